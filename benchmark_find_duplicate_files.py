@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for find_duplicate_files.py.
+
+Generates a synthetic directory tree (or uses an existing one) and measures:
+  - walk: the parallel scandir walker (and the out-of-core grouping) against
+          the original os.walk + getsize scan
+  - hash: hashing throughput (MB/s) of each hash_file strategy
+  - memory: peak RSS of the original dict-of-lists scan against the interned ScanStore
+  - latency: the threaded walker against the asyncio scanner on a filesystem
+            stand-in that adds a fixed delay to every listing and stat
+  - suite:  scan, grouping and report phases of name mode on a deterministic
+            synthetic tree, timed separately with peak memory, written as JSON
+            so runs can be compared between commits
+
+Usage:
+    python benchmark_find_duplicate_files.py [--bench walk hash memory suite] [--root <dir>] [--dirs N] [--files-per-dir N]
+    python benchmark_find_duplicate_files.py --bench suite --files 20000 --dup-ratio 0.3 --output new.json
+    python benchmark_find_duplicate_files.py --compare old.json new.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import find_duplicate_files as fdf
+
+
+def legacy_find_duplicate_files(root_dir: str) -> Dict[Tuple[str, int], List[str]]:
+    """The original os.walk + os.path.getsize scan, kept as the baseline."""
+    file_map = defaultdict(list)
+    root_dir = os.path.abspath(root_dir)
+    for dirpath, _, filenames in os.walk(root_dir):
+        for filename in filenames:
+            try:
+                file_size = os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+            file_map[(filename, file_size)].append(dirpath)
+    return {k: v for k, v in file_map.items() if len(v) > 1}
+
+
+def make_tree(root: str, dirs: int, files_per_dir: int, seed: int = 0, name_pool: Optional[int] = None) -> None:
+    """
+    Create a synthetic tree of small files with repeated names and sizes.
+
+    Names are drawn from `name_pool` candidates (default: 4 x files_per_dir,
+    so name+size collisions are common).
+    """
+    rng = random.Random(seed)
+    dir_paths = [root]
+    for i in range(dirs):
+        parent = rng.choice(dir_paths)
+        path = os.path.join(parent, f"dir_{i:05d}")
+        os.makedirs(path, exist_ok=True)
+        dir_paths.append(path)
+    name_pool = name_pool or files_per_dir * 4
+    for path in dir_paths:
+        for j in range(files_per_dir):
+            name = f"file_{rng.randrange(name_pool):08d}.bin"
+            with open(os.path.join(path, name), 'wb') as f:
+                f.write(b"x" * rng.randrange(64))
+
+
+def make_content_tree(root: str, file_count: int, min_size: int, max_size: int, seed: int = 0) -> None:
+    """Create `file_count` files of random content with log-uniform sizes."""
+    rng = random.Random(seed)
+    block = os.urandom(1024 * 1024)
+    for i in range(file_count):
+        size = int(math.exp(rng.uniform(math.log(min_size), math.log(max_size))))
+        with open(os.path.join(root, f"blob_{i:05d}.bin"), 'wb') as f:
+            remaining = size
+            while remaining:
+                n = min(remaining, len(block))
+                f.write(block[:n])
+                remaining -= n
+
+
+SIZE_DISTRIBUTIONS = ("fixed", "uniform", "lognormal")
+
+
+def make_synthetic_tree(
+    root: str,
+    depth: int = 3,
+    fanout: int = 6,
+    files: int = 5000,
+    dup_ratio: float = 0.2,
+    size_dist: str = "lognormal",
+    size_mean: int = 4096,
+    depth_ratio: float = 0.25,
+    main_ratio: float = 0.25,
+    seed: int = 0,
+) -> Dict[str, object]:
+    """
+    Create a deterministic synthetic tree for the benchmark suite.
+
+    The tree is a complete `fanout`-ary hierarchy `depth` levels deep. Files are
+    spread over all of its directories; a `dup_ratio` share of them are copies
+    (same name, size and contents) of an earlier file placed elsewhere. Names
+    follow the report categories: a `depth_ratio` share contain `_depth_`, a
+    `main_ratio` share contain `_main_`, the rest are plain files.
+
+    Args:
+        root: Existing empty directory to fill
+        depth: Directory levels below the root
+        fanout: Subdirectories per directory
+        files: Total number of files
+        dup_ratio: Share of files that duplicate another file (0-1)
+        size_dist: "fixed" (always size_mean), "uniform" (0 to 2 x size_mean)
+            or "lognormal" (median size_mean, long tail)
+        size_mean: Typical file size in bytes
+        depth_ratio: Share of names in the "Depth Maps" category
+        main_ratio: Share of names in the "Main Images" category
+        seed: Random seed; equal arguments always produce the same tree
+
+    Returns:
+        The generator parameters plus the resulting directory and byte counts
+    """
+    if size_dist not in SIZE_DISTRIBUTIONS:
+        raise ValueError(f"Unknown size distribution: {size_dist}")
+    rng = random.Random(seed)
+    dir_paths = [root]
+    level = [root]
+    for d in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(fanout):
+                path = os.path.join(parent, f"level{d}_{i:02d}")
+                os.makedirs(path, exist_ok=True)
+                next_level.append(path)
+        dir_paths.extend(next_level)
+        level = next_level
+
+    def draw_size() -> int:
+        if size_dist == "fixed":
+            return size_mean
+        if size_dist == "uniform":
+            return rng.randrange(2 * size_mean + 1)
+        return int(rng.lognormvariate(math.log(max(size_mean, 1)), 1.0))
+
+    originals: List[Tuple[str, int, int]] = []
+    total_bytes = 0
+    for i in range(files):
+        directory = rng.choice(dir_paths)
+        if originals and rng.random() < dup_ratio:
+            original = rng.choice(originals)
+        else:
+            roll = rng.random()
+            if roll < depth_ratio:
+                name = f"render_{i:07d}_depth_.png"
+            elif roll < depth_ratio + main_ratio:
+                name = f"render_{i:07d}_main_.png"
+            else:
+                name = f"file_{i:07d}.bin"
+            # Keep a seed rather than the bytes, so memory does not grow with the tree
+            originals.append((name, draw_size(), rng.getrandbits(32)))
+            original = originals[-1]
+        name, size, content_seed = original
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            # The copy landed next to its original; only one can exist
+            continue
+        with open(path, 'wb') as f:
+            f.write(random.Random(content_seed).randbytes(size))
+        total_bytes += size
+
+    return {
+        "depth": depth, "fanout": fanout, "files": files, "dup_ratio": dup_ratio,
+        "size_dist": size_dist, "size_mean": size_mean, "depth_ratio": depth_ratio,
+        "main_ratio": main_ratio, "seed": seed, "directories": len(dir_paths), "bytes": total_bytes,
+    }
+
+
+def time_call(func: Callable, repeat: int) -> Tuple[float, object]:
+    """Return the best wall-clock time of `repeat` calls and the last result."""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def _normalize(duplicates: Dict[Tuple[str, int], List[str]]) -> Dict[Tuple[str, int], List[str]]:
+    return {k: sorted(v) for k, v in duplicates.items()}
+
+
+def bench_walk(root: str, repeat: int, thread_counts: List[int]) -> None:
+    """Time the legacy walk and the parallel walker at several thread counts."""
+    print(f"\n=== Walk: {root} ===")
+    baseline_time, baseline = time_call(lambda: legacy_find_duplicate_files(root), repeat)
+    baseline = _normalize(baseline)
+    print(f"  {'os.walk + getsize':<24} {baseline_time:8.3f}s  ({len(baseline)} duplicate sets)")
+    for threads in thread_counts:
+        elapsed, result = time_call(lambda: fdf.find_duplicate_files(root, threads), repeat)
+        status = "OK" if _normalize(result) == baseline else "MISMATCH"
+        print(f"  {f'scandir x{threads} threads':<24} {elapsed:8.3f}s  "
+              f"speedup {baseline_time / elapsed:5.2f}x  [{status}]")
+    # Out-of-core grouping must agree with the in-memory result
+    budget = 1024 * 1024
+    elapsed, result = time_call(
+        lambda: dict(fdf.iter_duplicate_files_external(root, budget, max(thread_counts))), repeat)
+    status = "OK" if _normalize(result) == baseline else "MISMATCH"
+    print(f"  {'external sort (1 MB)':<24} {elapsed:8.3f}s  "
+          f"speedup {baseline_time / elapsed:5.2f}x  [{status}]")
+
+
+def _list_files(root: str) -> List[str]:
+    return [os.path.join(dirpath, name)
+            for dirpath, files in fdf.scan_tree(os.path.abspath(root))
+            for name, _ in files]
+
+
+def bench_hash(root: str, repeat: int, mmap_threshold: int) -> None:
+    """Report MB/s for every hashing strategy, plus the size-based default."""
+    paths = _list_files(root)
+    total = sum(os.path.getsize(p) for p in paths)
+    print(f"\n=== Hash: {len(paths)} files, {fdf.format_size(total)} ===")
+    # Warm the page cache so every strategy sees the same conditions
+    for path in paths:
+        fdf.hash_file(path, strategy="read")
+    runs = [(name, {"strategy": name}) for name in fdf.HASH_STRATEGIES]
+    runs.append((f"auto (mmap >= {fdf.format_size(mmap_threshold)})", {"mmap_threshold": mmap_threshold}))
+    for label, kwargs in runs:
+        elapsed, _ = time_call(lambda: [fdf.hash_file(p, **kwargs) for p in paths], repeat)
+        print(f"  {label:<32} {elapsed:8.3f}s  {total / elapsed / (1024 * 1024):9.1f} MB/s")
+
+
+class SlowFileSystem(fdf.LocalFileSystem):
+    """Local filesystem stand-in that sleeps before every call, like a network mount."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def list_entries(self, dirpath: str) -> List[Tuple[str, bool]]:
+        time.sleep(self.latency)
+        return super().list_entries(dirpath)
+
+    def stat(self, path: str) -> os.stat_result:
+        time.sleep(self.latency)
+        return super().stat(path)
+
+
+def _slow_list_directory(latency: float) -> Callable:
+    """list_directory for the threaded walker with the same per-call latency as SlowFileSystem."""
+    def lister(dirpath: str):
+        fs = SlowFileSystem(latency)
+        subdirs, files = [], []
+        for name, is_dir in fs.list_entries(dirpath):
+            path = os.path.join(dirpath, name)
+            if is_dir:
+                subdirs.append(path)
+            else:
+                files.append((name, fs.stat(path)))
+        return subdirs, files
+    return lister
+
+
+def bench_latency(root: str, latency: float, concurrencies: List[int], threads: int) -> None:
+    """
+    Scan through a slowed-down filesystem with the threaded walker and the
+    asyncio scanner, checking both against an unslowed find_duplicate_files.
+    """
+    print(f"\n=== Latency: {latency * 1000:.1f} ms per call, {root} ===")
+    expected = _normalize(fdf.find_duplicate_files(root))
+    root = os.path.abspath(root)
+
+    def threaded():
+        walk = fdf.scan_tree(root, threads, _slow_list_directory(latency))
+        return fdf.DuplicateMapView(fdf.build_scan_store(root, walk=walk))
+
+    baseline_time, result = time_call(threaded, 1)
+    status = "OK" if _normalize(result) == expected else "MISMATCH"
+    print(f"  {f'threaded x{threads}':<24} {baseline_time:8.3f}s  [{status}]")
+    for concurrency in concurrencies:
+        elapsed, result = time_call(
+            lambda: fdf.find_duplicate_files_async(root, concurrency, None, SlowFileSystem(latency)), 1)
+        status = "OK" if _normalize(result) == expected else "MISMATCH"
+        print(f"  {f'asyncio x{concurrency}':<24} {elapsed:8.3f}s  "
+              f"speedup {baseline_time / elapsed:5.2f}x  [{status}]")
+
+
+# Scan implementations compared by the memory benchmark, each run in a fresh process
+MEMORY_IMPLS = {
+    "baseline": lambda root: {},
+    "dict": legacy_find_duplicate_files,
+    "compact": lambda root: fdf.find_duplicate_files(root, 1),
+}
+
+
+def _peak_memory_bytes() -> Tuple[int, str]:
+    """Peak RSS of this process, or the tracemalloc peak where RSS is unavailable."""
+    # Linux: VmHWM is reset by exec, unlike ru_maxrss which inherits the parent's peak
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024, "peak RSS"
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return tracemalloc.get_traced_memory()[1], "tracemalloc peak"
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    return (peak if sys.platform == "darwin" else peak * 1024), "peak RSS"
+
+
+def _measure_memory(impl: str, root: str) -> None:
+    """Child-process side of bench_memory: run one scan and print its peak."""
+    try:
+        import resource  # noqa: F401
+    except ImportError:
+        tracemalloc.start()
+    result = MEMORY_IMPLS[impl](root)
+    sets = len(result)
+    peak, label = _peak_memory_bytes()
+    print(f"{peak} {sets} {label}")
+
+
+def bench_memory(root: str) -> None:
+    """Compare peak memory of the scan implementations, each in a fresh interpreter."""
+    print(f"\n=== Memory: {root} ===")
+    baseline = None
+    for impl in MEMORY_IMPLS:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--measure-memory", impl, "--root", root],
+            capture_output=True, text=True, check=True).stdout.split(maxsplit=2)
+        peak, sets, label = int(output[0]), int(output[1]), output[2].strip()
+        if baseline is None:
+            baseline = peak
+            print(f"  {impl:<10} {label}: {fdf.format_size(peak)} (interpreter only)")
+        else:
+            print(f"  {impl:<10} {label}: {fdf.format_size(peak)}  "
+                  f"scan cost: {fdf.format_size(peak - baseline)}  ({sets} duplicate sets)")
+
+
+SUITE_PHASES = ("scan", "group", "report")
+
+
+def _git_commit() -> Optional[str]:
+    """Commit of the checkout being benchmarked, if it is a git repository."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _run_phases(root: str, threads: int) -> Tuple[Dict[str, float], int]:
+    """Run scan, grouping and report once, returning each phase's wall time."""
+    timings = {}
+    start = time.perf_counter()
+    store = fdf.build_scan_store(root, threads)
+    timings["scan"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    duplicates = dict(fdf.DuplicateMapView(store).items())
+    timings["group"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        fdf.print_duplicates(duplicates)
+    timings["report"] = time.perf_counter() - start
+    return timings, len(duplicates)
+
+
+def _phase_peaks(root: str, threads: int) -> Dict[str, int]:
+    """Peak traced allocations of each phase, from one extra run (tracing slows everything down)."""
+    peaks = {}
+    tracemalloc.start()
+    try:
+        store = fdf.build_scan_store(root, threads)
+        peaks["scan"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        duplicates = dict(fdf.DuplicateMapView(store).items())
+        peaks["group"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        with contextlib.redirect_stdout(io.StringIO()):
+            fdf.print_duplicates(duplicates)
+        peaks["report"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def _suite_child(root: str, repeat: int, threads: int) -> None:
+    """Child-process side of bench_suite: run the phases and print JSON results."""
+    runs = []
+    sets = 0
+    for _ in range(repeat):
+        timings, sets = _run_phases(root, threads)
+        runs.append(timings)
+    # Read the RSS peak before tracing adds its own overhead
+    peak_rss, label = _peak_memory_bytes()
+    peaks = _phase_peaks(root, threads)
+    phases = {
+        phase: {
+            "best_s": min(run[phase] for run in runs),
+            "median_s": statistics.median(run[phase] for run in runs),
+            "peak_traced_bytes": peaks[phase],
+        }
+        for phase in SUITE_PHASES
+    }
+    print(json.dumps({"duplicate_sets": sets, "phases": phases, "peak_bytes": peak_rss, "peak_kind": label}))
+
+
+def bench_suite(root: str, repeat: int, threads: int, tree: Dict[str, object]) -> Dict[str, object]:
+    """
+    Time the scan, grouping and report phases of name mode in a fresh interpreter.
+
+    Returns:
+        Machine-readable results: environment, tree parameters, per-phase best
+        and median times and traced peaks, and the process's peak memory
+    """
+    print(f"\n=== Suite: {root} ===")
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--suite-child", "--root", root,
+         "--repeat", str(repeat), "--suite-threads", str(threads)],
+        capture_output=True, text=True, check=True).stdout
+    measured = json.loads(output)
+    for phase in SUITE_PHASES:
+        stats = measured["phases"][phase]
+        print(f"  {phase:<8} best {stats['best_s']:8.3f}s  median {stats['median_s']:8.3f}s  "
+              f"traced peak {fdf.format_size(stats['peak_traced_bytes']):>10}")
+    print(f"  {measured['peak_kind']}: {fdf.format_size(measured['peak_bytes'])}  "
+          f"({measured['duplicate_sets']} duplicate sets)")
+    return {
+        "format": 1,
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "threads": threads,
+        "repeat": repeat,
+        "tree": tree,
+        **measured,
+    }
+
+
+def compare_results(old_path: str, new_path: str, threshold: float) -> int:
+    """
+    Print per-phase changes between two suite result files.
+
+    Args:
+        old_path: Results of the reference commit
+        new_path: Results of the commit under test
+        threshold: Relative slowdown or memory growth reported as a regression
+
+    Returns:
+        Number of regressions found
+    """
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"=== Compare: {old.get('commit') or old_path} -> {new.get('commit') or new_path} ===")
+    if old.get("tree") != new.get("tree"):
+        print("  Warning: the results were measured on different trees")
+    regressions = 0
+    rows = [(f"{phase} time", old["phases"][phase]["best_s"], new["phases"][phase]["best_s"], "s")
+            for phase in SUITE_PHASES]
+    rows += [(f"{phase} memory", old["phases"][phase]["peak_traced_bytes"],
+              new["phases"][phase]["peak_traced_bytes"], "B") for phase in SUITE_PHASES]
+    rows.append(("peak memory", old["peak_bytes"], new["peak_bytes"], "B"))
+    for label, before, after, unit in rows:
+        change = (after - before) / before if before else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        elif change < -threshold:
+            flag = "  improved"
+        shown = (f"{before:8.3f}s -> {after:8.3f}s" if unit == "s"
+                 else f"{fdf.format_size(before):>10} -> {fdf.format_size(after):>10}")
+        print(f"  {label:<16} {shown}  {change:+7.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark find_duplicate_files.py.")
+    parser.add_argument("--bench", nargs="+", choices=["walk", "hash", "memory", "latency", "suite"],
+                        default=["walk", "hash", "memory"],
+                        help="Benchmarks to run (default: walk hash memory).")
+    parser.add_argument("--root", default=None, help="Existing tree to benchmark (default: generate one).")
+    parser.add_argument("--dirs", type=int, default=2000, help="Directories in the generated tree (default: 2000).")
+    parser.add_argument("--files-per-dir", type=int, default=20, help="Files per generated directory (default: 20).")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement; the best is reported (default: 3).")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 8, 16],
+                        help="Walker thread counts to measure (default: 1 4 8 16).")
+    parser.add_argument("--hash-files", type=int, default=64, help="Files in the generated hash tree (default: 64).")
+    parser.add_argument("--hash-max-size", type=int, default=64 * 1024 * 1024,
+                        help="Largest generated file for the hash benchmark in bytes (default: 64 MiB).")
+    parser.add_argument("--mmap-threshold", type=int, default=fdf.MMAP_THRESHOLD,
+                        help=f"Crossover size for the auto strategy (default: {fdf.MMAP_THRESHOLD}).")
+    parser.add_argument("--latency", type=float, default=0.002,
+                        help="Seconds added to every call by the latency benchmark (default: 0.002).")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[16, 64, 256],
+                        help="asyncio scanner concurrency levels to measure (default: 16 64 256).")
+    suite = parser.add_argument_group("suite", "Synthetic tree and results for --bench suite")
+    suite.add_argument("--depth", type=int, default=3, help="Directory levels below the root (default: 3).")
+    suite.add_argument("--fanout", type=int, default=6, help="Subdirectories per directory (default: 6).")
+    suite.add_argument("--files", type=int, default=5000, help="Total files (default: 5000).")
+    suite.add_argument("--dup-ratio", type=float, default=0.2,
+                       help="Share of files that copy another file (default: 0.2).")
+    suite.add_argument("--size-dist", choices=SIZE_DISTRIBUTIONS, default="lognormal",
+                       help="File size distribution (default: lognormal).")
+    suite.add_argument("--size-mean", type=int, default=4096, help="Typical file size in bytes (default: 4096).")
+    suite.add_argument("--depth-ratio", type=float, default=0.25,
+                       help="Share of _depth_ file names (default: 0.25).")
+    suite.add_argument("--main-ratio", type=float, default=0.25,
+                       help="Share of _main_ file names (default: 0.25).")
+    suite.add_argument("--seed", type=int, default=0, help="Generator seed (default: 0).")
+    suite.add_argument("--suite-threads", type=int, default=fdf.DEFAULT_WALK_THREADS,
+                       help=f"Walker threads for the suite (default: {fdf.DEFAULT_WALK_THREADS}).")
+    suite.add_argument("--output", default=None, metavar="PATH", help="Write suite results as JSON to PATH.")
+    suite.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), default=None,
+                       help="Compare two suite result files instead of running benchmarks.")
+    suite.add_argument("--threshold", type=float, default=0.10,
+                       help="Relative change reported as a regression by --compare (default: 0.10).")
+    parser.add_argument("--measure-memory", choices=list(MEMORY_IMPLS), help=argparse.SUPPRESS)
+    parser.add_argument("--suite-child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure_memory:
+        _measure_memory(args.measure_memory, args.root)
+        return
+    if args.suite_child:
+        _suite_child(args.root, args.repeat, args.suite_threads)
+        return
+    if args.compare:
+        sys.exit(1 if compare_results(args.compare[0], args.compare[1], args.threshold) else 0)
+
+    temp_roots = []
+    try:
+        if "walk" in args.bench:
+            root = args.root
+            if root is None:
+                root = tempfile.mkdtemp(prefix="fdf_bench_")
+                temp_roots.append(root)
+                print(f"Generating {args.dirs} directories x {args.files_per_dir} files in {root}...")
+                make_tree(root, args.dirs, args.files_per_dir)
+            bench_walk(root, args.repeat, args.threads)
+        if "memory" in args.bench:
+            root = args.root
+            if root is None:
+                root = tempfile.mkdtemp(prefix="fdf_bench_")
+                temp_roots.append(root)
+                print(f"\nGenerating {args.dirs} directories x {args.files_per_dir} files in {root}...")
+                # Mostly unique names, like a real tree
+                make_tree(root, args.dirs, args.files_per_dir, name_pool=args.dirs * args.files_per_dir * 10)
+            bench_memory(root)
+        if "hash" in args.bench:
+            root = args.root
+            if root is None:
+                root = tempfile.mkdtemp(prefix="fdf_bench_")
+                temp_roots.append(root)
+                print(f"\nGenerating {args.hash_files} files up to {fdf.format_size(args.hash_max_size)} in {root}...")
+                make_content_tree(root, args.hash_files, 1024, args.hash_max_size)
+            bench_hash(root, args.repeat, args.mmap_threshold)
+        if "latency" in args.bench:
+            root = args.root
+            if root is None:
+                root = tempfile.mkdtemp(prefix="fdf_bench_")
+                temp_roots.append(root)
+                # Small tree: every call is slow, so a full-size one would take minutes
+                dirs, files_per_dir = max(1, args.dirs // 10), args.files_per_dir
+                print(f"\nGenerating {dirs} directories x {files_per_dir} files in {root}...")
+                make_tree(root, dirs, files_per_dir)
+            bench_latency(root, args.latency, args.concurrency, max(args.threads))
+        if "suite" in args.bench:
+            root = args.root
+            tree = {"root": root}
+            if root is None:
+                root = tempfile.mkdtemp(prefix="fdf_bench_")
+                temp_roots.append(root)
+                print(f"\nGenerating {args.files} files, depth {args.depth} x fan-out {args.fanout}, in {root}...")
+                tree = make_synthetic_tree(
+                    root, args.depth, args.fanout, args.files, args.dup_ratio, args.size_dist,
+                    args.size_mean, args.depth_ratio, args.main_ratio, args.seed)
+            results = bench_suite(root, args.repeat, args.suite_threads, tree)
+            if args.output:
+                with open(args.output, 'w', encoding="utf-8") as f:
+                    json.dump(results, f, indent=2)
+                print(f"  Results written to {args.output}")
+    finally:
+        for root in temp_roots:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,155 +1,4276 @@
-#!/usr/bin/env python3
-"""
-Find duplicate files across subdirectories based on filename and filesize.
-Duplicates are defined as files with identical names AND sizes.
-"""
-
-import os
-from collections import defaultdict
-from typing import Dict, List, Tuple
-import sys
-from pathlib import Path
-
-
-def format_size(size_bytes: int) -> str:
-    """Convert bytes to human readable format."""
-    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-        if size_bytes < 1024:
-            return f"{size_bytes:.2f} {unit}"
-        size_bytes /= 1024
-    return f"{size_bytes:.2f} PB"
-
-
-def find_duplicate_files(root_dir: str) -> Dict[Tuple[str, int], List[str]]:
-    """
-    Scan directory tree for files with matching names and sizes.
-    
-    Args:
-        root_dir: Starting directory path to scan
-    
-    Returns:
-        Dictionary mapping (filename, size) to list of directory paths
-    """
-    file_map = defaultdict(list)
-    root_dir = os.path.abspath(root_dir)
-
-    try:
-        # Walk directory tree
-        for dirpath, _, filenames in os.walk(root_dir):
-            for filename in filenames:
-                try:
-                    filepath = os.path.join(dirpath, filename)
-                    # Get file size
-                    file_size = os.path.getsize(filepath)
-                    # Store directory path for this filename+size combination
-                    file_map[(filename, file_size)].append(dirpath)
-                except (OSError, PermissionError) as e:
-                    print(f"Error accessing {filepath}: {e}", file=sys.stderr)
-                    continue
-
-    except (OSError, PermissionError) as e:
-        print(f"Error scanning directory {root_dir}: {e}", file=sys.stderr)
-        return {}
-
-    # Filter out non-duplicates (files that only appear once)
-    return {k: v for k, v in file_map.items() if len(v) > 1}
-
-
-def print_duplicates(duplicates: Dict[Tuple[str, int], List[str]]) -> None:
-    """
-    Print formatted report of duplicate files, grouped by category.
-    Include summary of directory pairs containing duplicates.
-    
-    Args:
-        duplicates: Dictionary mapping (filename, size) to list of directory paths
-    """
-    if not duplicates:
-        print("\nNo duplicate files found.")
-        return
-
-    # Track directory pairs that contain duplicates
-    dir_pairs: Dict[Tuple[str, str], List[Tuple[str, int]]] = defaultdict(list)
-    
-    # Group files by category
-    categories: Dict[str, List[Tuple[Tuple[str, int], List[str]]]] = defaultdict(list)
-    total_wasted_space = 0
-    
-    for (filename, size), directories in duplicates.items():
-        # Identify category based on filename pattern
-        if "_depth_" in filename:
-            category = "Depth Maps"
-        elif "_main_" in filename:
-            category = "Main Images"
-        else:
-            category = "Other Files"
-            
-        # Calculate wasted space (size * (num_copies - 1))
-        total_wasted_space += size * (len(directories) - 1)
-        categories[category].append(((filename, size), directories))
-        
-        # Track directory pairs containing duplicates
-        sorted_dirs = sorted(directories)
-        for i in range(len(sorted_dirs)):
-            for j in range(i + 1, len(sorted_dirs)):
-                dir_pair = (sorted_dirs[i], sorted_dirs[j])
-                dir_pairs[dir_pair].append((filename, size))
-
-    # Print summary by category
-    print(f"\nFound {len(duplicates)} sets of duplicate files:\n")
-    
-    # Flatten list of all directories for common prefix calculation
-    all_dirs = []
-    for dirs in duplicates.values():
-        all_dirs.extend(dirs)
-    common_prefix = os.path.commonpath(all_dirs)
-    
-    for category, items in sorted(categories.items()):
-        print(f"=== {category} ===")
-        for (filename, size), directories in sorted(items):
-            print("\nDuplicate Found:")
-            print(f"  File Name: {filename}")
-            print(f"  File Size: {format_size(size)}")
-            print("  Locations:")
-            for directory in sorted(directories):
-                # Show relative path from common prefix for readability
-                rel_path = os.path.relpath(directory, common_prefix)
-                print(f"    - .../{rel_path}")
-        print("-" * 80)
-    
-    # Print space savings summary
-    print(f"\nTotal space that could be saved by removing duplicates: {format_size(total_wasted_space)}")
-    
-    # Print directory pairs summary
-    print("\nDirectory Pairs Containing Duplicates:")
-    print("-" * 80)
-    
-    common_prefix = os.path.commonpath([d for dirs in duplicates.values() for d in dirs])
-    
-    for (dir1, dir2), files in sorted(dir_pairs.items(), key=lambda x: len(x[1]), reverse=True):
-        # Show relative paths from common prefix
-        rel_dir1 = os.path.relpath(dir1, common_prefix)
-        rel_dir2 = os.path.relpath(dir2, common_prefix)
-        
-        total_size = sum(size for _, size in files)
-        print(f"\nPair containing {len(files)} duplicate files (Total: {format_size(total_size)}):")
-        print(f"  - .../{rel_dir1}")
-        print(f"  - .../{rel_dir2}")
-
-
-def main():
-    # Hardcoded path - can be modified or made into a command line argument
-    target_dir = r"C:\Users\Casey\OneDrive\CSM\CD\_WIP\.Next\_3Dnext\_DOWNselect"
-    
-    if not os.path.exists(target_dir):
-        print(f"Error: Directory not found: {target_dir}", file=sys.stderr)
-        sys.exit(1)
-    
-    print(f"Scanning directory: {target_dir}")
-    print("This may take a while depending on the number of files...")
-    
-    duplicates = find_duplicate_files(target_dir)
-    print_duplicates(duplicates)
-
-
-if __name__ == "__main__":
-    main()
\ No newline at end of file
+#!/usr/bin/env python3
+"""
+Find duplicate files across subdirectories.
+
+Several detection modes are available:
+  - name:    files with identical names AND sizes (fast, no file contents read)
+  - content: files with identical contents, regardless of name. Candidates are
+             narrowed by size, then by a hash of the first and last few KB,
+             and survivors are confirmed with a full-file hash.
+  - dirs:    whole directory subtrees that are identical.
+  - compare: which files of the tree are present in, changed in or missing from
+             a reference tree such as a backup, using a reusable index of it.
+
+Inside a git work tree, content mode can take the hashes of clean tracked
+files from the git index instead of reading them (--git).
+
+--chunks adds a content-defined chunking pass that estimates how much space
+chunk-level deduplication would save for files that are only partly alike.
+
+Hardlinks of one file are never counted as duplicates of each other. Content
+duplicates can optionally be replaced with hardlinks or reflinks (--link).
+"""
+
+import argparse
+import asyncio
+import fnmatch
+import cProfile
+import copy
+import functools
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import mmap
+import os
+import pstats
+import queue
+import re
+import shutil
+import socket
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from array import array
+from collections import defaultdict, deque
+from datetime import datetime
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Tuple, Union
+import sys
+from pathlib import Path
+
+
+# Bytes read from each end of a file for the partial-hash stage
+PARTIAL_HASH_BYTES = 4096
+# Chunk size used when hashing whole files
+HASH_CHUNK_BYTES = 1024 * 1024
+# Files at least this large are hashed through mmap instead of readinto
+MMAP_THRESHOLD = 16 * 1024 * 1024
+# Threads used to walk the directory tree
+DEFAULT_WALK_THREADS = 8
+# Filesystem calls in flight, and seconds allowed per call, for the asyncio scanner
+DEFAULT_ASYNC_CONCURRENCY = 64
+DEFAULT_OP_TIMEOUT = 30.0
+# Order in which the content-mode stages run (used for reporting)
+CONTENT_STAGES = ("size", "partial", "full")
+# Entries shown by --profile
+PROFILE_TOP_N = 25
+
+
+def format_size(size_bytes: int) -> str:
+    """Convert bytes to human readable format."""
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if size_bytes < 1024:
+            return f"{size_bytes:.2f} {unit}"
+        size_bytes /= 1024
+    return f"{size_bytes:.2f} PB"
+
+
+class ScanProgress:
+    """
+    Run-wide counters and per-phase timings, with an optional live status line.
+
+    Counting is always on and cheap. When enabled, a single status line on
+    stderr is redrawn at most every `interval` seconds with directories
+    visited, files stat'ed, bytes hashed, errors and the current rates.
+    Rates are measured over the whole run.
+    """
+
+    def __init__(self, enabled: bool = False, interval: float = 0.5):
+        self.enabled = enabled
+        self.interval = interval
+        self.dirs = 0
+        self.files = 0
+        self.files_hashed = 0
+        self.bytes_hashed = 0
+        self.errors = 0
+        # Cleared by rewalk() once the tree has been counted
+        self._counting = True
+        # Phase name -> seconds spent, in the order phases were entered
+        self.phases: Dict[str, float] = {}
+        self._phase: Optional[str] = None
+        self._start = self._phase_start = time.perf_counter()
+        self._last_draw = 0.0
+        self._drawn = False
+        # Directories and errors are counted from walker threads
+        self._lock = threading.Lock()
+
+    def phase(self, name: str) -> None:
+        """Close the current phase and start timing `name`."""
+        now = time.perf_counter()
+        if self._phase is not None:
+            self.phases[self._phase] = self.phases.get(self._phase, 0.0) + now - self._phase_start
+        self._phase = name
+        self._phase_start = now
+
+    def visited(self, file_count: int) -> None:
+        """Count one listed directory (with or without files) and its files."""
+        with self._lock:
+            if self._counting:
+                self.dirs += 1
+                self.files += file_count
+            self._tick()
+
+    def rewalk(self) -> None:
+        """Stop counting directories and files: later passes walk the tree the scan already counted."""
+        with self._lock:
+            self._counting = False
+
+    def hashed(self, nbytes: int) -> None:
+        """Count one hash pass over a file (partial and full passes count separately)."""
+        self.files_hashed += 1
+        self.bytes_hashed += nbytes
+        self._tick()
+
+    def error(self) -> None:
+        with self._lock:
+            self.errors += 1
+
+    def _tick(self, now: Optional[float] = None) -> None:
+        if not self.enabled:
+            return
+        now = now or time.perf_counter()
+        if now - self._last_draw >= self.interval:
+            self._last_draw = now
+            self._draw(now)
+
+    def _draw(self, now: float) -> None:
+        elapsed = max(now - self._start, 1e-9)
+        line = (f"[{self._phase or 'start'}] {self.dirs:,} dirs  {self.files:,} files  "
+                f"{format_size(self.bytes_hashed)} hashed  {self.errors:,} errors  "
+                f"{self.files / elapsed:,.0f} files/s  {self.bytes_hashed / elapsed / (1024 * 1024):,.1f} MB/s")
+        sys.stderr.write("\r" + line.ljust(100))
+        sys.stderr.flush()
+        self._drawn = True
+
+    def clear_line(self) -> None:
+        """Blank the status line so other output starts on a clean line."""
+        if self._drawn:
+            sys.stderr.write("\r" + " " * 100 + "\r")
+            sys.stderr.flush()
+            self._drawn = False
+
+    def finish(self) -> None:
+        """Close the last phase and remove the status line."""
+        self.phase("done")
+        self.phases.pop("done", None)
+        self._phase = None
+        self.clear_line()
+
+    def print_summary(self, out=None) -> None:
+        """Print counters and the per-phase timing breakdown."""
+        out = out or sys.stdout
+        total = sum(self.phases.values()) or 1e-9
+        print(f"\nScanned {self.dirs:,} directories, {self.files:,} files; {self.files_hashed:,} hash passes "
+              f"read {format_size(self.bytes_hashed)}; {self.errors:,} errors.", file=out)
+        print("Phase timings:", file=out)
+        for name, seconds in self.phases.items():
+            print(f"  {name:<16} {seconds:9.3f}s  {seconds / total:6.1%}", file=out)
+        print(f"  {'total':<16} {total:9.3f}s", file=out)
+
+
+# Shared by every scan in this process; main() turns the status line on
+progress = ScanProgress()
+
+
+def _report_error(message: str, count: bool = True) -> None:
+    """
+    Print a non-fatal error to stderr and count it.
+
+    Hashing functions pass count=False: they may run in a worker process, so
+    the caller counts their failed results instead.
+    """
+    if count:
+        progress.error()
+    progress.clear_line()
+    print(message, file=sys.stderr)
+
+
+# Report categories checked in order by ScanRules.categorize; anything else is "Other Files"
+DEFAULT_CATEGORIES = (("Depth Maps", "*_depth_*"), ("Main Images", "*_main_*"))
+
+
+def _compile_globs(globs: Iterable[str]) -> Tuple[Optional["re.Pattern"], Optional["re.Pattern"]]:
+    """
+    Compile globs into one regex for bare names and one for full paths.
+
+    Globs containing a path separator match the full path (with "/" as the
+    separator); the others match the bare name. Matching ignores case on Windows.
+    """
+    flags = re.IGNORECASE if os.name == "nt" else 0
+    name_globs, path_globs = [], []
+    for glob in globs:
+        glob = glob.replace("\\", "/")
+        (path_globs if "/" in glob else name_globs).append(fnmatch.translate(glob))
+    return (re.compile("|".join(name_globs), flags) if name_globs else None,
+            re.compile("|".join(path_globs), flags) if path_globs else None)
+
+
+def _glob_match(compiled: Tuple[Optional["re.Pattern"], Optional["re.Pattern"]], path: str, name: str) -> bool:
+    name_re, path_re = compiled
+    if name_re is not None and name_re.match(name):
+        return True
+    return path_re is not None and bool(path_re.match(path.replace(os.sep, "/")))
+
+
+def _sample_hash(value: bytes) -> int:
+    """Stable 64-bit hash used to sample keys consistently across files and runs."""
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8, person=b"fdf-sample").digest(), "little")
+
+
+def _sample_threshold(rate: float) -> int:
+    """Hashes below this value are in a `rate` sample."""
+    return min(int(rate * (1 << 64)), 1 << 64)
+
+
+class ScanRules:
+    """
+    Compiled include/exclude rules, applied inside the walker.
+
+    Directories matching a prune glob are never descended into. Files are
+    rejected by name (include/exclude globs, extensions) before they are
+    stat'ed, and by size and mtime straight after, so nothing filtered out
+    reaches the scan results. The rules also hold the report categories.
+
+    with_name_sample() adds a sample of filenames chosen by hash, so every file
+    sharing a name is kept or dropped together (see estimate_duplicates).
+    """
+
+    def __init__(
+        self,
+        include: Iterable[str] = (),
+        exclude: Iterable[str] = (),
+        prune: Iterable[str] = (),
+        extensions: Iterable[str] = (),
+        min_size: Optional[int] = None,
+        max_size: Optional[int] = None,
+        min_mtime: Optional[float] = None,
+        max_mtime: Optional[float] = None,
+        categories: Iterable[Tuple[str, str]] = DEFAULT_CATEGORIES,
+    ):
+        """
+        Args:
+            include: If given, only files matching one of these globs are kept
+            exclude: Files matching any of these globs are dropped
+            prune: Directories matching any of these globs are not descended into
+            extensions: If given, only files with one of these extensions are kept
+            min_size: Smallest file size kept, in bytes
+            max_size: Largest file size kept, in bytes
+            min_mtime: Oldest modification time kept (seconds since the epoch)
+            max_mtime: Newest modification time kept (seconds since the epoch)
+            categories: (category name, glob) pairs for the reports, checked in order
+        """
+        self._include = _compile_globs(include) if include else None
+        self._exclude = _compile_globs(exclude)
+        self._prune = _compile_globs(prune)
+        normalized = {ext.lower() if ext.startswith(".") else "." + ext.lower() for ext in extensions}
+        self.extensions = tuple(sorted(normalized)) or None
+        self.min_size = min_size
+        self.max_size = max_size
+        self._min_mtime_ns = int(min_mtime * 1e9) if min_mtime is not None else None
+        self._max_mtime_ns = int(max_mtime * 1e9) if max_mtime is not None else None
+        self.categories = [(name, _compile_globs([glob])) for name, glob in categories]
+        self.name_sample: Optional[float] = None
+        self._sample_below: Optional[int] = None
+
+    def with_name_sample(self, rate: float) -> "ScanRules":
+        """Copy of these rules that also keeps only a `rate` fraction (0 to 1) of filenames."""
+        rules = copy.copy(self)
+        rules.name_sample = rate
+        rules._sample_below = _sample_threshold(rate)
+        return rules
+
+    def keep_dir(self, path: str, name: str) -> bool:
+        """Whether to descend into a subdirectory."""
+        return not _glob_match(self._prune, path, name)
+
+    def keep_name(self, path: str, name: str) -> bool:
+        """Whether a file passes the name rules (checked before it is stat'ed)."""
+        if self._sample_below is not None and _sample_hash(os.fsencode(name)) >= self._sample_below:
+            return False
+        if self.extensions is not None and not name.lower().endswith(self.extensions):
+            return False
+        if self._include is not None and not _glob_match(self._include, path, name):
+            return False
+        return not _glob_match(self._exclude, path, name)
+
+    def keep_stat(self, st) -> bool:
+        """Whether a file passes the size and mtime rules."""
+        if self.min_size is not None and st.st_size < self.min_size:
+            return False
+        if self.max_size is not None and st.st_size > self.max_size:
+            return False
+        if self._min_mtime_ns is not None and st.st_mtime_ns < self._min_mtime_ns:
+            return False
+        return self._max_mtime_ns is None or st.st_mtime_ns <= self._max_mtime_ns
+
+    def filter_listing(
+        self,
+        subdirs: List[str],
+        files: List[Tuple[str, os.stat_result]],
+        dirpath: str,
+    ) -> Tuple[List[str], List[Tuple[str, os.stat_result]]]:
+        """Apply every rule to one directory listed without them."""
+        subdirs = [path for path in subdirs if self.keep_dir(path, os.path.basename(path))]
+        files = [(name, st) for name, st in files
+                 if self.keep_name(os.path.join(dirpath, name), name) and self.keep_stat(st)]
+        return subdirs, files
+
+    def categorize(self, filename: str, path: Optional[str] = None) -> str:
+        """Report category of a file: the first category whose glob matches it."""
+        for category, compiled in self.categories:
+            if _glob_match(compiled, path or filename, filename):
+                return category
+        return "Other Files"
+
+
+# Rules used when none are given: keep everything, default categories
+DEFAULT_RULES = ScanRules()
+
+
+def list_directory(dirpath: str, rules: Optional[ScanRules] = None) -> Tuple[List[str], List[Tuple[str, os.stat_result]]]:
+    """
+    List one directory with os.scandir.
+
+    Args:
+        dirpath: Directory to list
+        rules: Optional ScanRules; pruned subdirectories and rejected files are
+            left out, and files rejected by name are never stat'ed
+
+    Returns:
+        (subdirectory paths, [(filename, stat_result), ...])
+    """
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                try:
+                    # Same split as os.walk: symlinked dirs are listed but not followed
+                    if entry.is_dir():
+                        if not entry.is_symlink() and (rules is None or rules.keep_dir(entry.path, entry.name)):
+                            subdirs.append(entry.path)
+                        continue
+                    if rules is not None and not rules.keep_name(entry.path, entry.name):
+                        continue
+                    # On Windows this stat comes free with the directory listing
+                    st = entry.stat()
+                    if rules is None or rules.keep_stat(st):
+                        files.append((entry.name, st))
+                except (OSError, PermissionError) as e:
+                    _report_error(f"Error accessing {entry.path}: {e}")
+    except (OSError, PermissionError) as e:
+        _report_error(f"Error scanning directory {dirpath}: {e}")
+    return subdirs, files
+
+
+class _WorkStealingWalker:
+    """
+    Walk a directory tree on a pool of threads using os.scandir.
+
+    Each thread owns a deque of directories still to scan. A thread pushes the
+    subdirectories it discovers onto its own deque and pops from the same end
+    (depth-first, cache friendly); an idle thread steals from the opposite end
+    of another thread's deque, which tends to hand it a large unexplored subtree.
+    """
+
+    def __init__(self, root_dir: str, workers: int, lister: Callable = list_directory):
+        self._lister = lister
+        self._workers = max(1, workers)
+        self._deques = [deque() for _ in range(self._workers)]
+        self._deques[0].append(root_dir)
+        # Directories queued or currently being scanned
+        self._pending = 1
+        self._cond = threading.Condition()
+        # (dirpath, files), an exception raised by a lister, or None when a thread exits
+        self._results: "queue.Queue[Union[None, Exception, Tuple[str, List[Tuple[str, os.stat_result]]]]]" = \
+            queue.Queue()
+        self._stopped = False
+
+    def _take(self, index: int) -> Optional[str]:
+        """Pop work from this thread's deque, or steal from another one."""
+        try:
+            return self._deques[index].pop()
+        except IndexError:
+            pass
+        for offset in range(1, self._workers):
+            try:
+                return self._deques[(index + offset) % self._workers].popleft()
+            except IndexError:
+                continue
+        return None
+
+    def _scan(self, index: int, dirpath: str) -> List[Tuple[str, os.stat_result]]:
+        """List one directory, queue its subdirectories and return its files."""
+        try:
+            subdirs, files = self._lister(dirpath)
+            # Counted here rather than by the consumer, which only sees directories with files
+            progress.visited(len(files))
+
+            if subdirs:
+                with self._cond:
+                    # Count the work before publishing it so _pending never dips to 0 early
+                    self._pending += len(subdirs)
+                    self._deques[index].extend(subdirs)
+                    self._cond.notify(len(subdirs))
+        finally:
+            # Even when the lister raises, or the other threads wait for this directory forever
+            with self._cond:
+                self._pending -= 1
+                if self._pending == 0:
+                    self._cond.notify_all()
+        return files
+
+    def _run(self, index: int) -> None:
+        try:
+            while not self._stopped:
+                dirpath = self._take(index)
+                if dirpath is None:
+                    with self._cond:
+                        if self._pending == 0:
+                            break
+                        # Timeout guards against a push racing past our empty check
+                        self._cond.wait(0.05)
+                    continue
+                files = self._scan(index, dirpath)
+                if files:
+                    self._results.put((dirpath, files))
+        except Exception as e:
+            # Handed to the consumer, which re-raises it; listers report OSError themselves
+            self._stopped = True
+            self._results.put(e)
+        finally:
+            self._results.put(None)
+
+    def __iter__(self) -> Iterator[Tuple[str, List[Tuple[str, os.stat_result]]]]:
+        if self._workers == 1:
+            # No one to steal from: skip the threads and the result queue
+            while self._deques[0]:
+                dirpath = self._deques[0].pop()
+                files = self._scan(0, dirpath)
+                if files:
+                    yield dirpath, files
+            return
+        threads = [threading.Thread(target=self._run, args=(i,), daemon=True)
+                   for i in range(self._workers)]
+        for thread in threads:
+            thread.start()
+        finished = 0
+        try:
+            while finished < self._workers:
+                item = self._results.get()
+                if item is None:
+                    finished += 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            self._stopped = True
+
+
+def scan_tree(
+    root_dir: str,
+    workers: int = DEFAULT_WALK_THREADS,
+    lister: Callable = list_directory,
+) -> Iterator[Tuple[str, List[Tuple[str, os.stat_result]]]]:
+    """
+    Walk a directory tree in parallel, yielding each directory's files.
+
+    Directories are yielded in no particular order.
+
+    Args:
+        root_dir: Absolute directory path to scan
+        workers: Number of walker threads
+        lister: Function listing one directory (see list_directory); a
+            ScanIndex supplies one that reuses unchanged directories
+
+    Yields:
+        (dirpath, [(filename, stat_result), ...]) for every directory with files
+    """
+    yield from _WorkStealingWalker(root_dir, workers, lister)
+
+
+class LocalFileSystem:
+    """
+    The two filesystem operations made by scan_tree_async.
+
+    Kept behind an object so tests and benchmarks can substitute a slowed-down
+    or otherwise simulated filesystem.
+    """
+
+    def list_entries(self, dirpath: str) -> List[Tuple[str, bool]]:
+        """
+        List one directory without stat'ing its files.
+
+        Returns:
+            [(name, is_dir), ...]; as in list_directory, symlinked directories are left out
+        """
+        entries = []
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            entries.append((entry.name, True))
+                        continue
+                except (OSError, PermissionError) as e:
+                    _report_error(f"Error accessing {entry.path}: {e}")
+                    continue
+                entries.append((entry.name, False))
+        return entries
+
+    def stat(self, path: str) -> os.stat_result:
+        return os.stat(path)
+
+
+async def scan_tree_async(
+    root_dir: str,
+    concurrency: int = DEFAULT_ASYNC_CONCURRENCY,
+    timeout: Optional[float] = DEFAULT_OP_TIMEOUT,
+    fs: Optional[LocalFileSystem] = None,
+    rules: Optional[ScanRules] = None,
+) -> List[Tuple[str, List[Tuple[str, os.stat_result]]]]:
+    """
+    Walk a directory tree with asyncio, for mounts where every call is slow.
+
+    Every directory listing and every file stat is a separate operation run
+    on a thread pool, with at most `concurrency` in flight, so on a network
+    or cloud-synced mount the latencies overlap instead of adding up. An
+    operation taking longer than `timeout` seconds is reported as an error
+    and skipped; its thread cannot be interrupted and keeps its pool slot
+    until the call returns.
+
+    Args:
+        root_dir: Absolute directory path to scan
+        concurrency: Maximum filesystem operations in flight
+        timeout: Seconds allowed per operation (None = no limit)
+        fs: Filesystem to scan through (default: LocalFileSystem)
+        rules: Optional ScanRules to filter files and prune directories with
+
+    Returns:
+        Same records as scan_tree: [(dirpath, [(filename, stat_result), ...])]
+        for every directory with files, in no particular order
+    """
+    fs = fs or LocalFileSystem()
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    results: List[Tuple[str, List[Tuple[str, os.stat_result]]]] = []
+
+    async def call(func, *args):
+        async with semaphore:
+            return await asyncio.wait_for(loop.run_in_executor(executor, func, *args), timeout)
+
+    async def stat_file(path: str) -> Optional[os.stat_result]:
+        try:
+            return await call(fs.stat, path)
+        except asyncio.TimeoutError:
+            _report_error(f"Error accessing {path}: timed out after {timeout}s")
+        except (OSError, PermissionError) as e:
+            _report_error(f"Error accessing {path}: {e}")
+        return None
+
+    async def visit(dirpath: str) -> None:
+        try:
+            entries = await call(fs.list_entries, dirpath)
+        except asyncio.TimeoutError:
+            _report_error(f"Error scanning directory {dirpath}: timed out after {timeout}s")
+            return
+        except (OSError, PermissionError) as e:
+            _report_error(f"Error scanning directory {dirpath}: {e}")
+            return
+        names = [name for name, is_dir in entries if not is_dir]
+        subdirs = [os.path.join(dirpath, name) for name, is_dir in entries if is_dir]
+        if rules is not None:
+            names = [name for name in names if rules.keep_name(os.path.join(dirpath, name), name)]
+            subdirs = [path for path in subdirs if rules.keep_dir(path, os.path.basename(path))]
+        stats, _ = await asyncio.gather(
+            asyncio.gather(*(stat_file(os.path.join(dirpath, name)) for name in names)),
+            asyncio.gather(*(visit(path) for path in subdirs)),
+        )
+        files = [(name, st) for name, st in zip(names, stats)
+                 if st is not None and (rules is None or rules.keep_stat(st))]
+        progress.visited(len(files))
+        if files:
+            results.append((dirpath, files))
+
+    try:
+        await visit(root_dir)
+    finally:
+        # Don't wait for calls that timed out and may never return
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+
+class _CachedStat(NamedTuple):
+    """The os.stat_result fields a ScanIndex keeps for each file."""
+    st_size: int
+    st_mtime_ns: int
+    st_ino: int
+    st_dev: int = 0
+
+
+def _file_id(st) -> Optional[Tuple[int, int]]:
+    """(st_dev, st_ino) identifying the file behind a path, or None where unknown."""
+    return (st.st_dev, st.st_ino) if st.st_ino else None
+
+
+def default_index_path(root_dir: str) -> str:
+    """Index file kept next to (not inside) the scan root."""
+    root_dir = os.path.abspath(root_dir)
+    parent, name = os.path.split(root_dir)
+    return os.path.join(parent, f".{name}.fdf-index.sqlite")
+
+
+class ScanIndex:
+    """
+    Persistent SQLite record of previous scans, used for incremental rescans.
+
+    Directories whose mtime is unchanged since the last scan are not listed
+    again: their files and subdirectories are read back from the index, so a
+    rescan costs one stat per directory plus the work for whatever changed.
+    A directory's mtime only moves when entries are added, removed or renamed,
+    so a file rewritten in place inside an otherwise untouched directory is not
+    noticed; use full_rescan=True to re-list everything (hashes are still reused).
+
+    Cached hashes are kept only while a file's size, mtime and inode match.
+    """
+
+    SCHEMA = """
+        PRAGMA journal_mode = WAL;
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS dirs (
+            path TEXT PRIMARY KEY,
+            parent TEXT NOT NULL,
+            mtime_ns INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+        CREATE TABLE IF NOT EXISTS files (
+            dir TEXT NOT NULL,
+            name TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            partial_hash TEXT,
+            full_hash TEXT,
+            PRIMARY KEY (dir, name)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, db_path: str, full_rescan: bool = False):
+        self.db_path = db_path
+        self.full_rescan = full_rescan
+        self.dirs_listed = 0
+        self.dirs_reused = 0
+        self._conn = sqlite3.connect(db_path)
+        self._conn.executescript(self.SCHEMA)
+        # Walker threads read through their own connections
+        self._local = threading.local()
+        self._readers: List[sqlite3.Connection] = []
+        self._updates: List[Tuple[str, int, List[Tuple[str, os.stat_result]]]] = []
+        self._visited: List[str] = []
+        self._pruned: List[str] = []
+        self._rules: Optional[ScanRules] = None
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._local.conn = conn
+            self._readers.append(conn)
+        return conn
+
+    def _list_directory(self, dirpath: str) -> Tuple[List[str], List[Tuple[str, os.stat_result]]]:
+        """list_directory replacement that reuses directories with an unchanged mtime."""
+        subdirs, files = self._list_unfiltered(dirpath)
+        rules = self._rules
+        if rules is None:
+            return subdirs, files
+        kept, files = rules.filter_listing(subdirs, files, dirpath)
+        if len(kept) != len(subdirs):
+            kept_set = set(kept)
+            self._pruned.extend(path for path in subdirs if path not in kept_set)
+        return kept, files
+
+    def _list_unfiltered(self, dirpath: str) -> Tuple[List[str], List[Tuple[str, os.stat_result]]]:
+        # The index always records complete listings, so a scan with other rules can reuse them
+        try:
+            dir_st = os.stat(dirpath)
+        except (OSError, PermissionError) as e:
+            _report_error(f"Error scanning directory {dirpath}: {e}")
+            return [], []
+        self._visited.append(dirpath)
+        mtime_ns = dir_st.st_mtime_ns
+
+        if not self.full_rescan:
+            conn = self._reader()
+            row = conn.execute("SELECT mtime_ns FROM dirs WHERE path = ?", (dirpath,)).fetchone()
+            if row is not None and row[0] == mtime_ns:
+                subdirs = [path for (path,) in conn.execute(
+                    "SELECT path FROM dirs WHERE parent = ?", (dirpath,))]
+                # Files live on their directory's device, so st_dev need not be stored
+                files = [(name, _CachedStat(size, mtime, inode, dir_st.st_dev))
+                         for name, size, mtime, inode in conn.execute(
+                             "SELECT name, size, mtime_ns, inode FROM files WHERE dir = ?", (dirpath,))]
+                return subdirs, files
+
+        subdirs, files = list_directory(dirpath)
+        self._updates.append((dirpath, mtime_ns, files))
+        return subdirs, files
+
+    def _commit(self, root_dir: str) -> None:
+        """Write re-listed directories back and forget ones that disappeared."""
+        conn = self._conn
+        with conn:
+            for dirpath, mtime_ns, files in self._updates:
+                conn.execute(
+                    "INSERT INTO dirs (path, parent, mtime_ns) VALUES (?, ?, ?) "
+                    "ON CONFLICT (path) DO UPDATE SET parent = excluded.parent, mtime_ns = excluded.mtime_ns",
+                    (dirpath, os.path.dirname(dirpath), mtime_ns))
+                names = {name for name, _ in files}
+                stale = [(dirpath, name) for (name,) in conn.execute(
+                    "SELECT name FROM files WHERE dir = ?", (dirpath,)) if name not in names]
+                conn.executemany("DELETE FROM files WHERE dir = ? AND name = ?", stale)
+                # Keep cached hashes only when the file looks untouched
+                conn.executemany(
+                    "INSERT INTO files (dir, name, size, mtime_ns, inode) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (dir, name) DO UPDATE SET "
+                    "  partial_hash = CASE WHEN files.size = excluded.size AND files.mtime_ns = excluded.mtime_ns "
+                    "                       AND files.inode = excluded.inode THEN files.partial_hash END, "
+                    "  full_hash = CASE WHEN files.size = excluded.size AND files.mtime_ns = excluded.mtime_ns "
+                    "                    AND files.inode = excluded.inode THEN files.full_hash END, "
+                    "  size = excluded.size, mtime_ns = excluded.mtime_ns, inode = excluded.inode",
+                    [(dirpath, name, st.st_size, st.st_mtime_ns, st.st_ino) for name, st in files])
+
+            # Pruned directories stay listed under their parent, but must be re-listed when next visited
+            conn.executemany(
+                "INSERT INTO dirs (path, parent, mtime_ns) VALUES (?, ?, -1) "
+                "ON CONFLICT (path) DO UPDATE SET mtime_ns = -1",
+                ((path, os.path.dirname(path)) for path in self._pruned))
+
+            # Everything under the root that was not visited no longer exists
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS visited (path TEXT PRIMARY KEY)")
+            conn.execute("DELETE FROM visited")
+            conn.executemany("INSERT OR IGNORE INTO visited (path) VALUES (?)",
+                             ((p,) for p in itertools.chain(self._visited, self._pruned)))
+            # Range bounds select every path strictly below root_dir
+            low, high = root_dir + os.sep, root_dir + chr(ord(os.sep) + 1)
+            for table, column in (("files", "dir"), ("dirs", "path")):
+                conn.execute(
+                    f"DELETE FROM {table} WHERE ({column} = ? OR ({column} >= ? AND {column} < ?)) "
+                    f"AND {column} NOT IN (SELECT path FROM visited)",
+                    (root_dir, low, high))
+
+    def scan(
+        self,
+        root_dir: str,
+        workers: int = DEFAULT_WALK_THREADS,
+        rules: Optional[ScanRules] = None,
+    ) -> Iterator[Tuple[str, List[Tuple[str, os.stat_result]]]]:
+        """
+        Walk root_dir like scan_tree, refreshing the index from what changed.
+
+        The index is only updated once the walk has run to completion. Rules
+        filter what is yielded, not what is recorded, except that pruned
+        directories are not descended into.
+        """
+        root_dir = os.path.abspath(root_dir)
+        self._updates = []
+        self._visited = []
+        self._pruned = []
+        self._rules = rules
+        try:
+            yield from scan_tree(root_dir, workers, self._list_directory)
+        finally:
+            for conn in self._readers:
+                conn.close()
+            self._readers = []
+            self._local = threading.local()
+        self.dirs_listed = len(self._updates)
+        self.dirs_reused = len(self._visited) - self.dirs_listed
+        self._commit(root_dir)
+
+    def use_partial_bytes(self, partial_bytes: int) -> None:
+        """Drop cached partial hashes computed with a different partial size."""
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'partial_bytes'").fetchone()
+        if row is not None and int(row[0]) == partial_bytes:
+            return
+        with self._conn:
+            self._conn.execute("UPDATE files SET partial_hash = NULL")
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('partial_bytes', ?)",
+                               (str(partial_bytes),))
+
+    def get_hashes(self, paths: Iterable[str]) -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+        """
+        Return {path: (partial_hash, full_hash)} for paths with any cached hash.
+
+        Each path with cached hashes is stat'ed first: a file rewritten in place
+        leaves its directory's mtime alone, so a reused listing can be stale.
+        Where size, mtime or inode no longer match, the row is updated and its
+        hashes dropped.
+        """
+        cached = {}
+        stale = []
+        for path in paths:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, inode, partial_hash, full_hash FROM files WHERE dir = ? AND name = ?",
+                os.path.split(path)).fetchone()
+            if row is None or not (row[3] or row[4]):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            size, mtime_ns, inode = row[:3]
+            # DirEntry.stat() records inode 0 on Windows; only compare a known one
+            if st.st_size != size or st.st_mtime_ns != mtime_ns or (inode and st.st_ino != inode):
+                stale.append((st.st_size, st.st_mtime_ns, st.st_ino, *os.path.split(path)))
+            else:
+                cached[path] = row[3:]
+        if stale:
+            with self._conn:
+                self._conn.executemany(
+                    "UPDATE files SET size = ?, mtime_ns = ?, inode = ?, partial_hash = NULL, full_hash = NULL "
+                    "WHERE dir = ? AND name = ?", stale)
+        return cached
+
+    def store_hashes(self, partial: Dict[str, str], full: Dict[str, str]) -> None:
+        """Record newly computed partial and full hashes."""
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE files SET partial_hash = ? WHERE dir = ? AND name = ?",
+                ((digest, *os.path.split(path)) for path, digest in partial.items()))
+            self._conn.executemany(
+                "UPDATE files SET full_hash = ? WHERE dir = ? AND name = ?",
+                ((digest, *os.path.split(path)) for path, digest in full.items()))
+
+    def lookup(self, path: str) -> Optional[Tuple[int, int, Optional[str]]]:
+        """Return (size, mtime_ns, full_hash) recorded for a file, or None."""
+        return self._conn.execute(
+            "SELECT size, mtime_ns, full_hash FROM files WHERE dir = ? AND name = ?",
+            os.path.split(path)).fetchone()
+
+    def sizes_under(self, root_dir: str) -> set:
+        """Distinct sizes of the files recorded below root_dir."""
+        root_dir = os.path.abspath(root_dir)
+        low, high = root_dir + os.sep, root_dir + chr(ord(os.sep) + 1)
+        return {size for (size,) in self._conn.execute(
+            "SELECT DISTINCT size FROM files WHERE dir = ? OR (dir >= ? AND dir < ?)", (root_dir, low, high))}
+
+    def files_of_sizes(self, root_dir: str, sizes: Iterable[int]) -> Dict[int, List[Tuple[str, Optional[str]]]]:
+        """Return {size: [(path, full_hash)]} for the files of the given sizes recorded below root_dir."""
+        with self._conn:
+            self._conn.execute("CREATE INDEX IF NOT EXISTS files_size ON files (size)")
+        root_dir = os.path.abspath(root_dir)
+        low, high = root_dir + os.sep, root_dir + chr(ord(os.sep) + 1)
+        found = {}
+        for size in sizes:
+            found[size] = [(os.path.join(dirpath, name), full_hash) for dirpath, name, full_hash in self._conn.execute(
+                "SELECT dir, name, full_hash FROM files WHERE size = ? AND (dir = ? OR (dir >= ? AND dir < ?))",
+                (size, root_dir, low, high))]
+        return found
+
+
+def walk_tree(
+    root_dir: str,
+    workers: int = DEFAULT_WALK_THREADS,
+    index: Optional[ScanIndex] = None,
+    rules: Optional[ScanRules] = None,
+) -> Iterator[Tuple[str, List[Tuple[str, os.stat_result]]]]:
+    """
+    scan_tree, through a ScanIndex when one is given, with rules applied in the walker.
+
+    Args:
+        root_dir: Absolute directory path to scan
+        workers: Number of walker threads
+        index: Optional ScanIndex to rescan incrementally against
+        rules: Optional ScanRules to filter files and prune directories with
+    """
+    if index is not None:
+        return index.scan(root_dir, workers, rules)
+    lister = list_directory if rules is None else functools.partial(list_directory, rules=rules)
+    return scan_tree(root_dir, workers, lister)
+
+
+def _iter_files(
+    root_dir: str,
+    workers: int = DEFAULT_WALK_THREADS,
+    index: Optional[ScanIndex] = None,
+    rules: Optional[ScanRules] = None,
+) -> Iterator[Tuple[str, str, int]]:
+    """
+    Walk a directory tree and yield every file found.
+
+    Args:
+        root_dir: Absolute directory path to scan
+        workers: Number of walker threads
+        index: Optional ScanIndex to rescan incrementally against
+        rules: Optional ScanRules to filter files and prune directories with
+
+    Yields:
+        (dirpath, filename, size) for each file that could be stat'ed
+    """
+    for dirpath, files in walk_tree(root_dir, workers, index, rules):
+        for filename, st in files:
+            yield dirpath, filename, st.st_size
+
+
+class ScanStore:
+    """
+    Compact, interned record of every file seen by a name+size scan.
+
+    Directory paths and filenames are interned to integer IDs, and each file is
+    one row across array-backed columns (name ID, directory ID, size, and the
+    st_dev/st_ino that tell hardlinks of one file apart from copies). Rows with
+    the same filename are chained through a `next` column whose heads live in
+    another array indexed by name ID, so apart from the interned strings there
+    is no per-file or per-key Python object at all. Sizes are split out of each
+    name chain only when groups are read.
+    """
+
+    __slots__ = ("dirs", "names", "_dir_ids", "_name_ids",
+                 "name_col", "dir_col", "size_col", "dev_col", "ino_col", "next_col", "_heads")
+
+    def __init__(self):
+        self.dirs: List[str] = []
+        self.names: List[str] = []
+        self._dir_ids: Dict[str, int] = {}
+        self._name_ids: Dict[str, int] = {}
+        self.name_col = array('q')
+        self.dir_col = array('q')
+        self.size_col = array('q')
+        # st_ino 0 where the walk could not tell (see _file_id)
+        self.dev_col = array('Q')
+        self.ino_col = array('Q')
+        # Previous row with the same filename, or -1
+        self.next_col = array('q')
+        # Name ID -> most recent row with that filename
+        self._heads = array('q')
+
+    def __len__(self) -> int:
+        return len(self.size_col)
+
+    def add_directory(self, dirpath: str, files: Iterable[Tuple[str, os.stat_result]]) -> None:
+        """Record the (filename, stat) pairs found in one directory."""
+        dir_id = self._dir_ids.get(dirpath)
+        if dir_id is None:
+            dir_id = self._dir_ids[dirpath] = len(self.dirs)
+            self.dirs.append(dirpath)
+        name_ids = self._name_ids
+        heads = self._heads
+        for filename, st in files:
+            name_id = name_ids.get(filename)
+            if name_id is None:
+                name_id = name_ids[filename] = len(self.names)
+                self.names.append(filename)
+                heads.append(-1)
+            self.name_col.append(name_id)
+            self.dir_col.append(dir_id)
+            self.size_col.append(st.st_size)
+            self.dev_col.append(st.st_dev)
+            self.ino_col.append(st.st_ino)
+            self.next_col.append(heads[name_id])
+            heads[name_id] = len(self.size_col) - 1
+
+    def _name_groups(self, name_id: int) -> Dict[int, List[int]]:
+        """Split one filename's chain into {size: [row, ...]} in scan order."""
+        by_size: Dict[int, List[int]] = defaultdict(list)
+        row = self._heads[name_id]
+        while row != -1:
+            by_size[self.size_col[row]].append(row)
+            row = self.next_col[row]
+        for rows in by_size.values():
+            rows.reverse()
+        return by_size
+
+    def _dirs(self, rows: List[int]) -> List[str]:
+        return [self.dirs[self.dir_col[row]] for row in rows]
+
+    def _distinct_files(self, rows: List[int]) -> int:
+        """Number of distinct files among rows, counting hardlinks once."""
+        ids = [(self.dev_col[row], self.ino_col[row]) for row in rows]
+        unknown = sum(1 for _, ino in ids if not ino)
+        return len({file_id for file_id in ids if file_id[1]}) + unknown
+
+    def lookup(self, filename: str, size: int) -> List[str]:
+        """Directories holding `filename` with the given size (empty if none)."""
+        name_id = self._name_ids.get(filename)
+        if name_id is None:
+            return []
+        return self._dirs(self._name_groups(name_id).get(size, []))
+
+    def entries(self) -> Iterator[Tuple[Tuple[str, int], List[str], List[Optional[Tuple[int, int]]]]]:
+        """Yield ((filename, size), directories, file IDs) for every key, duplicated or not."""
+        for name_id in range(len(self.names)):
+            for size, rows in self._name_groups(name_id).items():
+                file_ids = [(self.dev_col[row], self.ino_col[row]) if self.ino_col[row] else None
+                            for row in rows]
+                yield (self.names[name_id], size), self._dirs(rows), file_ids
+
+    def groups(
+        self,
+        copies: Optional[Dict[Tuple[str, int], int]] = None,
+    ) -> Iterator[Tuple[Tuple[str, int], List[str]]]:
+        """
+        Yield ((filename, size), directories) for every duplicate set.
+
+        Args:
+            copies: Filled in with the number of distinct files behind each
+                yielded set, counting hardlinks of one file once
+        """
+        next_col = self.next_col
+        for name_id, head in enumerate(self._heads):
+            # A name seen once cannot be duplicated
+            if next_col[head] == -1:
+                continue
+            for size, rows in self._name_groups(name_id).items():
+                if len(rows) > 1:
+                    key = (self.names[name_id], size)
+                    if copies is not None:
+                        copies[key] = self._distinct_files(rows)
+                    yield key, self._dirs(rows)
+
+
+class DuplicateMapView(Mapping):
+    """
+    Read-only (filename, size) -> [dirpath] view of the duplicates in a ScanStore.
+
+    Directory lists are built on access, so the full dict never exists at once.
+    """
+
+    def __init__(self, store: ScanStore):
+        self._store = store
+        self._len: Optional[int] = None
+
+    def __getitem__(self, key: Tuple[str, int]) -> List[str]:
+        dirs = self._store.lookup(*key)
+        if len(dirs) < 2:
+            raise KeyError(key)
+        return dirs
+
+    def __iter__(self) -> Iterator[Tuple[str, int]]:
+        for key, _ in self._store.groups():
+            yield key
+
+    def __len__(self) -> int:
+        if self._len is None:
+            self._len = sum(1 for _ in self._store.groups())
+        return self._len
+
+    def items(self):
+        # Walk each chain once instead of once for the key and again for the value
+        return self._store.groups()
+
+
+def build_scan_store(
+    root_dir: str,
+    walk_threads: int = DEFAULT_WALK_THREADS,
+    index: Optional[ScanIndex] = None,
+    walk: Optional[Iterable[Tuple[str, List[Tuple[str, os.stat_result]]]]] = None,
+    rules: Optional[ScanRules] = None,
+) -> ScanStore:
+    """
+    Scan directory tree into a compact ScanStore.
+
+    Args:
+        root_dir: Starting directory path to scan
+        walk_threads: Number of threads walking the directory tree
+        index: Optional ScanIndex to rescan incrementally against
+        walk: Already-walked (dirpath, [(filename, stat)]) records to use
+            instead of walking root_dir, e.g. from scan_tree_async
+        rules: Optional ScanRules to filter files and prune directories with
+    """
+    store = ScanStore()
+    root_dir = os.path.abspath(root_dir)
+    if walk is None:
+        walk = walk_tree(root_dir, walk_threads, index, rules)
+    try:
+        for dirpath, files in walk:
+            # Store directory path once for all filename+size combinations in it
+            store.add_directory(dirpath, files)
+    except (OSError, PermissionError) as e:
+        _report_error(f"Error scanning directory {root_dir}: {e}")
+        return ScanStore()
+    return store
+
+
+def iter_duplicate_files(
+    root_dir: str,
+    walk_threads: int = DEFAULT_WALK_THREADS,
+    index: Optional[ScanIndex] = None,
+    walk: Optional[Iterable[Tuple[str, List[Tuple[str, os.stat_result]]]]] = None,
+    rules: Optional[ScanRules] = None,
+    copies: Optional[Dict[Tuple[str, int], int]] = None,
+) -> Iterator[Tuple[Tuple[str, int], List[str]]]:
+    """
+    Scan directory tree for files with matching names and sizes, yielding
+    each duplicate set.
+
+    A name+size set can gain members until the last directory is listed, so
+    sets are yielded once the walk finishes, without building a result dict.
+
+    Args:
+        root_dir: Starting directory path to scan
+        walk_threads: Number of threads walking the directory tree
+        index: Optional ScanIndex to rescan incrementally against
+        walk: Already-walked records to use instead of walking root_dir
+        rules: Optional ScanRules to filter files and prune directories with
+        copies: Filled in with the number of distinct files behind each
+            yielded set (hardlinks counted once), from the scan's stat results
+
+    Yields:
+        ((filename, size), list of directory paths)
+    """
+    store = build_scan_store(root_dir, walk_threads, index, walk, rules)
+    progress.phase("group")
+    # Filter out non-duplicates (files that only appear once)
+    yield from store.groups(copies)
+
+
+def find_duplicate_files(
+    root_dir: str,
+    walk_threads: int = DEFAULT_WALK_THREADS,
+    index: Optional[ScanIndex] = None,
+    rules: Optional[ScanRules] = None,
+) -> Mapping[Tuple[str, int], List[str]]:
+    """
+    Scan directory tree for files with matching names and sizes.
+
+    Args:
+        root_dir: Starting directory path to scan
+        walk_threads: Number of threads walking the directory tree
+        index: Optional ScanIndex to rescan incrementally against
+        rules: Optional ScanRules to filter files and prune directories with
+
+    Returns:
+        Read-only mapping of (filename, size) to list of directory paths,
+        backed by a compact ScanStore (see DuplicateMapView)
+    """
+    return DuplicateMapView(build_scan_store(root_dir, walk_threads, index, rules=rules))
+
+
+def find_duplicate_files_async(
+    root_dir: str,
+    concurrency: int = DEFAULT_ASYNC_CONCURRENCY,
+    timeout: Optional[float] = DEFAULT_OP_TIMEOUT,
+    fs: Optional[LocalFileSystem] = None,
+    rules: Optional[ScanRules] = None,
+) -> Mapping[Tuple[str, int], List[str]]:
+    """
+    find_duplicate_files for high-latency mounts, walking with scan_tree_async.
+
+    Args:
+        root_dir: Starting directory path to scan
+        concurrency: Maximum filesystem operations in flight
+        timeout: Seconds allowed per operation (None = no limit)
+        fs: Filesystem to scan through (default: LocalFileSystem)
+        rules: Optional ScanRules to filter files and prune directories with
+
+    Returns:
+        The same mapping find_duplicate_files returns
+    """
+    root_dir = os.path.abspath(root_dir)
+    walk = asyncio.run(scan_tree_async(root_dir, concurrency, timeout, fs, rules))
+    return DuplicateMapView(build_scan_store(root_dir, walk=walk))
+
+
+SHARD_FORMAT = "fdf-shard"
+SHARD_VERSION = 2
+# Version 1 shards carry no file IDs; every copy in them counts as a separate file
+SHARD_READ_VERSIONS = (1, 2)
+
+
+def write_shard(
+    shard_path: str,
+    root_dir: str,
+    walk_threads: int = DEFAULT_WALK_THREADS,
+    index: Optional[ScanIndex] = None,
+    hashes: bool = False,
+    workers: Optional[int] = None,
+    mmap_threshold: int = MMAP_THRESHOLD,
+    rules: Optional[ScanRules] = None,
+) -> Dict[str, object]:
+    """
+    Scan one subtree into a partial result that merge_shards can combine.
+
+    A shard is gzip-compressed JSON Lines: a metadata object, then the
+    interned directory table {"dirs": [...]}, then one [filename, size,
+    [dir index, ...], hashes, file IDs] array per (filename, size) key. The
+    full content hashes are null unless `hashes` is set; the file IDs are
+    [st_dev, st_ino] pairs (null where unknown) that let merge_shards count
+    hardlinks once. Both are parallel to the directories.
+    Every key is written, not only the ones duplicated within the shard,
+    since its other copies may be in another shard.
+
+    Args:
+        shard_path: File to write (replaced atomically)
+        root_dir: Subtree to scan
+        walk_threads: Number of threads walking the directory tree
+        index: Optional ScanIndex to rescan incrementally against
+        hashes: Also store a full content hash for every file
+        workers: Hashing processes (None = CPU count, 0 or 1 = in-process)
+        mmap_threshold: Size at which full hashing switches from readinto to mmap
+        rules: Optional ScanRules to filter files and prune directories with
+
+    Returns:
+        The shard's metadata
+    """
+    root_dir = os.path.abspath(root_dir)
+    store = build_scan_store(root_dir, walk_threads, index, rules=rules)
+
+    digests: Dict[str, Optional[str]] = {}
+    if hashes:
+        progress.phase("hash")
+        paths = [os.path.join(store.dirs[d], store.names[n]) for n, d in zip(store.name_col, store.dir_col)]
+        if workers is None:
+            workers = os.cpu_count() or 1
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        full_hash = functools.partial(_hash_full, mmap_threshold=mmap_threshold)
+        try:
+            for path, digest, bytes_read in _map_jobs(full_hash, paths, executor, workers):
+                progress.hashed(bytes_read)
+                if digest is None:
+                    progress.error()
+                digests[path] = digest
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    progress.phase("write")
+    dir_ids = {dirpath: i for i, dirpath in enumerate(store.dirs)}
+    metadata = {
+        "format": SHARD_FORMAT,
+        "version": SHARD_VERSION,
+        "root": root_dir,
+        "host": socket.gethostname(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "files": len(store),
+        "directories": len(store.dirs),
+        "hashes": "blake2b-160" if hashes else None,
+    }
+    tmp_path = shard_path + ".tmp"
+    with gzip.open(tmp_path, 'wt', encoding="utf-8") as f:
+        f.write(json.dumps(metadata) + "\n")
+        f.write(json.dumps({"dirs": store.dirs}) + "\n")
+        for (filename, size), dirs, file_ids in store.entries():
+            record = [filename, size, [dir_ids[d] for d in dirs],
+                      [digests.get(os.path.join(d, filename)) for d in dirs] if hashes else None,
+                      file_ids]
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+    os.replace(tmp_path, shard_path)
+    return metadata
+
+
+def iter_shard(shard_path: str) -> Tuple[Dict[str, object], Iterator[Tuple[
+        str, int, List[str], Optional[List[Optional[str]]], Optional[List[Optional[List[int]]]]]]]:
+    """
+    Open a shard written by write_shard.
+
+    Returns:
+        Tuple of:
+          - The shard's metadata
+          - Iterator of (filename, size, directories, hashes or None,
+            [st_dev, st_ino] file IDs or None) per key
+
+    Raises:
+        ValueError: If the file is not a shard of a supported version
+    """
+    f = gzip.open(shard_path, 'rt', encoding="utf-8")
+    try:
+        metadata = json.loads(f.readline())
+        if not isinstance(metadata, dict) or metadata.get("format") != SHARD_FORMAT:
+            raise ValueError(f"{shard_path} is not a duplicate-scan shard")
+        if metadata.get("version") not in SHARD_READ_VERSIONS:
+            raise ValueError(f"{shard_path} has unsupported shard version {metadata.get('version')}")
+        dirs = json.loads(f.readline())["dirs"]
+    except (OSError, ValueError, KeyError):
+        f.close()
+        raise
+
+    def records():
+        with f:
+            for line in f:
+                record = json.loads(line)
+                yield (record[0], record[1], [dirs[i] for i in record[2]],
+                       record[3] if len(record) > 3 else None, record[4] if len(record) > 4 else None)
+
+    return metadata, records()
+
+
+def merge_shards(
+    shard_paths: List[str],
+    copies: Optional[Dict[Tuple[str, int], int]] = None,
+) -> Tuple[Dict[Tuple[str, int], List[str]], List[Dict[str, object]]]:
+    """
+    Combine shards into the (filename, size) -> directories map of find_duplicate_files.
+
+    Where every copy of a key carries a content hash, copies whose hash no
+    other copy shares are dropped, so same-name files with different contents
+    are not reported. A directory found in several (overlapping) shards is
+    counted once.
+
+    Args:
+        shard_paths: Files written by write_shard
+        copies: Filled in with the number of distinct files behind each
+            returned set, counting hardlinks once by the file IDs each shard
+            recorded on its own host
+
+    Returns:
+        Tuple of:
+          - Dictionary mapping (filename, size) to list of directory paths
+          - Metadata of each shard, in argument order
+    """
+    # (filename, size) -> {dirpath: (digest, file ID)}
+    merged: Dict[Tuple[str, int], Dict[str, Tuple[Optional[str], Optional[Tuple]]]] = defaultdict(dict)
+    metadatas = []
+    for shard_path in shard_paths:
+        metadata, records = iter_shard(shard_path)
+        for other in metadatas:
+            a, b = other["root"], metadata["root"]
+            if os.path.commonpath([a, b]) in (a, b):
+                print(f"Warning: shard roots overlap: {a} and {b}", file=sys.stderr)
+        metadatas.append(metadata)
+        # Device and inode numbers only mean something on the host that recorded them
+        host = metadata["host"]
+        for filename, size, dirs, digests, file_ids in records:
+            entry = merged[(filename, size)]
+            for i, dirpath in enumerate(dirs):
+                file_id = (host, *file_ids[i]) if file_ids is not None and file_ids[i] is not None else None
+                entry[dirpath] = (digests[i] if digests is not None else None, file_id)
+
+    duplicates: Dict[Tuple[str, int], List[str]] = {}
+    for key, entry in merged.items():
+        if len(entry) < 2:
+            continue
+        digests = [digest for digest, _ in entry.values()]
+        if all(digest is not None for digest in digests):
+            counts: Dict[str, int] = defaultdict(int)
+            for digest in digests:
+                counts[digest] += 1
+            dirs = [dirpath for dirpath, (digest, _) in entry.items() if counts[digest] > 1]
+        else:
+            dirs = list(entry)
+        if len(dirs) > 1:
+            duplicates[key] = dirs
+            if copies is not None:
+                file_ids = [entry[dirpath][1] for dirpath in dirs]
+                copies[key] = (len({file_id for file_id in file_ids if file_id is not None})
+                               + file_ids.count(None))
+    return duplicates, metadatas
+
+
+class ExternalGrouper:
+    """
+    Group (key, value) records that do not fit in memory, by external merge sort.
+
+    Records are buffered until their estimated size reaches `memory_budget`
+    bytes, then sorted and written to a run file in `tmp_dir`. Reading the
+    groups k-way merges the runs (in several passes if there are more than
+    MERGE_FAN_IN of them), so only one record per run is held at a time.
+    """
+
+    # Most run files merged at once (bounded by open file handles)
+    MERGE_FAN_IN = 64
+    # Rough per-record overhead of the in-memory buffer, on top of the strings
+    RECORD_OVERHEAD = 120
+
+    def __init__(self, memory_budget: int, tmp_dir: Optional[str] = None):
+        self.memory_budget = memory_budget
+        self._tmp = tempfile.TemporaryDirectory(prefix="fdf_runs_", dir=tmp_dir)
+        # (name, size, value, st_dev, st_ino); st_ino 0 where the file ID is unknown
+        self._buffer: List[Tuple[str, int, str, int, int]] = []
+        self._buffered_bytes = 0
+        self._runs: List[str] = []
+        self._run_counter = itertools.count()
+
+    def add(self, name: str, size: int, value: str, file_id: Optional[Tuple[int, int]] = None) -> None:
+        self._buffer.append((name, size, value, *(file_id or (0, 0))))
+        self._buffered_bytes += len(name) + len(value) + self.RECORD_OVERHEAD
+        if self._buffered_bytes >= self.memory_budget:
+            self._spill()
+
+    def _new_run_path(self) -> str:
+        return os.path.join(self._tmp.name, f"run_{next(self._run_counter):06d}.jsonl")
+
+    def _spill(self) -> None:
+        """Sort the buffer and write it out as one run."""
+        if not self._buffer:
+            return
+        self._buffer.sort()
+        path = self._new_run_path()
+        with open(path, 'w', encoding='utf-8') as f:
+            for record in self._buffer:
+                f.write(json.dumps(record) + "\n")
+        self._runs.append(path)
+        self._buffer = []
+        self._buffered_bytes = 0
+
+    @staticmethod
+    def _read_run(path: str) -> Iterator[Tuple[str, int, str, int, int]]:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                yield tuple(json.loads(line))
+
+    def _merge_runs(self, paths: List[str]) -> Iterator[Tuple[str, int, str, int, int]]:
+        return heapq.merge(*(self._read_run(path) for path in paths))
+
+    def groups(
+        self,
+        copies: Optional[Dict[Tuple[str, int], int]] = None,
+    ) -> Iterator[Tuple[Tuple[str, int], List[str]]]:
+        """
+        Yield ((name, size), sorted values) for keys seen more than once, then clean up.
+
+        Args:
+            copies: Filled in with the number of distinct file IDs behind each
+                yielded key (records without one each count separately)
+        """
+        try:
+            self._spill()
+            # Merge down until one pass can read every run
+            while len(self._runs) > self.MERGE_FAN_IN:
+                batches = [self._runs[i:i + self.MERGE_FAN_IN]
+                           for i in range(0, len(self._runs), self.MERGE_FAN_IN)]
+                self._runs = []
+                for batch in batches:
+                    path = self._new_run_path()
+                    with open(path, 'w', encoding='utf-8') as f:
+                        for record in self._merge_runs(batch):
+                            f.write(json.dumps(record) + "\n")
+                    for old in batch:
+                        os.remove(old)
+                    self._runs.append(path)
+
+            records = self._merge_runs(self._runs)
+            for (name, size), group in itertools.groupby(records, key=lambda r: (r[0], r[1])):
+                group = list(group)
+                if len(group) > 1:
+                    if copies is not None:
+                        file_ids = {(dev, ino) for _, _, _, dev, ino in group if ino}
+                        copies[(name, size)] = len(file_ids) + sum(1 for record in group if not record[4])
+                    yield (name, size), [value for _, _, value, _, _ in group]
+        finally:
+            self._tmp.cleanup()
+
+
+def iter_duplicate_files_external(
+    root_dir: str,
+    memory_budget: int,
+    walk_threads: int = DEFAULT_WALK_THREADS,
+    index: Optional[ScanIndex] = None,
+    tmp_dir: Optional[str] = None,
+    rules: Optional[ScanRules] = None,
+    copies: Optional[Dict[Tuple[str, int], int]] = None,
+) -> Iterator[Tuple[Tuple[str, int], List[str]]]:
+    """
+    Out-of-core counterpart of iter_duplicate_files for trees whose file
+    records exceed RAM.
+
+    Yields the same sets as iter_duplicate_files (directories sorted), while
+    keeping roughly `memory_budget` bytes of records in memory.
+
+    Args:
+        root_dir: Starting directory path to scan
+        memory_budget: Approximate bytes of records held before spilling a sorted run
+        walk_threads: Number of threads walking the directory tree
+        index: Optional ScanIndex to rescan incrementally against
+        tmp_dir: Where run files are written (default: system temp directory)
+        rules: Optional ScanRules to filter files and prune directories with
+        copies: Filled in with the number of distinct files behind each
+            yielded set (hardlinks counted once), as for iter_duplicate_files
+
+    Yields:
+        ((filename, size), sorted list of directory paths)
+    """
+    grouper = ExternalGrouper(memory_budget, tmp_dir)
+    root_dir = os.path.abspath(root_dir)
+    try:
+        for dirpath, files in walk_tree(root_dir, walk_threads, index, rules):
+            for filename, st in files:
+                grouper.add(filename, st.st_size, dirpath, _file_id(st))
+    except (OSError, PermissionError) as e:
+        _report_error(f"Error scanning directory {root_dir}: {e}")
+        return
+    progress.phase("merge")
+    yield from grouper.groups(copies)
+
+
+# Reusable read buffers, allocated once per thread (see _read_buffer)
+_buffers = threading.local()
+
+
+def _read_buffer() -> memoryview:
+    """Return this thread's preallocated HASH_CHUNK_BYTES read buffer.
+
+    Per thread, not per process: hashing also runs on thread pools (the
+    approximate and async scans), where a shared buffer would be overwritten
+    by concurrent readinto() calls.
+    """
+    buf = getattr(_buffers, "buffer", None)
+    if buf is None:
+        buf = _buffers.buffer = memoryview(bytearray(HASH_CHUNK_BYTES))
+    return buf
+
+
+def _new_hasher():
+    return hashlib.blake2b(digest_size=20)
+
+
+def _advise_sequential(fd: int) -> None:
+    """Tell the kernel we will read the file front to back, where supported."""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+
+def _hash_fileobj_readinto(f, hasher) -> int:
+    """Feed a file to `hasher` through the reusable buffer; return bytes read."""
+    buf = _read_buffer()
+    total = 0
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            return total
+        hasher.update(buf[:n])
+        total += n
+
+
+def _hash_fileobj_mmap(f, hasher) -> int:
+    """Feed a file to `hasher` straight from a read-only mapping; return bytes read."""
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with memoryview(mm) as view:
+            for offset in range(0, len(view), HASH_CHUNK_BYTES):
+                hasher.update(view[offset:offset + HASH_CHUNK_BYTES])
+            return len(view)
+
+
+def _hash_fileobj_read(f, hasher) -> int:
+    """Feed a file to `hasher` with plain read() calls (benchmark baseline)."""
+    total = 0
+    while True:
+        chunk = f.read(HASH_CHUNK_BYTES)
+        if not chunk:
+            return total
+        hasher.update(chunk)
+        total += len(chunk)
+
+
+HASH_STRATEGIES = {
+    "readinto": _hash_fileobj_readinto,
+    "mmap": _hash_fileobj_mmap,
+    "read": _hash_fileobj_read,
+}
+
+
+def hash_file(
+    filepath: str,
+    mmap_threshold: int = MMAP_THRESHOLD,
+    fadvise: bool = True,
+    strategy: Optional[str] = None,
+) -> Tuple[Optional[str], int]:
+    """
+    Hash the complete contents of a file without allocating per chunk.
+
+    Files of at least `mmap_threshold` bytes are hashed through mmap; smaller
+    ones are read with readinto() into a buffer reused across calls.
+
+    Args:
+        filepath: File to hash
+        mmap_threshold: Size at which hashing switches from readinto to mmap
+        fadvise: Give the kernel a sequential-access hint (posix_fadvise)
+        strategy: Force one of HASH_STRATEGIES instead of choosing by size
+
+    Returns:
+        (hex digest or None on error, bytes read)
+    """
+    hasher = _new_hasher()
+    bytes_read = 0
+    try:
+        with open(filepath, 'rb', buffering=0) as f:
+            if fadvise:
+                _advise_sequential(f.fileno())
+            if strategy is None:
+                size = os.fstat(f.fileno()).st_size
+                # mmap cannot map an empty file
+                strategy = "mmap" if size and size >= mmap_threshold else "readinto"
+            bytes_read = HASH_STRATEGIES[strategy](f, hasher)
+    except (OSError, PermissionError, ValueError) as e:
+        _report_error(f"Error reading {filepath}: {e}", count=False)
+        return None, bytes_read
+    return hasher.hexdigest(), bytes_read
+
+
+def _hash_partial(job: Tuple[str, int, int]) -> Tuple[str, Optional[str], int]:
+    """
+    Hash the first and last `nbytes` of a file.
+
+    Files no larger than 2 * nbytes are read completely, so their partial
+    digest is also their full-content digest.
+
+    Args:
+        job: (filepath, size, nbytes) tuple (single argument for Executor.map)
+
+    Returns:
+        (filepath, hex digest or None on error, bytes read)
+    """
+    filepath, size, nbytes = job
+    hasher = _new_hasher()
+    buf = _read_buffer()
+    bytes_read = 0
+    try:
+        with open(filepath, 'rb', buffering=0) as f:
+            if size <= 2 * nbytes:
+                bytes_read = _hash_fileobj_readinto(f, hasher)
+                return filepath, hasher.hexdigest(), bytes_read
+            head = buf[:nbytes] if nbytes <= len(buf) else memoryview(bytearray(nbytes))
+            n = f.readinto(head)
+            hasher.update(head[:n])
+            bytes_read += n
+            f.seek(size - len(head))
+            n = f.readinto(head)
+            hasher.update(head[:n])
+            bytes_read += n
+    except (OSError, PermissionError) as e:
+        _report_error(f"Error reading {filepath}: {e}", count=False)
+        return filepath, None, 0
+    return filepath, hasher.hexdigest(), bytes_read
+
+
+def _hash_full(filepath: str, mmap_threshold: int = MMAP_THRESHOLD) -> Tuple[str, Optional[str], int]:
+    """
+    Hash the complete contents of a file (Executor.map wrapper for hash_file).
+
+    Returns:
+        (filepath, hex digest or None on error, bytes read)
+    """
+    digest, bytes_read = hash_file(filepath, mmap_threshold)
+    return filepath, digest, bytes_read
+
+
+def _map_jobs(func, jobs: List, executor: Optional[ProcessPoolExecutor], workers: int) -> Iterable:
+    """Run `func` over `jobs`, on the process pool when one is available."""
+    if executor is None:
+        return map(func, jobs)
+    # Batch jobs so small files don't pay one IPC round trip each
+    chunksize = max(1, len(jobs) // (workers * 4))
+    return executor.map(func, jobs, chunksize=chunksize)
+
+
+def new_content_stats() -> Dict[str, Dict[str, int]]:
+    """Empty per-stage statistics for the content scan."""
+    return {stage: {"candidates": 0, "cached": 0, "bytes_read": 0, "bytes_skipped": 0}
+            for stage in CONTENT_STAGES}
+
+
+def _fold_links(files: List[Tuple[str, Optional[Tuple[int, int]]]], links: Dict[str, List[str]]) -> List[str]:
+    """
+    Collapse paths that are hardlinks of the same file into one representative.
+
+    Args:
+        files: (path, file id) pairs, as from _file_id
+        links: Updated in place with representative path -> its other links
+
+    Returns:
+        One path per distinct file, the first in sort order standing for its links
+    """
+    first: Dict[Tuple[int, int], str] = {}
+    paths = []
+    for path, file_id in sorted(files):
+        if file_id is None:
+            # DirEntry.stat() leaves st_ino at 0 on Windows; a full stat fills it in
+            try:
+                file_id = _file_id(os.stat(path))
+            except OSError:
+                file_id = None
+        if file_id is None:
+            paths.append(path)
+            continue
+        representative = first.setdefault(file_id, path)
+        if representative == path:
+            paths.append(path)
+        else:
+            links.setdefault(representative, []).append(path)
+    return paths
+
+
+def iter_content_duplicates(
+    root_dir: str,
+    workers: Optional[int] = None,
+    partial_bytes: int = PARTIAL_HASH_BYTES,
+    walk_threads: int = DEFAULT_WALK_THREADS,
+    index: Optional[ScanIndex] = None,
+    mmap_threshold: int = MMAP_THRESHOLD,
+    stats: Optional[Dict[str, Dict[str, int]]] = None,
+    walk: Optional[Iterable[Tuple[str, List[Tuple[str, os.stat_result]]]]] = None,
+    links: Optional[Dict[str, List[str]]] = None,
+    rules: Optional[ScanRules] = None,
+) -> Iterator[Tuple[Tuple[str, int], List[str]]]:
+    """
+    Scan directory tree for files with identical contents, yielding each
+    duplicate set as soon as it is confirmed.
+
+    Runs in three stages, each only looking at the survivors of the previous one:
+      1. size:    group by file size; files with a unique size are dropped unread
+      2. partial: hash the first and last `partial_bytes` of each candidate
+      3. full:    hash the complete file to confirm the match
+
+    Candidates are processed one size at a time, so a set is yielded once every
+    file of its size has been hashed, not after the whole tree is done.
+
+    Paths that are hardlinks of one file (same st_dev and st_ino) are folded
+    together before hashing: only the first in sort order is hashed and
+    reported, and a set needs at least two distinct files.
+
+    Args:
+        root_dir: Starting directory path to scan
+        workers: Number of hashing processes (None = CPU count, 0 or 1 = in-process)
+        partial_bytes: Bytes read from each end of a file in the partial stage
+        walk_threads: Number of threads walking the directory tree
+        index: Optional ScanIndex to rescan incrementally against; hashes of
+            unchanged files are taken from it instead of being recomputed
+        mmap_threshold: Size at which full hashing switches from readinto to mmap
+        stats: Optional dict (see new_content_stats) updated in place with
+            per-stage candidates, cached hashes, bytes read and bytes skipped
+        walk: Already-walked (dirpath, [(filename, stat)]) records to use
+            instead of walking root_dir (the index then only supplies hashes)
+        links: Optional dict updated in place with reported path -> the other
+            hardlinks of the same file
+        rules: Optional ScanRules to filter files and prune directories with
+
+    Yields:
+        ((content digest, size), sorted list of file paths, one per distinct file)
+    """
+    root_dir = os.path.abspath(root_dir)
+    if stats is None:
+        stats = new_content_stats()
+    if links is None:
+        links = {}
+
+    # Stage 1: group by size only
+    size_map: Dict[int, List[Tuple[str, Optional[Tuple[int, int]]]]] = defaultdict(list)
+    try:
+        if walk is None:
+            walk = walk_tree(root_dir, walk_threads, index, rules)
+        for dirpath, files in walk:
+            for filename, st in files:
+                size_map[st.st_size].append((os.path.join(dirpath, filename), _file_id(st)))
+    except (OSError, PermissionError) as e:
+        _report_error(f"Error scanning directory {root_dir}: {e}")
+        return
+
+    candidates: Dict[int, List[str]] = {}
+    for size, files in size_map.items():
+        stats["size"]["candidates"] += len(files)
+        paths = _fold_links(files, links) if len(files) > 1 else [files[0][0]]
+        if len(paths) > 1:
+            candidates[size] = paths
+        else:
+            stats["size"]["bytes_skipped"] += size
+    del size_map
+    progress.phase("hash")
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    full_hash = functools.partial(_hash_full, mmap_threshold=mmap_threshold)
+
+    cached: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+    if index is not None:
+        index.use_partial_bytes(partial_bytes)
+        cached = index.get_hashes(path for paths in candidates.values() for path in paths)
+    new_partial: Dict[str, str] = {}
+    new_full: Dict[str, str] = {}
+
+    # size -> partial digest -> paths, filled until every file of that size is hashed
+    partial_groups: Dict[int, Dict[str, List[str]]] = defaultdict(lambda: defaultdict(list))
+    partial_read: Dict[str, int] = {}
+    # Sizes whose full hashes are still running: (size, full digest -> paths, futures)
+    pending_full: List[Tuple[int, Dict[str, List[str]], List[Future]]] = []
+
+    def record_full(size: int, groups: Dict[str, List[str]], result: Tuple[str, Optional[str], int]) -> None:
+        path, digest, bytes_read = result
+        stats["full"]["bytes_read"] += bytes_read
+        progress.hashed(bytes_read)
+        if digest is None:
+            progress.error()
+        else:
+            new_full[path] = digest
+            groups[digest].append(path)
+
+    def confirmed(size: int, groups: Dict[str, List[str]]) -> Iterator[Tuple[Tuple[str, int], List[str]]]:
+        for digest, paths in groups.items():
+            if len(paths) > 1:
+                yield (digest, size), sorted(paths)
+
+    def finish_partial(size: int) -> Iterator[Tuple[Tuple[str, int], List[str]]]:
+        """Stage 3 for one size once all of its partial hashes are known."""
+        full_groups: Dict[str, List[str]] = defaultdict(list)
+        futures = []
+        for digest, paths in partial_groups.pop(size, {}).items():
+            if len(paths) < 2:
+                stats["partial"]["bytes_skipped"] += size - partial_read[paths[0]]
+            elif size <= 2 * partial_bytes:
+                # The partial stage already read these files completely
+                yield (digest, size), sorted(paths)
+            else:
+                stats["full"]["candidates"] += len(paths)
+                for path in paths:
+                    full_digest = cached.get(path, (None, None))[1]
+                    if full_digest is not None:
+                        stats["full"]["cached"] += 1
+                        full_groups[full_digest].append(path)
+                    elif executor is None:
+                        record_full(size, full_groups, full_hash(path))
+                    else:
+                        futures.append(executor.submit(full_hash, path))
+        if futures:
+            pending_full.append((size, full_groups, futures))
+        else:
+            yield from confirmed(size, full_groups)
+
+    def drain_full(block: bool) -> Iterator[Tuple[Tuple[str, int], List[str]]]:
+        """Yield sets whose full hashes have all finished."""
+        while pending_full:
+            size, full_groups, futures = pending_full[0]
+            if block:
+                wait(futures)
+            elif not all(f.done() for f in futures):
+                return
+            pending_full.pop(0)
+            for future in futures:
+                record_full(size, full_groups, future.result())
+            yield from confirmed(size, full_groups)
+
+    try:
+        # Stage 2: partial hash of each end of the file, one size after another
+        remaining: Dict[int, int] = {}
+        jobs = []
+        for size, paths in candidates.items():
+            stats["partial"]["candidates"] += len(paths)
+            remaining[size] = 0
+            for path in paths:
+                digest = cached.get(path, (None, None))[0]
+                if digest is None:
+                    jobs.append((path, size, partial_bytes))
+                    remaining[size] += 1
+                else:
+                    stats["partial"]["cached"] += 1
+                    partial_read[path] = 0
+                    partial_groups[size][digest].append(path)
+        del candidates
+
+        # Sizes answered entirely from the index need no hashing at all
+        for size in [size for size, count in remaining.items() if count == 0]:
+            yield from finish_partial(size)
+
+        # map() returns results in job order, so each size completes in turn
+        results = _map_jobs(_hash_partial, jobs, executor, workers)
+        for (_, size, _), (path, digest, bytes_read) in zip(jobs, results):
+            stats["partial"]["bytes_read"] += bytes_read
+            progress.hashed(bytes_read)
+            partial_read[path] = bytes_read
+            if digest is None:
+                progress.error()
+            else:
+                new_partial[path] = digest
+                partial_groups[size][digest].append(path)
+            remaining[size] -= 1
+            if remaining[size] == 0:
+                yield from finish_partial(size)
+                yield from drain_full(block=False)
+
+        yield from drain_full(block=True)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if index is not None:
+            index.store_hashes(new_partial, new_full)
+
+
+def find_content_duplicates(
+    root_dir: str,
+    workers: Optional[int] = None,
+    partial_bytes: int = PARTIAL_HASH_BYTES,
+    walk_threads: int = DEFAULT_WALK_THREADS,
+    index: Optional[ScanIndex] = None,
+    mmap_threshold: int = MMAP_THRESHOLD,
+    links: Optional[Dict[str, List[str]]] = None,
+    rules: Optional[ScanRules] = None,
+) -> Tuple[Dict[Tuple[str, int], List[str]], Dict[str, Dict[str, int]]]:
+    """
+    Scan directory tree for files with identical contents.
+
+    Collects iter_content_duplicates into a dictionary; see it for the stages,
+    hardlink folding and arguments.
+
+    Returns:
+        Tuple of:
+          - Dictionary mapping (content digest, size) to list of file paths
+          - Per-stage statistics: {stage: {"candidates", "cached", "bytes_read", "bytes_skipped"}}
+    """
+    stats = new_content_stats()
+    duplicates = dict(iter_content_duplicates(
+        root_dir, workers, partial_bytes, walk_threads, index, mmap_threshold, stats, links=links, rules=rules))
+    return duplicates, stats
+
+
+def _run_git(root_dir: str, *args: str) -> Optional[bytes]:
+    """Run a git command in root_dir and return its stdout, or None if git fails or is missing."""
+    try:
+        return subprocess.run(["git", *args], cwd=root_dir, capture_output=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def git_blob_ids(root_dir: str) -> Optional[Tuple[Dict[str, str], str]]:
+    """
+    Read the object IDs of the clean tracked files under root_dir from git in bulk.
+
+    `git ls-files -s -z` lists the index entry of every tracked file, and
+    `git status --porcelain=v2 -z` names those whose work tree copy differs from
+    the index (status also refreshes stale index stat data, so its answer is
+    content-accurate). Only regular files at stage 0 whose work tree matches the
+    index are returned; symlinks, submodules and unmerged paths are left out.
+
+    Args:
+        root_dir: Directory inside a git work tree
+
+    Returns:
+        ({absolute path: object id}, object format, "sha1" or "sha256"),
+        or None if root_dir is not inside a git work tree
+    """
+    root_dir = os.path.abspath(root_dir)
+    prefix = _run_git(root_dir, "rev-parse", "--show-prefix")
+    listing = _run_git(root_dir, "ls-files", "-s", "-z", "--", ".")
+    status = _run_git(root_dir, "status", "--porcelain=v2", "-z", "--untracked-files=no",
+                      "--ignore-submodules=all", "--", ".")
+    if prefix is None or listing is None or status is None:
+        return None
+    # Older gits lack --show-object-format; they only support SHA-1
+    object_format = (_run_git(root_dir, "rev-parse", "--show-object-format") or b"sha1").strip().decode()
+
+    # Status paths are relative to the top level; ls-files paths to root_dir
+    prefix = prefix.strip()
+    dirty = set()
+    records = iter(status.split(b"\0"))
+    for record in records:
+        kind = record[:1]
+        if kind == b"1":
+            fields = record.split(b" ", 8)
+        elif kind == b"2":
+            fields = record.split(b" ", 9)
+            next(records, None)  # the rename or copy source
+        elif kind == b"u":
+            dirty.add(record.split(b" ", 10)[-1])
+            continue
+        else:
+            continue
+        # Y is the work tree against the index; a staged-only change leaves the index blob accurate
+        if fields[1][1:2] != b".":
+            dirty.add(fields[-1])
+
+    blob_ids = {}
+    for record in listing.split(b"\0"):
+        if not record:
+            continue
+        info, path = record.split(b"\t", 1)
+        mode, oid, stage = info.split(b" ")
+        if mode not in (b"100644", b"100755") or stage != b"0" or prefix + path in dirty:
+            continue
+        blob_ids[os.path.normpath(os.path.join(root_dir, os.fsdecode(path)))] = oid.decode()
+    return blob_ids, object_format
+
+
+def _hash_git_blob(job: Tuple[str, str]) -> Tuple[str, Optional[str], int]:
+    """
+    Hash a file the way `git hash-object` does, so digests compare with index object IDs.
+
+    Args:
+        job: (filepath, object format) tuple (single argument for Executor.map)
+
+    Returns:
+        (filepath, hex object id or None on error, bytes read)
+    """
+    filepath, object_format = job
+    hasher = hashlib.new(object_format)
+    try:
+        with open(filepath, 'rb', buffering=0) as f:
+            _advise_sequential(f.fileno())
+            hasher.update(b"blob %d\0" % os.fstat(f.fileno()).st_size)
+            bytes_read = _hash_fileobj_readinto(f, hasher)
+    except (OSError, PermissionError) as e:
+        _report_error(f"Error reading {filepath}: {e}", count=False)
+        return filepath, None, 0
+    return filepath, hasher.hexdigest(), bytes_read
+
+
+def iter_git_content_duplicates(
+    root_dir: str,
+    blob_ids: Optional[Tuple[Dict[str, str], str]] = None,
+    workers: Optional[int] = None,
+    walk_threads: int = DEFAULT_WALK_THREADS,
+    index: Optional[ScanIndex] = None,
+    stats: Optional[Dict[str, Dict[str, int]]] = None,
+    walk: Optional[Iterable[Tuple[str, List[Tuple[str, os.stat_result]]]]] = None,
+    links: Optional[Dict[str, List[str]]] = None,
+    rules: Optional[ScanRules] = None,
+) -> Iterator[Tuple[Tuple[str, int], List[str]]]:
+    """
+    Scan a git work tree for files with identical contents, keyed by git object ID.
+
+    Files are grouped by size as in iter_content_duplicates. Clean tracked files
+    then take their object ID from the index without being read; modified and
+    untracked files are hashed with git's blob hash so both kinds of key compare.
+    Sets are yielded once every candidate has been keyed.
+
+    Files stored through clean filters (text=auto line endings, Git LFS) have
+    index objects that differ from their work tree bytes, so they may be missed
+    as duplicates of untracked copies, but are never falsely matched.
+
+    Args:
+        root_dir: Starting directory path to scan, inside a git work tree
+        blob_ids: Result of git_blob_ids(root_dir), if already read
+        workers: Number of hashing processes (None = CPU count, 0 or 1 = in-process)
+        walk_threads: Number of threads walking the directory tree
+        index: Optional ScanIndex to rescan incrementally against
+        stats: Optional dict (see new_content_stats) updated in place; object IDs
+            taken from git count as cached full hashes
+        walk: Already-walked (dirpath, [(filename, stat)]) records to use
+            instead of walking root_dir
+        links: Optional dict updated in place with reported path -> the other
+            hardlinks of the same file
+        rules: Optional ScanRules to filter files and prune directories with
+
+    Yields:
+        ((git object id, size), sorted list of file paths, one per distinct file)
+
+    Raises:
+        RuntimeError: If root_dir is not inside a git work tree
+    """
+    root_dir = os.path.abspath(root_dir)
+    if blob_ids is None:
+        blob_ids = git_blob_ids(root_dir)
+        if blob_ids is None:
+            raise RuntimeError(f"{root_dir} is not inside a git work tree")
+    known, object_format = blob_ids
+    if stats is None:
+        stats = new_content_stats()
+    if links is None:
+        links = {}
+
+    size_map: Dict[int, List[Tuple[str, Optional[Tuple[int, int]]]]] = defaultdict(list)
+    try:
+        if walk is None:
+            walk = walk_tree(root_dir, walk_threads, index, rules)
+        for dirpath, files in walk:
+            for filename, st in files:
+                size_map[st.st_size].append((os.path.join(dirpath, filename), _file_id(st)))
+    except (OSError, PermissionError) as e:
+        _report_error(f"Error scanning directory {root_dir}: {e}")
+        return
+
+    groups: Dict[Tuple[str, int], List[str]] = defaultdict(list)
+    jobs = []
+    sizes: Dict[str, int] = {}
+    for size, files in size_map.items():
+        stats["size"]["candidates"] += len(files)
+        paths = _fold_links(files, links) if len(files) > 1 else [files[0][0]]
+        if len(paths) < 2:
+            stats["size"]["bytes_skipped"] += size
+            continue
+        stats["full"]["candidates"] += len(paths)
+        for path in paths:
+            oid = known.get(path)
+            if oid is None:
+                jobs.append((path, object_format))
+                sizes[path] = size
+            else:
+                stats["full"]["cached"] += 1
+                stats["full"]["bytes_skipped"] += size
+                groups[oid, size].append(path)
+    del size_map
+    progress.phase("hash")
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 and len(jobs) > 1 else None
+    try:
+        for path, digest, bytes_read in _map_jobs(_hash_git_blob, jobs, executor, workers):
+            stats["full"]["bytes_read"] += bytes_read
+            progress.hashed(bytes_read)
+            if digest is None:
+                progress.error()
+            else:
+                groups[digest, sizes[path]].append(path)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    for key, paths in groups.items():
+        if len(paths) > 1:
+            yield key, sorted(paths)
+
+
+class DirectoryDuplicate(NamedTuple):
+    """A set of directories whose whole subtrees are identical."""
+    digest: str
+    size: int
+    file_count: int
+    directories: List[str]
+
+
+def find_duplicate_directories(
+    root_dir: str,
+    walk_threads: int = DEFAULT_WALK_THREADS,
+    index: Optional[ScanIndex] = None,
+    content: bool = False,
+    workers: Optional[int] = None,
+    partial_bytes: int = PARTIAL_HASH_BYTES,
+    mmap_threshold: int = MMAP_THRESHOLD,
+    rules: Optional[ScanRules] = None,
+) -> List[DirectoryDuplicate]:
+    """
+    Find whole directories that are copies of each other, via Merkle hashing.
+
+    Each directory's hash is computed bottom-up from its files' (name, size
+    [, content hash]) and its subdirectories' (name, hash), so two directories
+    match exactly when their entire subtrees do. Directories without files
+    anywhere below them are ignored.
+
+    Only matches not already implied by a larger one are reported. While
+    hashing a parent, each child records its position in it (parent digest,
+    name); copies at the same position in duplicated parents are covered by
+    the parents' match and kept once, and a set left with fewer than two
+    copies is dropped. Identical siblings inside a duplicated directory are
+    therefore still reported (once, not once per copy of the parent).
+
+    Args:
+        root_dir: Starting directory path to scan
+        walk_threads: Number of threads walking the directory tree
+        index: Optional ScanIndex to rescan incrementally against
+        content: Include file contents in the hash (via the staged content scan,
+            which only hashes files whose size occurs more than once)
+        workers: Hashing processes for content (None = CPU count)
+        partial_bytes: Bytes read from each end of a file in the partial stage
+        mmap_threshold: Size at which full hashing switches from readinto to mmap
+        rules: Optional ScanRules to filter files and prune directories with
+
+    Returns:
+        Duplicate directory sets, largest potential saving first
+    """
+    root_dir = os.path.abspath(root_dir)
+    listing: Dict[str, List[Tuple[str, os.stat_result]]] = {}
+    walk = walk_tree(root_dir, walk_threads, index, rules)
+    for dirpath, files in walk:
+        listing[dirpath] = sorted(files, key=lambda item: item[0])
+
+    tokens: Dict[str, str] = {}
+    if content:
+        links: Dict[str, List[str]] = {}
+        for (digest, _), paths in iter_content_duplicates(
+                root_dir, workers, partial_bytes, walk_threads, index, mmap_threshold,
+                walk=listing.items(), links=links):
+            for path in paths:
+                tokens[path] = digest
+                for link in links.get(path, ()):
+                    tokens[link] = digest
+
+    # Link every directory holding files to its ancestors up to the root
+    children: Dict[str, set] = defaultdict(set)
+    for dirpath in list(listing):
+        while dirpath != root_dir:
+            parent = os.path.dirname(dirpath)
+            known = parent in children
+            children[parent].add(dirpath)
+            if known:
+                break
+            dirpath = parent
+
+    progress.phase("merkle")
+    # Deepest directories first, so children are always hashed before parents
+    all_dirs = set(listing) | set(children)
+    info: Dict[str, Tuple[str, int, int]] = {}
+    # Child directory -> (parent's digest, child's name)
+    position: Dict[str, Tuple[str, str]] = {}
+    for dirpath in sorted(all_dirs, key=lambda d: d.count(os.sep), reverse=True):
+        hasher = _new_hasher()
+        size = file_count = 0
+        for name, st in listing.get(dirpath, ()):
+            file_size = st.st_size
+            token = ""
+            if content:
+                # A file outside every content set is unique apart from its own hardlinks
+                path = os.path.join(dirpath, name)
+                file_id = _file_id(st)
+                token = tokens.get(path) or (f"inode:{file_id[0]}:{file_id[1]}" if file_id else "path:" + path)
+            hasher.update(f"f\0{name}\0{file_size}\0{token}\n".encode("utf-8", "surrogateescape"))
+            size += file_size
+            file_count += 1
+        child_dirs = sorted(children.get(dirpath, ()))
+        for child in child_dirs:
+            child_digest, child_size, child_count = info[child]
+            hasher.update(f"d\0{os.path.basename(child)}\0{child_digest}\n".encode("utf-8", "surrogateescape"))
+            size += child_size
+            file_count += child_count
+        digest = hasher.hexdigest()
+        info[dirpath] = (digest, size, file_count)
+        for child in child_dirs:
+            position[child] = (digest, os.path.basename(child))
+
+    by_digest: Dict[str, List[str]] = defaultdict(list)
+    for dirpath, (digest, _, file_count) in info.items():
+        if file_count:
+            by_digest[digest].append(dirpath)
+
+    results = []
+    for digest, dirs in by_digest.items():
+        if len(dirs) < 2:
+            continue
+        # One copy per position in a duplicated parent; elsewhere every copy counts
+        kept: Dict[object, str] = {}
+        for dirpath in sorted(dirs):
+            parent = position.get(dirpath)
+            key = parent if parent is not None and len(by_digest[parent[0]]) > 1 else dirpath
+            kept.setdefault(key, dirpath)
+        if len(kept) < 2:
+            continue
+        _, size, file_count = info[dirs[0]]
+        results.append(DirectoryDuplicate(digest, size, file_count, sorted(kept.values())))
+    results.sort(key=lambda r: (r.size * (len(r.directories) - 1), r.file_count), reverse=True)
+    return results
+
+
+# Files of the compared tree hashed and matched against the reference per batch
+COMPARE_BATCH_SIZE = 1024
+# TreeComparison statuses, in report order
+COMPARE_STATUSES = ("missing", "changed", "present")
+
+
+class TreeComparison(NamedTuple):
+    """Where one file of the compared tree stands against the reference tree."""
+    status: str
+    path: str
+    size: int
+    # Reference files with the same contents when present (same relative path
+    # first), or the differing file at the same relative path when changed
+    reference: List[str]
+
+
+def compare_trees(
+    root_dir: str,
+    reference_dir: str,
+    reference_index: ScanIndex,
+    workers: Optional[int] = None,
+    walk_threads: int = DEFAULT_WALK_THREADS,
+    index: Optional[ScanIndex] = None,
+    mmap_threshold: int = MMAP_THRESHOLD,
+    refresh: bool = True,
+    quick: bool = False,
+    rules: Optional[ScanRules] = None,
+) -> Iterator[TreeComparison]:
+    """
+    Check which files of root_dir are already in reference_dir, as a hash join
+    against the reference tree's ScanIndex.
+
+    The reference index is the build side: it is brought up to date with an
+    incremental scan (unless refresh is False, e.g. for an offline backup) and
+    the distinct file sizes it records are loaded into a set. root_dir is then
+    streamed against it:
+      - a file whose size is not in the set cannot be in the reference and is
+        reported without being read;
+      - the others are hashed in batches and probed against the full hashes of
+        reference files of the same size. Reference hashes are computed once
+        and stored in the index, so later comparisons only read new files.
+
+    A file is "present" if its contents exist anywhere in the reference,
+    "changed" if not but the reference has a file at the same relative path,
+    and "missing" otherwise.
+
+    Args:
+        root_dir: Tree to check
+        reference_dir: Tree to check against, e.g. a backup
+        reference_index: ScanIndex holding (or to hold) reference_dir
+        workers: Number of hashing processes (None = CPU count, 0 or 1 = in-process)
+        walk_threads: Number of threads walking each tree
+        index: Optional ScanIndex for root_dir, whose cached hashes are reused
+        mmap_threshold: Size at which full hashing switches from readinto to mmap
+        refresh: Rescan reference_dir into reference_index first
+        quick: Take a file as present without hashing when the reference file
+            at its relative path has the same size and mtime
+        rules: Optional ScanRules to filter files and prune directories with,
+            in both trees
+
+    Yields:
+        TreeComparison for every file of root_dir, a batch at a time
+    """
+    root_dir = os.path.abspath(root_dir)
+    reference_dir = os.path.abspath(reference_dir)
+    if refresh:
+        for _ in reference_index.scan(reference_dir, walk_threads, rules):
+            pass
+    sizes = reference_index.sizes_under(reference_dir)
+    progress.phase("compare")
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    full_hash = functools.partial(_hash_full, mmap_threshold=mmap_threshold)
+
+    def counterpart(path: str) -> str:
+        return os.path.join(reference_dir, os.path.relpath(path, root_dir))
+
+    def hash_all(paths: List[str], cache: Optional[ScanIndex]) -> Dict[str, str]:
+        """Full hashes of `paths`, from `cache` where it has them; new ones are stored in it."""
+        cached = cache.get_hashes(paths) if cache is not None else {}
+        digests = {path: row[1] for path, row in cached.items() if row[1] is not None}
+        new_full = {}
+        for path, digest, bytes_read in _map_jobs(full_hash, [p for p in paths if p not in digests],
+                                                  executor, workers):
+            progress.hashed(bytes_read)
+            if digest is None:
+                progress.error()
+            else:
+                new_full[path] = digest
+        if cache is not None and new_full:
+            cache.store_hashes({}, new_full)
+        digests.update(new_full)
+        return digests
+
+    # Reference hashes read by earlier batches (None where hashing failed). Without a refresh
+    # they are not written to the index, so this is what keeps a file from being read per batch
+    reference_digests: Dict[str, Optional[str]] = {}
+
+    def probe(batch: List[Tuple[str, int, bool]]) -> Iterator[TreeComparison]:
+        candidates = reference_index.files_of_sizes(reference_dir, {size for _, size, _ in batch})
+        known = {path: digest for files in candidates.values() for path, digest in files if digest is not None}
+        unhashed = [path for files in candidates.values() for path, digest in files if digest is None]
+        missing = [path for path in unhashed if path not in reference_digests]
+        # Without a refresh the index may be stale, so hashes read now are not kept in it
+        new_digests = hash_all(missing, reference_index if refresh else None)
+        for path in missing:
+            reference_digests[path] = new_digests.get(path)
+        known.update((path, reference_digests[path]) for path in unhashed if reference_digests[path] is not None)
+        copies: Dict[Tuple[int, str], List[str]] = defaultdict(list)
+        for size, files in candidates.items():
+            for path, _ in files:
+                if path in known:
+                    copies[size, known[path]].append(path)
+
+        digests = hash_all([path for path, _, _ in batch], index)
+        for path, size, has_twin in batch:
+            digest = digests.get(path)
+            if digest is None:
+                continue
+            found = copies.get((size, digest))
+            if found:
+                twin = counterpart(path)
+                yield TreeComparison("present", path, size, sorted(found, key=lambda p: (p != twin, p)))
+            elif has_twin:
+                yield TreeComparison("changed", path, size, [counterpart(path)])
+            else:
+                yield TreeComparison("missing", path, size, [])
+
+    try:
+        batch = []
+        for dirpath, files in walk_tree(root_dir, walk_threads, index, rules):
+            for filename, st in files:
+                path = os.path.join(dirpath, filename)
+                twin = reference_index.lookup(counterpart(path))
+                if quick and twin is not None and twin[:2] == (st.st_size, st.st_mtime_ns):
+                    yield TreeComparison("present", path, st.st_size, [counterpart(path)])
+                elif st.st_size not in sizes:
+                    if twin is not None:
+                        yield TreeComparison("changed", path, st.st_size, [counterpart(path)])
+                    else:
+                        yield TreeComparison("missing", path, st.st_size, [])
+                else:
+                    batch.append((path, st.st_size, twin is not None))
+                    if len(batch) >= COMPARE_BATCH_SIZE:
+                        yield from probe(batch)
+                        batch = []
+        if batch:
+            yield from probe(batch)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+# Only these report categories are searched for re-encoded or resized copies
+NEAR_DUPLICATE_CATEGORIES = ("Depth Maps", "Main Images")
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp")
+
+PHASH_ALGORITHMS = ("ahash", "dhash")
+
+DEFAULT_MAX_DISTANCE = 6
+
+
+def _require_imaging():
+    """Import the optional imaging dependencies, with a clear error when missing."""
+    try:
+        import numpy as np
+        from PIL import Image
+    except ImportError as e:
+        raise RuntimeError(
+            "Near-duplicate detection needs NumPy and Pillow: pip install numpy pillow") from e
+    return np, Image
+
+
+def _perceptual_hash(job: Tuple[str, str]) -> Tuple[str, Optional[int]]:
+    """
+    Compute a 64-bit perceptual hash of one image.
+
+    aHash sets a bit for each pixel of an 8x8 thumbnail brighter than the mean;
+    dHash sets a bit for each pixel of a 9x8 thumbnail brighter than its right
+    neighbour. Both survive re-encoding and resizing.
+
+    Args:
+        job: (image path, "ahash" or "dhash")
+
+    Returns:
+        (path, hash), with hash None if the image could not be read
+    """
+    path, algorithm = job
+    np, Image = _require_imaging()
+    size = (8, 8) if algorithm == "ahash" else (9, 8)
+    try:
+        with Image.open(path) as img:
+            # Let JPEG decode at reduced scale; a no-op for other formats
+            img.draft("L", (size[0] * 8, size[1] * 8))
+            # 16-bit depth maps keep their full range instead of being clipped to 8 bits
+            if img.mode.startswith("I;16"):
+                img = img.convert("I")
+            if img.mode not in ("I", "F", "L"):
+                img = img.convert("L")
+            pixels = np.asarray(img.resize(size, Image.BOX), dtype=np.float64)
+    except (OSError, ValueError) as e:
+        _report_error(f"Error hashing image {path}: {e}", count=False)
+        return path, None
+    if algorithm == "ahash":
+        bits = pixels > pixels.mean()
+    else:
+        bits = pixels[:, 1:] > pixels[:, :-1]
+    return path, int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def compute_perceptual_hashes(
+    paths: List[str],
+    algorithm: str = "dhash",
+    workers: Optional[int] = None,
+):
+    """
+    Hash images in a process pool into a packed uint64 array.
+
+    Args:
+        paths: Image files to hash
+        algorithm: "ahash" or "dhash"
+        workers: Number of hashing processes (None = CPU count, 0 or 1 = in-process)
+
+    Returns:
+        Tuple of (paths that could be hashed, numpy uint64 array of their hashes)
+    """
+    if algorithm not in PHASH_ALGORITHMS:
+        raise ValueError(f"Unknown perceptual hash: {algorithm}")
+    np, _ = _require_imaging()
+    if workers is None:
+        workers = os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    hashed: List[str] = []
+    values: List[int] = []
+    try:
+        for path, value in _map_jobs(_perceptual_hash, [(p, algorithm) for p in paths], executor, workers):
+            progress.hashed(0)
+            if value is None:
+                progress.error()
+            else:
+                hashed.append(path)
+                values.append(value)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return hashed, np.array(values, dtype=np.uint64)
+
+
+def _popcount64(values):
+    """Number of set bits in each element of a uint64 array."""
+    np, _ = _require_imaging()
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    # NumPy < 2.0: count the bits of each byte through a lookup table
+    table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    return table[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def find_similar_pairs(hashes, max_distance: int = DEFAULT_MAX_DISTANCE) -> Iterator[Tuple[int, int, int]]:
+    """
+    Find every pair of hashes within `max_distance` bits of each other.
+
+    Uses the pigeonhole principle instead of comparing all pairs: the 64 bits
+    are split into max_distance + 1 bands, and two hashes that differ in at
+    most max_distance bits must agree exactly on at least one band. Hashes are
+    sorted by each band in turn, and only hashes sharing a band value are
+    compared, with vectorized XOR and popcount.
+
+    Args:
+        hashes: numpy uint64 array of perceptual hashes
+        max_distance: Largest Hamming distance counted as similar (0-63)
+
+    Yields:
+        (i, j, distance) with i < j, each pair once
+    """
+    np, _ = _require_imaging()
+    if not 0 <= max_distance < 64:
+        raise ValueError("max_distance must be between 0 and 63")
+    bands = max_distance + 1
+    width = 64 // bands
+    seen = set()
+    for band in range(bands):
+        shift = band * width
+        # The last band takes the leftover high bits
+        bits = 64 - shift if band == bands - 1 else width
+        mask = np.uint64((1 << bits) - 1)
+        keys = (hashes >> np.uint64(shift)) & mask
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        # Start of each run of equal band values
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+        for start, end in zip(starts, ends):
+            if end - start < 2:
+                continue
+            members = order[start:end]
+            for pos in range(len(members) - 1):
+                i = members[pos]
+                others = members[pos + 1:]
+                distances = _popcount64(hashes[others] ^ hashes[i])
+                for j, distance in zip(others[distances <= max_distance], distances[distances <= max_distance]):
+                    pair = (int(min(i, j)), int(max(i, j)))
+                    if pair not in seen:
+                        seen.add(pair)
+                        yield pair[0], pair[1], int(distance)
+
+
+class NearDuplicate(NamedTuple):
+    """A cluster of visually similar images within one report category."""
+    category: str
+    paths: List[str]
+    # Largest Hamming distance among the similar pairs that joined the cluster
+    max_distance: int
+
+
+def find_near_duplicates(
+    root_dir: str,
+    max_distance: int = DEFAULT_MAX_DISTANCE,
+    algorithm: str = "dhash",
+    workers: Optional[int] = None,
+    walk_threads: int = DEFAULT_WALK_THREADS,
+    index: Optional[ScanIndex] = None,
+    categories: Iterable[str] = NEAR_DUPLICATE_CATEGORIES,
+    rules: Optional[ScanRules] = None,
+) -> List[NearDuplicate]:
+    """
+    Find re-encoded or resized copies of images by perceptual hash.
+
+    Only images in the given report categories are hashed. Similar pairs are
+    joined into clusters (connected components), so a cluster may contain
+    members further apart than max_distance via intermediate images.
+
+    Args:
+        root_dir: Starting directory path to scan
+        max_distance: Largest Hamming distance between hashes counted as similar
+        algorithm: "ahash" or "dhash"
+        workers: Number of hashing processes (None = CPU count)
+        walk_threads: Number of threads walking the directory tree
+        index: Optional ScanIndex to rescan incrementally against
+        categories: Report categories to search
+        rules: Optional ScanRules to filter files and prune directories with
+
+    Returns:
+        Clusters of at least two images, largest first
+
+    Raises:
+        RuntimeError: If NumPy or Pillow is not installed
+    """
+    _require_imaging()
+    root_dir = os.path.abspath(root_dir)
+    categories = set(categories)
+    by_category: Dict[str, List[str]] = defaultdict(list)
+    rules = rules or DEFAULT_RULES
+    for dirpath, filename, _ in _iter_files(root_dir, walk_threads, index, rules):
+        category = rules.categorize(filename, os.path.join(dirpath, filename))
+        if category in categories and filename.lower().endswith(IMAGE_EXTENSIONS):
+            by_category[category].append(os.path.join(dirpath, filename))
+
+    clusters = []
+    for category, paths in sorted(by_category.items()):
+        hashed, hashes = compute_perceptual_hashes(paths, algorithm, workers)
+        # Union-find over similar pairs
+        parent = list(range(len(hashed)))
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        widest: Dict[int, int] = defaultdict(int)
+        for i, j, distance in find_similar_pairs(hashes, max_distance):
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                parent[root_j] = root_i
+                widest[root_i] = max(widest[root_i], widest.pop(root_j, 0))
+            widest[root_i] = max(widest[root_i], distance)
+
+        members: Dict[int, List[str]] = defaultdict(list)
+        for i, path in enumerate(hashed):
+            members[find(i)].append(path)
+        for root, group in members.items():
+            if len(group) > 1:
+                clusters.append(NearDuplicate(category, sorted(group), widest[root]))
+    clusters.sort(key=lambda c: (-len(c.paths), c.category, c.paths))
+    return clusters
+
+
+# Average content-defined chunk size; chunks range from a quarter to four times this
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# Bytes covered by the 32-bit Gear rolling hash: bit k depends on the last k + 1 bytes
+GEAR_WINDOW = 32
+# Random 32-bit value per byte value, fixed so chunk boundaries are stable between runs
+GEAR_TABLE = tuple(int.from_bytes(hashlib.blake2b(bytes([i]), digest_size=4).digest(), "little")
+                   for i in range(256))
+# Shared file and directory pairs listed in the chunk report when --top-pairs is not given
+CHUNK_TOP_PAIRS = 20
+_MASK32 = (1 << 32) - 1
+
+
+def _load_numpy():
+    """Return numpy if installed, else None (chunking then runs in pure Python)."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _gear_masks(avg_size: int) -> Tuple[int, int]:
+    """
+    FastCDC normalized-chunking masks for a power-of-two average size.
+
+    The masks select high bits, which depend on the whole window. The strict
+    mask (two bits more) applies below the average size and the loose one (two
+    bits fewer) above it, pulling chunk sizes towards the average. Every strict
+    hit is also a loose hit.
+
+    Returns:
+        (strict mask, loose mask)
+    """
+    bits = avg_size.bit_length() - 1
+
+    def top(n: int) -> int:
+        return ((1 << n) - 1) << (32 - n)
+
+    return top(bits + 2), top(bits - 2)
+
+
+def _cut_lengths_python(data: bytearray, avg_size: int, final: bool) -> List[int]:
+    """
+    Split `data`, which starts on a chunk boundary, into FastCDC chunks.
+
+    The hash restarts at each chunk and boundaries are only tested once a chunk
+    reaches its minimum size, so the first min - GEAR_WINDOW bytes are skipped.
+
+    Args:
+        data: Buffered file contents
+        avg_size: Average chunk size (power of two, 256 to 2**28)
+        final: Whether data runs to the end of the file
+
+    Returns:
+        Lengths of the complete chunks at the front of data; if not final, the
+        bytes after them are kept for the next call
+    """
+    min_size, max_size = avg_size // 4, avg_size * 4
+    mask_s, mask_l = _gear_masks(avg_size)
+    gear = GEAR_TABLE
+    lengths = []
+    start = 0
+    size = len(data)
+    while start < size:
+        end = min(start + max_size, size)
+        normal = min(start + avg_size - 1, end)
+        cut = 0
+        h = 0
+        for i in range(start + min_size - GEAR_WINDOW, min(start + min_size - 1, end)):
+            h = ((h << 1) + gear[data[i]]) & _MASK32
+        for i in range(start + min_size - 1, normal):
+            h = ((h << 1) + gear[data[i]]) & _MASK32
+            if not h & mask_s:
+                cut = i + 1
+                break
+        else:
+            for i in range(normal, end):
+                h = ((h << 1) + gear[data[i]]) & _MASK32
+                if not h & mask_l:
+                    cut = i + 1
+                    break
+        if not cut:
+            if end == start + max_size or final:
+                cut = end
+            else:
+                break
+        lengths.append(cut - start)
+        start = cut
+    return lengths
+
+
+def _cut_lengths_numpy(np, data: bytearray, avg_size: int, final: bool) -> List[int]:
+    """
+    Vectorized _cut_lengths_python, finding the same boundaries.
+
+    The Gear hash only depends on its last GEAR_WINDOW bytes, so its value at
+    every position is built in log2(GEAR_WINDOW) shifted additions over the
+    whole buffer: h_2w[i] = h_w[i] + (h_w[i - w] << w). Only positions where the
+    loose mask hits are then walked in Python, one chunk at a time.
+    """
+    min_size, max_size = avg_size // 4, avg_size * 4
+    mask_s, mask_l = _gear_masks(avg_size)
+    h = np.take(np.array(GEAR_TABLE, dtype=np.uint32), np.frombuffer(data, dtype=np.uint8))
+    shifted = np.empty_like(h)
+    width = 1
+    while width < GEAR_WINDOW:
+        np.left_shift(h[:-width], np.uint32(width), out=shifted[width:])
+        np.add(h[width:], shifted[width:], out=h[width:])
+        width *= 2
+    loose = np.flatnonzero((h & np.uint32(mask_l)) == 0)
+    strict = loose[(h[loose] & np.uint32(mask_s)) == 0]
+
+    lengths = []
+    start = 0
+    size = len(data)
+    while start < size:
+        end = min(start + max_size, size)
+        normal = min(start + avg_size - 1, end)
+        cut = 0
+        j = np.searchsorted(strict, start + min_size - 1)
+        if j < len(strict) and strict[j] < normal:
+            cut = int(strict[j]) + 1
+        else:
+            k = np.searchsorted(loose, normal)
+            if k < len(loose) and loose[k] < end:
+                cut = int(loose[k]) + 1
+        if not cut:
+            if end == start + max_size or final:
+                cut = end
+            else:
+                break
+        lengths.append(cut - start)
+        start = cut
+    return lengths
+
+
+def chunk_file(filepath: str, avg_size: int = DEFAULT_CHUNK_SIZE) -> Tuple[Optional[List[Tuple[bytes, int]]], int]:
+    """
+    Split a file into content-defined chunks and digest each one.
+
+    Boundaries come from a Gear rolling hash with FastCDC's normalized chunking,
+    so an insertion or an appended tail only changes the chunks around it. The
+    file is streamed in HASH_CHUNK_BYTES reads; at most one read plus one
+    maximum-size chunk is buffered. Uses numpy when installed.
+
+    Args:
+        filepath: File to chunk
+        avg_size: Average chunk size (power of two, 256 to 2**28)
+
+    Returns:
+        ([(16-byte chunk digest, chunk length), ...] or None on error, bytes read)
+    """
+    np = _load_numpy()
+    pending = bytearray()
+    chunks = []
+    bytes_read = 0
+    try:
+        with open(filepath, 'rb', buffering=0) as f:
+            _advise_sequential(f.fileno())
+            final = False
+            while not final:
+                block = f.read(HASH_CHUNK_BYTES)
+                final = not block
+                bytes_read += len(block)
+                pending += block
+                if np is None:
+                    lengths = _cut_lengths_python(pending, avg_size, final)
+                else:
+                    lengths = _cut_lengths_numpy(np, pending, avg_size, final)
+                offset = 0
+                with memoryview(pending) as view:
+                    for length in lengths:
+                        digest = hashlib.blake2b(view[offset:offset + length], digest_size=16).digest()
+                        chunks.append((digest, length))
+                        offset += length
+                del pending[:offset]
+    except (OSError, PermissionError) as e:
+        _report_error(f"Error reading {filepath}: {e}", count=False)
+        return None, bytes_read
+    return chunks, bytes_read
+
+
+def _chunk_file(job: Tuple[str, int]) -> Tuple[str, Optional[List[Tuple[bytes, int]]], int]:
+    """Executor.map wrapper for chunk_file; job is (filepath, avg_size)."""
+    chunks, bytes_read = chunk_file(*job)
+    return job[0], chunks, bytes_read
+
+
+class ChunkIndex:
+    """
+    Chunk digests seen so far, and the bytes each file shares with earlier ones.
+
+    A digest maps to the ID of the first file containing it; every later copy
+    credits its length to that (first file, this file) pair. Pair totals are
+    kept in a dict keyed by (id_a << 32) | id_b, as in DirectoryOverlapIndex.
+    """
+
+    def __init__(self):
+        self._owners: Dict[bytes, int] = {}
+        self.paths: List[str] = []
+        self.chunks = 0
+        self.bytes_total = 0
+        self.bytes_unique = 0
+        self._pairs: Dict[int, int] = defaultdict(int)
+
+    def add_file(self, path: str, chunks: Iterable[Tuple[bytes, int]]) -> None:
+        """Record the chunks of one file, in file order."""
+        file_id = len(self.paths)
+        self.paths.append(path)
+        for digest, length in chunks:
+            self.chunks += 1
+            self.bytes_total += length
+            owner = self._owners.get(digest)
+            if owner is None:
+                self._owners[digest] = file_id
+                self.bytes_unique += length
+            elif owner != file_id:
+                # Repeats within one file save space too, but form no pair
+                self._pairs[(owner << 32) | file_id] += length
+
+    def shared_file_pairs(self, limit: Optional[int] = None) -> Tuple[List[Tuple[str, str, int]], int]:
+        """
+        Rank file pairs by the chunk bytes the second shares with the first.
+
+        Returns:
+            ([(path1, path2, shared bytes), ...], total number of pairs)
+        """
+        keys = heapq.nlargest(limit, self._pairs, key=self._pairs.get) if limit is not None \
+            else sorted(self._pairs, key=self._pairs.get, reverse=True)
+        pairs = [(self.paths[key >> 32], self.paths[key & 0xFFFFFFFF], self._pairs[key]) for key in keys]
+        return pairs, len(self._pairs)
+
+    def shared_directory_pairs(self, limit: Optional[int] = None) -> Tuple[List[Tuple[str, str, int]], int]:
+        """
+        Rank pairs of different directories by shared chunk bytes between their files.
+
+        Returns:
+            ([(dir1, dir2, shared bytes), ...], total number of pairs)
+        """
+        totals: Dict[Tuple[str, str], int] = defaultdict(int)
+        for key, shared in self._pairs.items():
+            dir1 = os.path.dirname(self.paths[key >> 32])
+            dir2 = os.path.dirname(self.paths[key & 0xFFFFFFFF])
+            if dir1 != dir2:
+                totals[min(dir1, dir2), max(dir1, dir2)] += shared
+        keys = heapq.nlargest(limit, totals, key=totals.get) if limit is not None \
+            else sorted(totals, key=totals.get, reverse=True)
+        return [(dir1, dir2, totals[dir1, dir2]) for dir1, dir2 in keys], len(totals)
+
+
+class ChunkReport(NamedTuple):
+    """Chunk-level sharing across a tree, as found by find_shared_chunks."""
+    avg_chunk_size: int
+    files: int
+    chunks: int
+    bytes_total: int
+    bytes_unique: int
+    # (path1, path2, bytes of path2 already found in path1), most shared first
+    file_pairs: List[Tuple[str, str, int]]
+    dir_pairs: List[Tuple[str, str, int]]
+
+
+def find_shared_chunks(
+    root_dir: str,
+    avg_size: int = DEFAULT_CHUNK_SIZE,
+    workers: Optional[int] = None,
+    walk_threads: int = DEFAULT_WALK_THREADS,
+    index: Optional[ScanIndex] = None,
+    top_pairs: Optional[int] = CHUNK_TOP_PAIRS,
+    rules: Optional[ScanRules] = None,
+) -> ChunkReport:
+    """
+    Measure how many bytes files share at the chunk level, e.g. appended logs
+    or re-exported archives that whole-file matching cannot see.
+
+    Every file is split with chunk_file and its chunks are added to a ChunkIndex
+    in sorted path order. Hardlinks are folded first, so they share nothing.
+    bytes_total - bytes_unique estimates what chunk-level deduplication saves.
+
+    Args:
+        root_dir: Starting directory path to scan
+        avg_size: Average chunk size (power of two, 256 to 2**28)
+        workers: Number of chunking processes (None = CPU count, 0 or 1 = in-process)
+        walk_threads: Number of threads walking the directory tree
+        index: Optional ScanIndex to rescan incrementally against
+        top_pairs: File and directory pairs to keep in the report (None = all)
+        rules: Optional ScanRules to filter files and prune directories with
+
+    Returns:
+        ChunkReport of the whole tree
+    """
+    root_dir = os.path.abspath(root_dir)
+    files = [(os.path.join(dirpath, filename), _file_id(st))
+             for dirpath, listing in walk_tree(root_dir, walk_threads, index, rules)
+             for filename, st in listing if st.st_size]
+    paths = _fold_links(files, {})
+    del files
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 and len(paths) > 1 else None
+    chunk_index = ChunkIndex()
+    try:
+        for path, chunks, bytes_read in _map_jobs(_chunk_file, [(path, avg_size) for path in paths],
+                                                  executor, workers):
+            progress.hashed(bytes_read)
+            if chunks is None:
+                progress.error()
+            else:
+                chunk_index.add_file(path, chunks)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    return ChunkReport(
+        avg_size, len(chunk_index.paths), chunk_index.chunks, chunk_index.bytes_total, chunk_index.bytes_unique,
+        chunk_index.shared_file_pairs(top_pairs)[0], chunk_index.shared_directory_pairs(top_pairs)[0])
+
+
+# HyperLogLog registers for --approximate: 2**14 give about 0.8% standard error
+HLL_PRECISION = 14
+# Count-Min rows for --approximate; each row costs a quarter of the sketch memory
+CMS_DEPTH = 4
+# Default memory for the --approximate sketches, and fraction of keys sampled
+DEFAULT_SKETCH_MEMORY = 16 * 1024 * 1024
+DEFAULT_SAMPLE_RATE = 1 / 16
+# Replicate subsamples whose spread gives the --approximate error bounds
+SKETCH_GROUPS = 64
+# Two-sided 95% quantiles: normal, and Student's t with SKETCH_GROUPS - 1 degrees of freedom
+_Z95 = 1.96
+_T95 = 1.998
+_MASK64 = (1 << 64) - 1
+
+
+class HyperLogLog:
+    """
+    Distinct-count sketch over 64-bit hashes, in 2**precision one-byte registers.
+
+    Uses the standard estimator with linear counting for small cardinalities;
+    the relative standard error is 1.04 / sqrt(2**precision).
+    """
+
+    def __init__(self, precision: int = HLL_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, hashed: int) -> None:
+        """Count one 64-bit hash."""
+        rest_bits = 64 - self.precision
+        rest = hashed & ((1 << rest_bits) - 1)
+        rank = rest_bits - rest.bit_length() + 1
+        register = hashed >> rest_bits
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    def count(self) -> float:
+        """Estimated number of distinct hashes added."""
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            return m * math.log(m / zeros)
+        return estimate
+
+    @property
+    def relative_error(self) -> float:
+        return 1.04 / math.sqrt(len(self.registers))
+
+
+class CountMinSketch:
+    """
+    Count-Min sketch with conservative update, `depth` rows of `width` 32-bit counters.
+
+    Estimates never undercount. A key not seen before reads as already seen
+    only when its cell in every row is taken, with probability collision_rate().
+    """
+
+    def __init__(self, width: int, depth: int = CMS_DEPTH):
+        self.width = width
+        self.depth = depth
+        self._cells = array("I", [0]) * (width * depth)
+        self._used = [0] * depth
+
+    def add(self, h1: int, h2: int) -> int:
+        """
+        Count one key, given two independent 64-bit hashes of it.
+
+        Returns:
+            Estimated count of the key before this occurrence
+        """
+        cells = self._cells
+        width = self.width
+        slots = [row * width + (h1 + row * h2) % width for row in range(self.depth)]
+        before = min(cells[slot] for slot in slots)
+        for row, slot in enumerate(slots):
+            if cells[slot] <= before:
+                if not cells[slot]:
+                    self._used[row] += 1
+                cells[slot] = before + 1
+        return before
+
+    def collision_rate(self) -> float:
+        """Probability that an unseen key currently reads as seen."""
+        rate = 1.0
+        for used in self._used:
+            rate *= used / self.width
+        return rate
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._cells.itemsize * len(self._cells)
+
+
+class SketchEstimate(NamedTuple):
+    """Estimated duplication of a tree, scaled up from a sample (see estimate_duplicates)."""
+    mode: str
+    sample_rate: float
+    files_sampled: int
+    bytes_sampled: int
+    duplicate_sets: float
+    duplicate_sets_error: float
+    duplicate_files: float
+    duplicate_files_error: float
+    wasted_bytes: float
+    wasted_bytes_error: float
+    distinct_keys: float
+    distinct_keys_error: float
+    # Probability, by the end of the scan, that a new key was taken for a repeat
+    # (inflating the figures) or a new file for a second link (deflating them)
+    collision_rate: float
+    memory_bytes: int
+
+
+class DuplicateSketch:
+    """
+    Fixed-memory duplicate statistics over a stream of sampled (key, size) records.
+
+    A Count-Min sketch answers, for each record, how often its key was seen
+    before: a repeat adds a duplicate file and its size to the wasted space, and
+    a first repeat adds a duplicate set. A HyperLogLog counts distinct keys.
+
+    Totals are kept per replicate group: the sample is split by hash into
+    SKETCH_GROUPS independent subsamples, and the spread of their scaled-up
+    totals gives the error bound. This stays valid when sampling units are
+    clustered, e.g. one common filename that many different keys share.
+    """
+
+    def __init__(self, memory_bytes: int = DEFAULT_SKETCH_MEMORY, precision: int = HLL_PRECISION):
+        self.hll = HyperLogLog(precision)
+        # A quarter of the counters remember file IDs, to skip second links to a file
+        width = max(1024, (memory_bytes - len(self.hll.registers)) // (4 * CMS_DEPTH))
+        self.cms = CountMinSketch(width - width // 4)
+        self.links = CountMinSketch(width // 4)
+        self.files = 0
+        self.bytes = 0
+        # Per group: [new keys, duplicate sets, duplicate files, wasted bytes]
+        self.groups = [[0, 0, 0, 0] for _ in range(SKETCH_GROUPS)]
+
+    def _hash(self, key: bytes) -> Tuple[int, int]:
+        hashed = int.from_bytes(hashlib.blake2b(key, digest_size=16).digest(), "little")
+        return hashed & _MASK64, hashed >> 64
+
+    def is_extra_link(self, st) -> bool:
+        """
+        Whether a file is a hardlink of one already counted, or reached again
+        through a symlink (probably: collisions can say yes).
+        """
+        file_id = _file_id(st)
+        if file_id is None:
+            return False
+        h1, h2 = self._hash(b"inode\0%d\0%d" % file_id)
+        return self.links.add(h1, h2 | 1) > 0
+
+    def add(self, key: bytes, size: int, unit_hash: int) -> None:
+        """
+        Count one file whose duplicate key is `key`.
+
+        Args:
+            key: Duplicate key of the file
+            size: File size in bytes
+            unit_hash: Sampling hash of the file, equal for every copy of the key
+        """
+        h1, h2 = self._hash(key)
+        self.files += 1
+        self.bytes += size
+        self.hll.add(h2)
+        totals = self.groups[unit_hash % SKETCH_GROUPS]
+        before = self.cms.add(h1, h2 | 1)
+        if not before:
+            totals[0] += 1
+            return
+        if before == 1:
+            totals[1] += 1
+        totals[2] += 1
+        totals[3] += size
+
+    def estimate(self, mode: str, sample_rate: float) -> SketchEstimate:
+        """
+        Scale the sample up to the whole tree.
+
+        Keys are sampled all-or-nothing with probability sample_rate, so totals
+        are divided by it (Horvitz-Thompson). Bounds are 95% and cover sampling
+        error, plus HyperLogLog error for distinct keys, but not Count-Min
+        collisions (see SketchEstimate.collision_rate).
+        """
+        count = len(self.groups)
+
+        def scaled(column: int) -> Tuple[float, float]:
+            # Each group is a sample_rate / count sample of its own
+            values = [totals[column] * count / sample_rate for totals in self.groups]
+            mean = sum(values) / count
+            variance = sum((value - mean) ** 2 for value in values) / (count - 1)
+            # Finite population correction: a full sample has no sampling error
+            return mean, _T95 * math.sqrt(variance / count * (1 - sample_rate))
+
+        distinct = self.hll.count() / sample_rate
+        _, distinct_error = scaled(0)
+        distinct_error = math.hypot(distinct_error, _Z95 * self.hll.relative_error * distinct)
+        return SketchEstimate(
+            mode, sample_rate, self.files, self.bytes, *scaled(1), *scaled(2), *scaled(3),
+            distinct, distinct_error, max(self.cms.collision_rate(), self.links.collision_rate()),
+            self.cms.memory_bytes + self.links.memory_bytes + len(self.hll.registers))
+
+
+def estimate_duplicates(
+    root_dir: str,
+    mode: str = "name",
+    sample_rate: float = DEFAULT_SAMPLE_RATE,
+    memory_bytes: int = DEFAULT_SKETCH_MEMORY,
+    walk_threads: int = DEFAULT_WALK_THREADS,
+    partial_bytes: int = PARTIAL_HASH_BYTES,
+    rules: Optional[ScanRules] = None,
+) -> SketchEstimate:
+    """
+    Quickly estimate duplicate sets and wasted space from a sample of keys.
+
+    Name mode keys are (filename, size). The sample is taken by filename hash
+    inside the walker, so unsampled files are never stat'ed and every copy of
+    a sampled name is seen. Content mode keys are (size, partial hash of the
+    first and last `partial_bytes`), sampled by size hash, so only sampled files
+    are read and copies, which share a size, are sampled together. Hardlinks
+    and symlinks of a file already counted are skipped. Memory stays fixed at
+    `memory_bytes` however large the tree.
+
+    Args:
+        root_dir: Starting directory path to scan
+        mode: "name" or "content"
+        sample_rate: Fraction of keys sampled (0 to 1)
+        memory_bytes: Memory for the Count-Min and HyperLogLog sketches
+        walk_threads: Number of threads walking the tree and reading samples
+        partial_bytes: Bytes hashed from each end of a file in content mode
+        rules: Optional ScanRules to filter files and prune directories with
+
+    Returns:
+        SketchEstimate for the whole tree
+    """
+    root_dir = os.path.abspath(root_dir)
+    rules = rules or DEFAULT_RULES
+    sketch = DuplicateSketch(memory_bytes)
+    if mode == "name":
+        for dirpath, files in walk_tree(root_dir, walk_threads, None, rules.with_name_sample(sample_rate)):
+            for filename, st in files:
+                if sketch.is_extra_link(st):
+                    continue
+                name = os.fsencode(filename)
+                sketch.add(name + b"\0%d" % st.st_size, st.st_size, _sample_hash(name))
+        return sketch.estimate(mode, sample_rate)
+
+    below = _sample_threshold(sample_rate)
+
+    def sampled_jobs() -> Iterator[Tuple[str, int, int]]:
+        for dirpath, files in walk_tree(root_dir, walk_threads, None, rules):
+            for filename, st in files:
+                if _sample_hash(b"%d" % st.st_size) < below and not sketch.is_extra_link(st):
+                    yield os.path.join(dirpath, filename), st.st_size, partial_bytes
+
+    progress.phase("hash")
+    jobs = sampled_jobs()
+    with ThreadPoolExecutor(max_workers=walk_threads) as executor:
+        while True:
+            batch = list(itertools.islice(jobs, 256))
+            if not batch:
+                break
+            for (_, size, _), (_, digest, bytes_read) in zip(batch, executor.map(_hash_partial, batch)):
+                progress.hashed(bytes_read)
+                if digest is None:
+                    progress.error()
+                else:
+                    sketch.add(b"%d\0" % size + bytes.fromhex(digest), size, _sample_hash(b"%d" % size))
+    return sketch.estimate(mode, sample_rate)
+
+
+# Linux FICLONE ioctl: make the destination share the source's extents (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+LINK_METHODS = ("hardlink", "reflink")
+
+LINK_BATCH_SIZE = 64
+
+
+def default_journal_path(root_dir: str) -> str:
+    """Link journal kept next to (not inside) the scan root."""
+    root_dir = os.path.abspath(root_dir)
+    parent, name = os.path.split(root_dir)
+    return os.path.join(parent, f".{name}.fdf-link-journal.jsonl")
+
+
+def reflink_supported() -> bool:
+    """Whether this platform has the FICLONE ioctl used for reflinks (Linux)."""
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    return True
+
+
+def _reflink(source: str, dest: str) -> None:
+    """Create dest as a copy-on-write clone of source."""
+    import fcntl
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            os.unlink(dest)
+            raise
+
+
+def _same_contents(source: str, target: str) -> bool:
+    """Compare two files byte for byte."""
+    with open(source, 'rb', buffering=0) as a, open(target, 'rb', buffering=0) as b:
+        while True:
+            chunk = a.read(HASH_CHUNK_BYTES)
+            if chunk != b.read(HASH_CHUNK_BYTES):
+                return False
+            if not chunk:
+                return True
+
+
+def _replace_with_link(job: Tuple[str, str, int, str, List[str]]) -> Tuple[str, str, str]:
+    """
+    Replace one duplicate with a link to the file being kept.
+
+    The target is first compared byte for byte with the source: hashes may
+    come from an index that missed an in-place edit, and a file replaced on
+    their word alone would lose that edit. The link is created under a
+    temporary name next to the target and moved over it with os.replace, so
+    the target is never missing. Other hardlinks of the target are then
+    relinked to it, so the old copy's storage is freed.
+
+    Args:
+        job: (source to keep, target to replace, expected size, method, target's other hardlinks)
+
+    Returns:
+        (target, status, detail) with status "linked", "skipped" or "error"
+    """
+    source, target, size, method, aliases = job
+    try:
+        source_st = os.stat(source)
+        target_st = os.stat(target)
+        if _file_id(source_st) is not None and _file_id(source_st) == _file_id(target_st):
+            return target, "skipped", "already linked"
+        if source_st.st_size != size or target_st.st_size != size:
+            return target, "skipped", "size changed since scan"
+        if not _same_contents(source, target):
+            return target, "skipped", "contents differ from the file kept"
+        tmp = os.path.join(os.path.dirname(target), f".{os.path.basename(target)}.fdf-link")
+        if os.path.lexists(tmp):
+            # Left behind by an interrupted run
+            os.unlink(tmp)
+        if method == "hardlink":
+            os.link(source, tmp)
+        else:
+            _reflink(source, tmp)
+            shutil.copystat(target, tmp)
+        try:
+            os.replace(tmp, target)
+        except OSError:
+            os.unlink(tmp)
+            raise
+        for alias in aliases:
+            os.link(target, tmp)
+            os.replace(tmp, alias)
+    except (OSError, PermissionError) as e:
+        return target, "error", str(e)
+    return target, "linked", ""
+
+
+def link_duplicates(
+    duplicates: Iterable[Tuple[Tuple[str, int], List[str]]],
+    method: str = "hardlink",
+    journal_path: Optional[str] = None,
+    threads: int = DEFAULT_WALK_THREADS,
+    links: Optional[Mapping[str, List[str]]] = None,
+    batch_size: int = LINK_BATCH_SIZE,
+) -> Dict[str, int]:
+    """
+    Reclaim space by replacing content duplicates with hardlinks or reflinks.
+
+    In every set the first path is kept and the others become links to it.
+    Replacements run in parallel batches; after each batch its outcomes are
+    appended to the journal and synced, and targets the journal already
+    records as linked are skipped, so an interrupted run can simply be
+    repeated to resume.
+
+    Args:
+        duplicates: Confirmed content duplicate sets, as from iter_content_duplicates
+        method: "hardlink" (same inode) or "reflink" (separate inodes sharing
+            extents, via FICLONE; Linux copy-on-write filesystems only)
+        journal_path: JSON Lines journal to resume from and append to (None = no journal)
+        threads: Number of replacements running at once
+        links: Other hardlinks of reported paths, as filled in by iter_content_duplicates
+        batch_size: Replacements per journaled batch
+
+    Returns:
+        Counts of "linked", "skipped", "error" and "resumed" targets, and
+        "bytes_reclaimed"
+    """
+    if method not in LINK_METHODS:
+        raise ValueError(f"Unknown link method: {method}")
+    if method == "reflink" and not reflink_supported():
+        # Checked before the journal is opened or any file is touched
+        raise ValueError("reflink needs the FICLONE ioctl, which this platform does not provide")
+    links = links or {}
+    done = set()
+    if journal_path is not None and os.path.exists(journal_path):
+        with open(journal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interruption
+                    continue
+                if record.get("status") == "linked" and record.get("method") == method:
+                    done.add(record["target"])
+
+    summary = {"linked": 0, "skipped": 0, "error": 0, "resumed": 0, "bytes_reclaimed": 0}
+    jobs = []
+    for (_, size), paths in duplicates:
+        source = paths[0]
+        for target in paths[1:]:
+            if target in done:
+                summary["resumed"] += 1
+            else:
+                jobs.append((source, target, size, method, links.get(target, [])))
+
+    journal = open(journal_path, 'a', encoding="utf-8") if journal_path is not None else None
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+            for start in range(0, len(jobs), batch_size):
+                batch = jobs[start:start + batch_size]
+                for (source, _, size, _, _), (target, status, detail) in zip(
+                        batch, executor.map(_replace_with_link, batch)):
+                    summary[status] += 1
+                    if status == "linked":
+                        summary["bytes_reclaimed"] += size
+                    elif status == "error":
+                        _report_error(f"Error linking {target}: {detail}")
+                    if journal is not None:
+                        journal.write(json.dumps({"target": target, "source": source, "method": method,
+                                                  "status": status, "detail": detail}) + "\n")
+                if journal is not None:
+                    journal.flush()
+                    os.fsync(journal.fileno())
+    finally:
+        if journal is not None:
+            journal.close()
+    return summary
+
+
+def write_jsonl(groups: Iterable, mode: str, out=None, links: Optional[Mapping[str, List[str]]] = None) -> int:
+    """
+    Write one JSON object per duplicate set as the sets arrive.
+
+    Name mode lines hold {"name", "size", "directories"}; content mode lines
+    hold {"hash", "size", "paths"}, plus {"hardlinks": {path: [other links]}}
+    when `links` has entries for the set; dirs mode lines hold the
+    DirectoryDuplicate fields {"digest", "size", "file_count", "directories"},
+    and compare mode lines the TreeComparison fields {"status", "path", "size", "reference"}.
+
+    Returns:
+        Number of lines written
+    """
+    out = out or sys.stdout
+    count = 0
+    for group in groups:
+        if mode in ("dirs", "compare"):
+            record = group._asdict()
+        elif mode == "content":
+            (key, size), locations = group
+            record = {"hash": key, "size": size, "paths": locations}
+            hardlinks = {path: links[path] for path in locations if links and path in links}
+            if hardlinks:
+                record["hardlinks"] = hardlinks
+        else:
+            (key, size), locations = group
+            record = {"name": key, "size": size, "directories": sorted(locations)}
+        out.write(json.dumps(record) + "\n")
+        out.flush()
+        count += 1
+    return count
+
+
+class DirectoryOverlapIndex:
+    """
+    Sparse co-occurrence counts of duplicate files between directory pairs.
+
+    Directories are interned to integer IDs and duplicate sets are first
+    collapsed by their exact set of directories, so a folder copied N times
+    costs one counter per pair of copies instead of one entry per file per pair.
+    Pair counts are kept in a dict keyed by (id_a << 32) | id_b.
+    """
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self.dirs: List[str] = []
+        # Sorted directory-ID tuple -> [file count, total bytes]
+        self._dirsets: Dict[Tuple[int, ...], List[int]] = {}
+
+    def _intern(self, directory: str) -> int:
+        dir_id = self._ids.get(directory)
+        if dir_id is None:
+            dir_id = self._ids[directory] = len(self.dirs)
+            self.dirs.append(directory)
+        return dir_id
+
+    def add(self, size: int, directories: Iterable[str]) -> None:
+        """Record one duplicate set of `size`-byte files found in `directories`."""
+        ids = tuple(sorted({self._intern(d) for d in directories}))
+        if len(ids) < 2:
+            return
+        entry = self._dirsets.get(ids)
+        if entry is None:
+            self._dirsets[ids] = [1, size]
+        else:
+            entry[0] += 1
+            entry[1] += size
+
+    def top_pairs(self, limit: Optional[int] = None) -> Tuple[List[Tuple[str, str, int, int]], int]:
+        """
+        Rank directory pairs by shared duplicate files, then by shared bytes.
+
+        Args:
+            limit: Only return this many pairs (selected with a heap, no full sort)
+
+        Returns:
+            ([(dir1, dir2, file count, total bytes), ...], total number of pairs)
+        """
+        counts: Dict[int, int] = defaultdict(int)
+        totals: Dict[int, int] = defaultdict(int)
+        for ids, (files, total) in self._dirsets.items():
+            for position, first in enumerate(ids):
+                base = first << 32
+                for second in ids[position + 1:]:
+                    counts[base | second] += files
+                    totals[base | second] += total
+
+        def rank(key: int) -> Tuple[int, int]:
+            return counts[key], totals[key]
+
+        if limit is None:
+            keys = sorted(counts, key=rank, reverse=True)
+        else:
+            keys = heapq.nlargest(limit, counts, key=rank)
+
+        pairs = []
+        for key in keys:
+            dir1, dir2 = sorted((self.dirs[key >> 32], self.dirs[key & 0xFFFFFFFF]))
+            pairs.append((dir1, dir2, counts[key], totals[key]))
+        return pairs, len(counts)
+
+
+def _print_directory_pairs(
+    groups: Iterable[Tuple[int, List[str]]],
+    common_prefix: str,
+    top_pairs: Optional[int] = None,
+) -> None:
+    """
+    Print summary of directory pairs containing duplicates.
+
+    Args:
+        groups: (size, directories) for every duplicate set
+        common_prefix: Path that displayed directories are made relative to
+        top_pairs: Only print the N most-overlapping pairs
+    """
+    # Track directory pairs that contain duplicates
+    overlap = DirectoryOverlapIndex()
+    for size, directories in groups:
+        overlap.add(size, directories)
+    pairs, total_pairs = overlap.top_pairs(top_pairs)
+
+    print("\nDirectory Pairs Containing Duplicates:")
+    print("-" * 80)
+
+    for dir1, dir2, file_count, total_size in pairs:
+        # Show relative paths from common prefix
+        rel_dir1 = os.path.relpath(dir1, common_prefix)
+        rel_dir2 = os.path.relpath(dir2, common_prefix)
+
+        print(f"\nPair containing {file_count} duplicate files (Total: {format_size(total_size)}):")
+        print(f"  - .../{rel_dir1}")
+        print(f"  - .../{rel_dir2}")
+
+    if total_pairs > len(pairs):
+        print(f"\n... and {total_pairs - len(pairs)} more directory pairs.")
+
+
+def print_duplicates(
+    duplicates: Mapping[Tuple[str, int], List[str]],
+    top_pairs: Optional[int] = None,
+    rules: Optional[ScanRules] = None,
+    chunks: Optional[ChunkReport] = None,
+    copies: Optional[Mapping[Tuple[str, int], int]] = None,
+) -> None:
+    """
+    Print formatted report of duplicate files, grouped by category.
+    Include summary of directory pairs containing duplicates.
+
+    Args:
+        duplicates: Dictionary mapping (filename, size) to list of directory paths
+        top_pairs: Only list the N directory pairs sharing the most duplicates
+        rules: ScanRules whose categories group the report (default: Depth Maps, Main Images)
+        chunks: Optional find_shared_chunks result, whose savings are listed next to whole-file savings
+        copies: Distinct files behind each set, as filled in by iter_duplicate_files,
+            so hardlinked copies are not counted as wasted space (default: every
+            location is a separate copy)
+    """
+    rules = rules or DEFAULT_RULES
+    if not duplicates:
+        print("\nNo duplicate files found.")
+        return
+
+    # Group files by category
+    categories: Dict[str, List[Tuple[Tuple[str, int], List[str]]]] = defaultdict(list)
+    total_wasted_space = 0
+
+    for (filename, size), directories in duplicates.items():
+        category = rules.categorize(filename, os.path.join(directories[0], filename))
+
+        # Calculate wasted space (size * (num_copies - 1)); hardlinked copies take no extra space
+        distinct = copies.get((filename, size), len(directories)) if copies is not None else len(directories)
+        total_wasted_space += size * max(distinct - 1, 0)
+        categories[category].append(((filename, size), directories))
+
+    # Print summary by category
+    print(f"\nFound {len(duplicates)} sets of duplicate files:\n")
+
+    # Flatten list of all directories for common prefix calculation
+    all_dirs = []
+    for dirs in duplicates.values():
+        all_dirs.extend(dirs)
+    common_prefix = os.path.commonpath(all_dirs)
+
+    for category, items in sorted(categories.items()):
+        print(f"=== {category} ===")
+        for (filename, size), directories in sorted(items):
+            print("\nDuplicate Found:")
+            print(f"  File Name: {filename}")
+            print(f"  File Size: {format_size(size)}")
+            print("  Locations:")
+            for directory in sorted(directories):
+                # Show relative path from common prefix for readability
+                rel_path = os.path.relpath(directory, common_prefix)
+                print(f"    - .../{rel_path}")
+        print("-" * 80)
+
+    # Print space savings summary
+    print(f"\nTotal space that could be saved by removing duplicates: {format_size(total_wasted_space)}")
+    if chunks is not None:
+        print(f"Total space that could be saved by chunk-level deduplication: "
+              f"{format_size(chunks.bytes_total - chunks.bytes_unique)}")
+
+    # Print directory pairs summary
+    _print_directory_pairs(
+        ((size, directories) for (_, size), directories in duplicates.items()),
+        common_prefix,
+        top_pairs,
+    )
+
+
+def print_content_duplicates(
+    duplicates: Dict[Tuple[str, int], List[str]],
+    stats: Dict[str, Dict[str, int]],
+    top_pairs: Optional[int] = None,
+    links: Optional[Mapping[str, List[str]]] = None,
+    rules: Optional[ScanRules] = None,
+    chunks: Optional[ChunkReport] = None,
+) -> None:
+    """
+    Print formatted report of content-identical files, grouped by category.
+    Include per-stage read statistics and a summary of directory pairs.
+
+    Args:
+        duplicates: Dictionary mapping (content digest, size) to list of file paths
+        stats: Per-stage statistics returned by find_content_duplicates
+        top_pairs: Only list the N directory pairs sharing the most duplicates
+        links: Other hardlinks of reported paths, listed under each location
+        rules: ScanRules whose categories group the report (default: Depth Maps, Main Images)
+        chunks: Optional find_shared_chunks result, whose savings are listed next to whole-file savings
+    """
+    links = links or {}
+    rules = rules or DEFAULT_RULES
+    print("\nContent scan stages:")
+    for stage in CONTENT_STAGES:
+        stage_stats = stats[stage]
+        print(f"  {stage:<8} candidates: {stage_stats['candidates']:>8}  "
+              f"cached: {stage_stats['cached']:>8}  "
+              f"read: {format_size(stage_stats['bytes_read']):>12}  "
+              f"skipped: {format_size(stage_stats['bytes_skipped']):>12}")
+
+    if not duplicates:
+        print("\nNo duplicate files found.")
+        return
+
+    categories: Dict[str, List[Tuple[Tuple[str, int], List[str]]]] = defaultdict(list)
+    total_wasted_space = 0
+    for (digest, size), paths in duplicates.items():
+        # Copies may be renamed, so categorize by the first name in sort order
+        category = rules.categorize(os.path.basename(paths[0]), paths[0])
+        total_wasted_space += size * (len(paths) - 1)
+        categories[category].append(((digest, size), paths))
+
+    print(f"\nFound {len(duplicates)} sets of duplicate files:\n")
+
+    common_prefix = os.path.commonpath([os.path.dirname(p) for paths in duplicates.values() for p in paths])
+
+    for category, items in sorted(categories.items()):
+        print(f"=== {category} ===")
+        for (digest, size), paths in sorted(items, key=lambda item: item[1]):
+            print("\nDuplicate Found:")
+            print(f"  Content Hash: {digest}")
+            print(f"  File Size: {format_size(size)}")
+            print("  Locations:")
+            for path in paths:
+                rel_path = os.path.relpath(path, common_prefix)
+                print(f"    - .../{rel_path}")
+                for link in links.get(path, ()):
+                    print(f"        (hardlink: .../{os.path.relpath(link, common_prefix)})")
+        print("-" * 80)
+
+    print(f"\nTotal space that could be saved by removing duplicates: {format_size(total_wasted_space)}")
+    if chunks is not None:
+        print(f"Total space that could be saved by chunk-level deduplication: "
+              f"{format_size(chunks.bytes_total - chunks.bytes_unique)}")
+    linked = sum(len(others) for others in links.values())
+    if linked:
+        print(f"({linked} paths are hardlinks of other files and already take no extra space.)")
+
+    _print_directory_pairs(
+        ((size, [os.path.dirname(p) for p in paths]) for (_, size), paths in duplicates.items()),
+        common_prefix,
+        top_pairs,
+    )
+
+
+def print_duplicate_directories(duplicates: List[DirectoryDuplicate]) -> None:
+    """
+    Print formatted report of duplicated directory subtrees, largest first.
+
+    Args:
+        duplicates: Result of find_duplicate_directories
+    """
+    if not duplicates:
+        print("\nNo duplicate directories found.")
+        return
+
+    print(f"\nFound {len(duplicates)} sets of duplicate directories:\n")
+    common_prefix = os.path.commonpath([d for dup in duplicates for d in dup.directories])
+    total_wasted_space = 0
+    for dup in duplicates:
+        total_wasted_space += dup.size * (len(dup.directories) - 1)
+        print("\nDuplicate Directory Found:")
+        print(f"  Contents: {dup.file_count} files, {format_size(dup.size)}")
+        print("  Locations:")
+        for directory in dup.directories:
+            print(f"    - .../{os.path.relpath(directory, common_prefix)}")
+    print("-" * 80)
+    print(f"\nTotal space that could be saved by removing duplicate directories: {format_size(total_wasted_space)}")
+
+
+def print_tree_comparison(results: List[TreeComparison], root_dir: str, reference_dir: str) -> None:
+    """
+    Print formatted report of compare_trees results: missing and changed
+    files in full, then a summary of all three statuses.
+
+    Args:
+        results: Result of compare_trees
+        root_dir: Tree that was checked
+        reference_dir: Tree it was checked against
+    """
+    root_dir = os.path.abspath(root_dir)
+    reference_dir = os.path.abspath(reference_dir)
+    by_status: Dict[str, List[TreeComparison]] = defaultdict(list)
+    for result in results:
+        by_status[result.status].append(result)
+
+    for status, heading in (("missing", "Missing from the reference"), ("changed", "Changed in the reference")):
+        items = sorted(by_status[status], key=lambda r: r.path)
+        if not items:
+            continue
+        print(f"\n=== {heading} ({len(items)} files, {format_size(sum(r.size for r in items))}) ===")
+        for result in items:
+            print(f"  - {os.path.relpath(result.path, root_dir)} ({format_size(result.size)})")
+        print("-" * 80)
+
+    present = by_status["present"]
+    moved = sum(1 for r in present
+                if r.reference[0] != os.path.join(reference_dir, os.path.relpath(r.path, root_dir)))
+    print(f"\nCompared {len(results)} files against {reference_dir}:")
+    for status in COMPARE_STATUSES:
+        items = by_status[status]
+        print(f"  {status:<8} {len(items):>8} files  {format_size(sum(r.size for r in items)):>12}")
+    if moved:
+        print(f"({moved} present files are only found at another path in the reference.)")
+
+
+def print_near_duplicates(clusters: List[NearDuplicate], algorithm: str, max_distance: int) -> None:
+    """
+    Print formatted report of perceptually similar images, grouped by category.
+
+    Args:
+        clusters: Result of find_near_duplicates
+        algorithm: Perceptual hash used, for the heading
+        max_distance: Distance threshold used, for the heading
+    """
+    if not clusters:
+        print(f"\nNo near-duplicate images found ({algorithm}, distance <= {max_distance}).")
+        return
+
+    print(f"\nFound {len(clusters)} sets of near-duplicate images ({algorithm}, distance <= {max_distance}):\n")
+    common_prefix = os.path.commonpath([os.path.dirname(p) for c in clusters for p in c.paths])
+    categories: Dict[str, List[NearDuplicate]] = defaultdict(list)
+    for cluster in clusters:
+        categories[cluster.category].append(cluster)
+    for category, items in sorted(categories.items()):
+        print(f"=== {category} ===")
+        for cluster in items:
+            print("\nNear-Duplicate Found:")
+            print(f"  Images: {len(cluster.paths)}  (max distance {cluster.max_distance})")
+            print("  Locations:")
+            for path in cluster.paths:
+                print(f"    - .../{os.path.relpath(path, common_prefix)}")
+        print("-" * 80)
+
+
+def print_shared_chunks(report: ChunkReport) -> None:
+    """
+    Print chunk-level sharing: totals, then the file and directory pairs sharing the most bytes.
+
+    Args:
+        report: Result of find_shared_chunks
+    """
+    saved = report.bytes_total - report.bytes_unique
+    print(f"\nContent-defined chunks (average {format_size(report.avg_chunk_size)}): "
+          f"{report.files} files, {report.chunks} chunks, {format_size(report.bytes_total)} read, "
+          f"{format_size(report.bytes_unique)} unique.")
+    print(f"Space that could be saved by chunk-level deduplication: {format_size(saved)}")
+    if not report.file_pairs:
+        return
+    common_prefix = os.path.commonpath([os.path.dirname(path) for pair in report.file_pairs for path in pair[:2]]
+                                       + [directory for pair in report.dir_pairs for directory in pair[:2]])
+
+    print("\nFiles Sharing the Most Chunk Data:")
+    print("-" * 80)
+    for path1, path2, shared in report.file_pairs:
+        print(f"\nPair sharing {format_size(shared)}:")
+        print(f"  - .../{os.path.relpath(path1, common_prefix)}")
+        print(f"  - .../{os.path.relpath(path2, common_prefix)}")
+
+    if report.dir_pairs:
+        print("\nDirectory Pairs Sharing the Most Chunk Data:")
+        print("-" * 80)
+        for dir1, dir2, shared in report.dir_pairs:
+            print(f"\nPair sharing {format_size(shared)}:")
+            print(f"  - .../{os.path.relpath(dir1, common_prefix)}")
+            print(f"  - .../{os.path.relpath(dir2, common_prefix)}")
+
+
+def print_sketch_estimate(estimate: SketchEstimate) -> None:
+    """
+    Print the duplication estimate from estimate_duplicates.
+
+    Args:
+        estimate: Result of estimate_duplicates
+    """
+    keys = "filename + size" if estimate.mode == "name" else "size + partial content hash"
+    print(f"\nApproximate scan ({keys} keys, {estimate.sample_rate:.2%} sampled: "
+          f"{estimate.files_sampled} files, {format_size(estimate.bytes_sampled)}):")
+    print(f"  Duplicate sets:  ~{estimate.duplicate_sets:,.0f} ± {estimate.duplicate_sets_error:,.0f}")
+    print(f"  Duplicate files: ~{estimate.duplicate_files:,.0f} ± {estimate.duplicate_files_error:,.0f}")
+    print(f"  Distinct keys:   ~{estimate.distinct_keys:,.0f} ± {estimate.distinct_keys_error:,.0f}")
+    print(f"\nEstimated space that could be saved by removing duplicates: "
+          f"~{format_size(estimate.wasted_bytes)} ± {format_size(estimate.wasted_bytes_error)}")
+    print("(95% bounds from sampling and HyperLogLog error.)")
+    if estimate.collision_rate >= 0.001:
+        print(f"Sketch collisions ({estimate.collision_rate:.1%} of new keys by the end) may skew these "
+              f"figures; raise --sketch-memory or lower --sample-rate.")
+    print(f"Sketch memory: {format_size(estimate.memory_bytes)}")
+
+
+def main():
+    # Hardcoded default path - can be overridden on the command line
+    default_dir = r"C:\Users\Casey\OneDrive\CSM\CD\_WIP\.Next\_3Dnext\_DOWNselect"
+
+    parser = argparse.ArgumentParser(description="Find duplicate files across subdirectories.")
+    parser.add_argument("target_dir", nargs="?", default=default_dir,
+                        help=f"Directory to scan (default: {default_dir})")
+    parser.add_argument("--mode", choices=["name", "content", "dirs", "compare"], default="name",
+                        help="Match files on filename+size (fast, default) or on file contents, "
+                             "or match whole directory subtrees (dirs), or check target_dir "
+                             "against a --reference tree (compare).")
+    parser.add_argument("--reference", default=None, metavar="DIR",
+                        help="With --mode compare, the tree (e.g. a backup) whose contents target_dir "
+                             "is checked against: each file is reported present, changed or missing.")
+    parser.add_argument("--reference-index", default=None, metavar="PATH",
+                        help="Scan index of the --reference tree, kept across comparisons "
+                             "(default: .<dirname>.fdf-index.sqlite next to the reference).")
+    parser.add_argument("--trust-reference", action="store_true",
+                        help="Use the reference index as-is instead of rescanning the reference first.")
+    parser.add_argument("--quick", action="store_true",
+                        help="With --mode compare, count a file as present without hashing it when the "
+                             "reference file at the same path has the same size and mtime.")
+    parser.add_argument("--dir-content", action="store_true",
+                        help="With --mode dirs, compare file contents instead of names and sizes only.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Hashing processes for content mode (default: CPU count).")
+    parser.add_argument("--partial-bytes", type=int, default=PARTIAL_HASH_BYTES,
+                        help=f"Bytes hashed from each end of a file in the partial stage (default: {PARTIAL_HASH_BYTES}).")
+    parser.add_argument("--mmap-threshold", type=int, default=MMAP_THRESHOLD,
+                        help=f"File size at which content hashing switches to mmap (default: {MMAP_THRESHOLD}).")
+    parser.add_argument("--git", action="store_true",
+                        help="Content mode: use git object IDs as hashes of clean tracked files and only "
+                             "hash modified and untracked ones (target_dir must be in a git work tree).")
+    parser.add_argument("--walk-threads", type=int, default=DEFAULT_WALK_THREADS,
+                        help=f"Threads used to walk the directory tree (default: {DEFAULT_WALK_THREADS}).")
+    filters = parser.add_argument_group("filters", "Rules applied inside the walker; globs containing "
+                                                   "a path separator match full paths, others bare names")
+    filters.add_argument("--include", action="append", default=[], metavar="GLOB",
+                         help="Only scan files matching GLOB (repeatable).")
+    filters.add_argument("--exclude", action="append", default=[], metavar="GLOB",
+                         help="Skip files matching GLOB (repeatable).")
+    filters.add_argument("--prune", action="append", default=[], metavar="GLOB",
+                         help="Do not descend into directories matching GLOB, e.g. .git (repeatable).")
+    filters.add_argument("--ext", action="append", default=[], metavar="EXT",
+                         help="Only scan files with these extensions, comma-separated (repeatable).")
+    filters.add_argument("--min-size", type=int, default=None, metavar="BYTES", help="Skip smaller files.")
+    filters.add_argument("--max-size", type=int, default=None, metavar="BYTES", help="Skip larger files.")
+    filters.add_argument("--newer-than", type=_parse_time, default=None, metavar="DATE",
+                         help="Skip files last modified before DATE (ISO format, e.g. 2024-01-31).")
+    filters.add_argument("--older-than", type=_parse_time, default=None, metavar="DATE",
+                         help="Skip files last modified after DATE (ISO format).")
+    filters.add_argument("--category", action="append", default=[], metavar="NAME=GLOB",
+                         help="Report category for names matching GLOB, checked in order; replaces the "
+                              "default Depth Maps (*_depth_*) and Main Images (*_main_*) (repeatable).")
+    parser.add_argument("--async-scan", action="store_true",
+                        help="Walk with asyncio, one bounded operation per listing and stat; "
+                             "faster on network or cloud-synced mounts where every call is slow.")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_ASYNC_CONCURRENCY,
+                        help=f"Filesystem operations in flight with --async-scan (default: {DEFAULT_ASYNC_CONCURRENCY}).")
+    parser.add_argument("--op-timeout", type=float, default=DEFAULT_OP_TIMEOUT, metavar="SECONDS",
+                        help=f"Seconds before an --async-scan operation is skipped as an error "
+                             f"(default: {DEFAULT_OP_TIMEOUT:g}).")
+    parser.add_argument("--approximate", action="store_true",
+                        help="Only estimate duplicate sets and wasted space, with error bounds, from a "
+                             "sample of keys held in fixed-memory sketches (name or content mode).")
+    parser.add_argument("--sample-rate", type=float, default=DEFAULT_SAMPLE_RATE, metavar="FRACTION",
+                        help=f"Fraction of keys sampled by --approximate (default: {DEFAULT_SAMPLE_RATE:g}).")
+    parser.add_argument("--sketch-memory", type=int, default=DEFAULT_SKETCH_MEMORY // (1024 * 1024), metavar="MB",
+                        help=f"Memory for the --approximate sketches "
+                             f"(default: {DEFAULT_SKETCH_MEMORY // (1024 * 1024)}).")
+    parser.add_argument("--index", nargs="?", const="", default=None, metavar="PATH",
+                        help="Keep a persistent scan index and rescan incrementally "
+                             "(default PATH: .<dirname>.fdf-index.sqlite next to the target directory).")
+    parser.add_argument("--full-rescan", action="store_true",
+                        help="With --index, re-list every directory instead of trusting unchanged mtimes.")
+    parser.add_argument("--memory-budget", type=int, default=None, metavar="MB",
+                        help="Name mode only: group out of core with sorted run files, "
+                             "holding about this many MB of records in memory.")
+    parser.add_argument("--tmp-dir", default=None,
+                        help="Directory for --memory-budget run files (default: system temp directory).")
+    parser.add_argument("--top-pairs", type=int, default=None, metavar="N",
+                        help="Only list the N directory pairs sharing the most duplicates (default: all).")
+    parser.add_argument("--link", choices=LINK_METHODS, default=None,
+                        help="Content mode only: replace each duplicate with a hardlink or reflink "
+                             "to the first file of its set.")
+    parser.add_argument("--link-journal", default=None, metavar="PATH",
+                        help="Journal used to resume an interrupted --link run "
+                             "(default: .<dirname>.fdf-link-journal.jsonl next to the target directory).")
+    parser.add_argument("--link-threads", type=int, default=DEFAULT_WALK_THREADS,
+                        help=f"Files replaced in parallel by --link (default: {DEFAULT_WALK_THREADS}).")
+    parser.add_argument("--near-duplicates", action="store_true",
+                        help="Also find re-encoded or resized copies of Depth Map and Main Image "
+                             "renders by perceptual hash (needs numpy and Pillow).")
+    parser.add_argument("--phash", choices=PHASH_ALGORITHMS, default="dhash",
+                        help="Perceptual hash for --near-duplicates (default: dhash).")
+    parser.add_argument("--max-distance", type=int, default=DEFAULT_MAX_DISTANCE,
+                        help=f"Largest differing hash bits counted as similar (default: {DEFAULT_MAX_DISTANCE}).")
+    parser.add_argument("--chunks", action="store_true",
+                        help="Also split every file into content-defined chunks and report bytes shared "
+                             "between files and directories (e.g. appended logs); numpy speeds this up.")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, metavar="BYTES",
+                        help=f"Average chunk size for --chunks, a power of two (default: {DEFAULT_CHUNK_SIZE}).")
+    parser.add_argument("--write-shard", default=None, metavar="PATH",
+                        help="Name mode: write a partial result for this subtree to PATH instead of "
+                             "reporting, for --merge-shards to combine with other nodes' shards.")
+    parser.add_argument("--shard-hashes", action="store_true",
+                        help="With --write-shard, also store a full content hash of every file.")
+    parser.add_argument("--merge-shards", nargs="+", default=None, metavar="SHARD",
+                        help="Report duplicates across shards written by --write-shard (target_dir is ignored).")
+    parser.add_argument("--progress", action=argparse.BooleanOptionalAction, default=None,
+                        help="Show a live status line on stderr (default: when stderr is a terminal).")
+    parser.add_argument("--profile", choices=["cprofile", "tracemalloc"], default=None,
+                        help="Run under cProfile or tracemalloc and print the top entries to stderr.")
+    parser.add_argument("--profile-output", default=None, metavar="PATH",
+                        help="With --profile, also save the pstats data or tracemalloc snapshot to PATH.")
+    parser.add_argument("--format", choices=["text", "jsonl"], default="text",
+                        help="Human-readable report (default) or one JSON object per duplicate set, "
+                             "streamed as sets are confirmed.")
+    args = parser.parse_args()
+    if args.memory_budget is not None and args.mode != "name":
+        parser.error("--memory-budget is only supported with --mode name")
+    if args.link is not None and args.mode != "content":
+        parser.error("--link is only supported with --mode content")
+    if args.link == "reflink" and not reflink_supported():
+        parser.error("--link reflink is only supported on Linux (use --link hardlink)")
+    if args.link is not None and args.index is not None and not args.full_rescan:
+        # The index trusts unchanged directory mtimes, so it can miss files edited in place
+        parser.error("--link with --index requires --full-rescan")
+    if not 0 <= args.max_distance < 64:
+        parser.error("--max-distance must be between 0 and 63")
+    if args.async_scan and (args.index is not None or args.memory_budget is not None or args.mode == "dirs"):
+        parser.error("--async-scan does not support --index, --memory-budget or --mode dirs")
+    if (args.write_shard or args.merge_shards) and args.mode != "name":
+        parser.error("--write-shard and --merge-shards are only supported with --mode name")
+    if args.git and args.mode != "content":
+        parser.error("--git is only supported with --mode content")
+    if not 256 <= args.chunk_size <= 1 << 28 or args.chunk_size & (args.chunk_size - 1):
+        parser.error("--chunk-size must be a power of two from 256 to 2**28")
+    if args.approximate and (args.mode == "dirs" or args.index is not None or args.async_scan
+                             or args.memory_budget is not None or args.link is not None or args.git
+                             or args.write_shard or args.merge_shards):
+        parser.error("--approximate only supports --mode name or content, without --index, --async-scan, "
+                     "--memory-budget, --link, --git or shards")
+    if not 0 < args.sample_rate <= 1:
+        parser.error("--sample-rate must be above 0 and at most 1")
+    if args.sketch_memory < 1:
+        parser.error("--sketch-memory must be at least 1 MB")
+    if (args.mode == "compare") != (args.reference is not None):
+        parser.error("--mode compare and --reference go together")
+    if args.mode == "compare" and (args.async_scan or args.memory_budget is not None or args.link is not None
+                                   or args.git or args.near_duplicates or args.chunks or args.approximate):
+        parser.error("--mode compare does not support --async-scan, --memory-budget, --link, --git, "
+                     "--near-duplicates, --chunks or --approximate")
+    if args.mode == "compare":
+        target, reference = os.path.abspath(args.target_dir), os.path.abspath(args.reference)
+        if os.path.commonpath([target, reference]) in (target, reference):
+            parser.error("target_dir and --reference must not contain one another")
+        if not os.path.isdir(reference) and not args.trust_reference:
+            parser.error(f"reference directory not found: {args.reference}")
+    if any("=" not in category for category in args.category):
+        parser.error("--category takes NAME=GLOB")
+
+    if args.merge_shards is None and not os.path.exists(args.target_dir):
+        print(f"Error: Directory not found: {args.target_dir}", file=sys.stderr)
+        sys.exit(1)
+    if args.near_duplicates:
+        try:
+            _require_imaging()
+        except RuntimeError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+
+    progress.enabled = sys.stderr.isatty() if args.progress is None else args.progress
+    if args.profile is None:
+        run(args)
+    else:
+        _run_profiled(args)
+
+
+def _parse_time(value: str) -> float:
+    """argparse type for ISO dates and times, as seconds since the epoch."""
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date: {value!r}")
+
+
+def rules_from_args(args: argparse.Namespace) -> Optional[ScanRules]:
+    """Build ScanRules from the filter options, or None when none are given."""
+    extensions = [ext.strip() for value in args.ext for ext in value.split(",") if ext.strip()]
+    categories = [tuple(category.split("=", 1)) for category in args.category]
+    if not (args.include or args.exclude or args.prune or extensions or categories
+            or args.min_size is not None or args.max_size is not None
+            or args.newer_than is not None or args.older_than is not None):
+        return None
+    return ScanRules(args.include, args.exclude, args.prune, extensions, args.min_size, args.max_size,
+                     args.newer_than, args.older_than, categories or DEFAULT_CATEGORIES)
+
+
+def _run_profiled(args: argparse.Namespace) -> None:
+    """Run under cProfile or tracemalloc and print the top entries to stderr."""
+    if args.profile == "cprofile":
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(run, args)
+        finally:
+            print(f"\nProfile (top {PROFILE_TOP_N} by cumulative time; hashing processes not included):",
+                  file=sys.stderr)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+            if args.profile_output:
+                profiler.dump_stats(args.profile_output)
+                print(f"Profile data written to {args.profile_output}", file=sys.stderr)
+    else:
+        tracemalloc.start()
+        try:
+            run(args)
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"\nPeak traced memory: {format_size(peak)}. Top {PROFILE_TOP_N} allocation sites still live:",
+                  file=sys.stderr)
+            for stat in snapshot.statistics("lineno")[:PROFILE_TOP_N]:
+                print(f"  {stat}", file=sys.stderr)
+            if args.profile_output:
+                snapshot.dump(args.profile_output)
+                print(f"Snapshot written to {args.profile_output}", file=sys.stderr)
+
+
+def run(args: argparse.Namespace) -> None:
+    """Scan and report according to parsed command-line arguments."""
+    target_dir = args.target_dir
+    # Keep stdout clean for machine-readable output
+    log = sys.stderr if args.format == "jsonl" else sys.stdout
+    rules = rules_from_args(args)
+
+    if args.merge_shards is not None:
+        progress.phase("merge")
+        try:
+            copies: Dict[Tuple[str, int], int] = {}
+            duplicates, metadatas = merge_shards(args.merge_shards, copies)
+        except (OSError, ValueError) as e:
+            print(f"Error reading shard: {e}", file=sys.stderr)
+            sys.exit(1)
+        for metadata in metadatas:
+            print(f"Shard: {metadata['host']}:{metadata['root']} ({metadata['files']} files, "
+                  f"{'hashed' if metadata['hashes'] else 'no hashes'}, {metadata['created']})", file=log)
+        progress.phase("report")
+        if args.format == "jsonl":
+            count = write_jsonl(duplicates.items(), args.mode)
+            print(f"Wrote {count} duplicate sets.", file=log)
+        else:
+            print_duplicates(duplicates, args.top_pairs, rules, copies=copies)
+        progress.finish()
+        progress.print_summary(log)
+        return
+
+    if args.approximate:
+        print(f"Estimating duplicates in: {target_dir}", file=log)
+        progress.phase("scan")
+        estimate = estimate_duplicates(target_dir, args.mode, args.sample_rate, args.sketch_memory * 1024 * 1024,
+                                       args.walk_threads, args.partial_bytes, rules)
+        progress.phase("report")
+        progress.clear_line()
+        if args.format == "jsonl":
+            print(json.dumps(estimate._asdict()))
+        else:
+            print_sketch_estimate(estimate)
+        progress.finish()
+        progress.print_summary(log)
+        return
+
+    print(f"Scanning directory: {target_dir}", file=log)
+    print("This may take a while depending on the number of files...", file=log)
+
+    index = None
+    if args.index is not None:
+        index_path = args.index or default_index_path(target_dir)
+        print(f"Using scan index: {index_path}", file=log)
+        index = ScanIndex(index_path, full_rescan=args.full_rescan)
+
+    if args.mode == "compare":
+        reference_index_path = args.reference_index or default_index_path(args.reference)
+        print(f"Reference: {args.reference} (index: {reference_index_path})", file=log)
+        reference_index = ScanIndex(reference_index_path)
+        progress.phase("scan")
+        try:
+            results = compare_trees(
+                target_dir, args.reference, reference_index, args.workers, args.walk_threads, index,
+                args.mmap_threshold, not args.trust_reference, args.quick, rules)
+            if args.format == "jsonl":
+                count = write_jsonl(results, args.mode)
+                progress.clear_line()
+                print(f"Compared {count} files.", file=log)
+            else:
+                results = list(results)
+        finally:
+            reference_index.close()
+            if index is not None:
+                index.close()
+        progress.phase("report")
+        progress.clear_line()
+        if args.format == "text":
+            print_tree_comparison(results, target_dir, args.reference)
+        progress.finish()
+        progress.print_summary(log)
+        return
+
+    if args.write_shard is not None:
+        progress.phase("scan")
+        try:
+            metadata = write_shard(args.write_shard, target_dir, args.walk_threads, index,
+                                   args.shard_hashes, args.workers, args.mmap_threshold, rules)
+        finally:
+            if index is not None:
+                index.close()
+        progress.finish()
+        print(f"Wrote shard {args.write_shard}: {metadata['files']} files in "
+              f"{metadata['directories']} directories.", file=log)
+        progress.print_summary(log)
+        return
+
+    stats = new_content_stats()
+    links: Dict[str, List[str]] = {}
+    copies: Dict[Tuple[str, int], int] = {}
+    progress.phase("scan")
+    walk = None
+    if args.async_scan:
+        walk = asyncio.run(scan_tree_async(os.path.abspath(target_dir), args.concurrency, args.op_timeout,
+                                           rules=rules))
+    try:
+        if args.mode == "content" and args.git:
+            blob_ids = git_blob_ids(target_dir)
+            if blob_ids is None:
+                print(f"Error: Not inside a git work tree: {target_dir}", file=sys.stderr)
+                sys.exit(1)
+            print(f"Git index: {len(blob_ids[0])} clean tracked files ({blob_ids[1]} object IDs).", file=log)
+            groups = iter_git_content_duplicates(
+                target_dir, blob_ids, args.workers, args.walk_threads, index, stats, walk, links, rules)
+            if args.link is not None:
+                groups = list(groups)
+        elif args.mode == "content":
+            groups = iter_content_duplicates(
+                target_dir, args.workers, args.partial_bytes, args.walk_threads, index,
+                args.mmap_threshold, stats, walk, links, rules)
+            if args.link is not None:
+                groups = list(groups)
+        elif args.mode == "dirs":
+            groups = find_duplicate_directories(
+                target_dir, args.walk_threads, index, args.dir_content, args.workers,
+                args.partial_bytes, args.mmap_threshold, rules)
+        elif args.memory_budget is not None:
+            groups = iter_duplicate_files_external(
+                target_dir, args.memory_budget * 1024 * 1024, args.walk_threads, index, args.tmp_dir, rules,
+                copies)
+        else:
+            groups = iter_duplicate_files(target_dir, args.walk_threads, index, walk, rules, copies)
+
+        if args.format == "jsonl":
+            count = write_jsonl(groups, args.mode, links=links)
+            progress.clear_line()
+            print(f"Wrote {count} duplicate sets.", file=log)
+        elif args.mode != "dirs":
+            duplicates = dict(groups)
+
+        near = None
+        if args.near_duplicates:
+            progress.phase("near-duplicates")
+            progress.rewalk()
+            near = find_near_duplicates(
+                target_dir, args.max_distance, args.phash, args.workers, args.walk_threads, index,
+                rules=rules)
+            if args.format == "jsonl":
+                for cluster in near:
+                    print(json.dumps(cluster._asdict()))
+
+        chunks = None
+        if args.chunks:
+            progress.phase("chunk")
+            progress.rewalk()
+            chunks = find_shared_chunks(target_dir, args.chunk_size, args.workers, args.walk_threads, index,
+                                        args.top_pairs or CHUNK_TOP_PAIRS, rules)
+            if args.format == "jsonl":
+                print(json.dumps(chunks._asdict()))
+    finally:
+        if index is not None:
+            index.close()
+
+    progress.phase("report")
+    progress.clear_line()
+    if index is not None:
+        print(f"Index: {index.dirs_reused} directories unchanged, {index.dirs_listed} re-listed.", file=log)
+    if args.format == "text":
+        if args.mode == "dirs":
+            print_duplicate_directories(groups)
+        elif args.mode == "content":
+            print_content_duplicates(duplicates, stats, args.top_pairs, links, rules, chunks)
+        else:
+            print_duplicates(duplicates, args.top_pairs, rules, chunks, copies)
+        if near is not None:
+            print_near_duplicates(near, args.phash, args.max_distance)
+        if chunks is not None:
+            print_shared_chunks(chunks)
+
+    if args.link is not None:
+        progress.phase("link")
+        journal_path = args.link_journal or default_journal_path(target_dir)
+        print(f"\nReplacing duplicates with {args.link}s (journal: {journal_path})...", file=log)
+        summary = link_duplicates(groups, args.link, journal_path, args.link_threads, links)
+        print(f"Linked {summary['linked']}, skipped {summary['skipped']}, failed {summary['error']}, "
+              f"already done {summary['resumed']}; reclaimed {format_size(summary['bytes_reclaimed'])}.", file=log)
+
+    progress.finish()
+    progress.print_summary(log)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,22 @@
 import argparse
 import subprocess
 import sys
-import os
 import re
 
-def run_command(command, capture=True, check=True, suppress_output=False):
-    """Runs a shell command, captures output, and handles errors."""
-    if not suppress_output:
-        # Display joined command for logging purposes
-        print(f"Executing: {' '.join(command)}")
+from glob_git_session import GitError, GitSession, RepoSnapshot
+from glob_task_worktrees import DEFAULT_POOL_SIZE, WorktreePool
+
+# First git release with `git merge-tree --write-tree`
+MERGE_TREE_VERSION = (2, 38)
+
+def refresh_snapshot(snapshot, paths=None):
+    """Rescans the given paths (all when None) into the snapshot; returns False if git status failed."""
     try:
-        # Use utf-8 encoding for better compatibility and shell=False for security/quoting
-        process = subprocess.run(command, shell=False, check=check, capture_output=capture, text=True, cwd=os.getcwd(), encoding='utf-8', errors='replace')
-        if not suppress_output:
-            if process.stdout:
-                print("Output:\n", process.stdout.strip())
-            if process.stderr:
-                print("Errors:\n", process.stderr.strip())
-            print(f"Command successful.")
-        return process
-    except subprocess.CalledProcessError as e:
-        stdout = e.stdout.strip() if e.stdout else ""
-        stderr = e.stderr.strip() if e.stderr else ""
-        # Display joined command for logging purposes
-        print(f"Error executing command: {' '.join(command)}")
-        print(f"Return code: {e.returncode}")
-        if stdout:
-            print(f"Output:\n{stdout}")
-        if stderr:
-            print(f"Error output:\n{stderr}")
-        return e # Return the exception object
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-        return None
-
-def get_current_branch():
-    """Gets the current git branch name."""
-    result = run_command(["git", "rev-parse", "--abbrev-ref", "HEAD"], suppress_output=True, check=False) # Don't fail script if git command fails
-    if result and result.returncode == 0 and not isinstance(result, Exception):
-        return result.stdout.strip()
-    print("Warning: Could not determine current git branch.")
-    return None
+        snapshot.refresh(paths)
+        return True
+    except GitError as e:
+        print(f"Warning: Could not refresh git status: {e.stderr.strip()}")
+        return False
 
 def format_complete_commit_message(branch_name, summary):
     """Formats the commit message based on branch name and summary."""
@@ -56,7 +32,149 @@ def format_complete_commit_message(branch_name, summary):
         # Fallback for branches not matching the pattern (e.g., main)
         return f'✔️ Success: {summary}'
 
+def format_merge_commit_message(target_branch, source_branch):
+    """Formats the merge commit message the way `git merge` does."""
+    if target_branch in ('main', 'master'):
+        return f"Merge branch '{source_branch}'"
+    return f"Merge branch '{source_branch}' into {target_branch}"
+
+def merge_without_checkout(git, snapshot, main_branch, branch_to_merge, detach=False):
+    """
+    Merges branch_to_merge into main_branch (--no-ff) without a working-tree merge.
+
+    The merge is computed with `git merge-tree --write-tree`, so conflicts are found
+    before any ref moves. The merge commit is made with commit-tree and main_branch
+    is advanced only if it has not changed meanwhile. The final checkout of
+    main_branch (detached in a Task Set worktree) then only rewrites files the
+    merge brought in from it.
+    """
+    print(f"\nStep 3: Merging '{branch_to_merge}' into '{main_branch}' (merge-tree, no checkout)...")
+    try:
+        target = git.resolve(f"refs/heads/{main_branch}^{{commit}}")
+        source = git.resolve(f"refs/heads/{branch_to_merge}^{{commit}}")
+        if target is None or source is None:
+            print(f"Error: Branch '{main_branch if target is None else branch_to_merge}' not found.")
+            sys.exit(1)
+        target_oid, source_oid = target[0], source[0]
+
+        if git.succeeds(["merge-base", "--is-ancestor", source_oid, target_oid]):
+            print(f"Already up to date: '{branch_to_merge}' is already merged into '{main_branch}'.")
+        else:
+            # Exit status 1 means conflicts; output is the tree, then the conflicted paths
+            merge_tree = git.run(["merge-tree", "--write-tree", "--name-only", "--no-messages", "-z",
+                                  target_oid, source_oid], check=False)
+            if merge_tree.returncode not in (0, 1):
+                raise GitError(merge_tree.args[1:], merge_tree.returncode, merge_tree.stdout, merge_tree.stderr)
+            tree, *conflicts = [field for field in merge_tree.stdout.split("\0") if field]
+            if merge_tree.returncode == 1:
+                print("MERGE CONFLICT DETECTED. No branch was changed.")
+                for path in conflicts:
+                    print(f"  Conflict: {path}")
+                print(f"Please resolve conflicts manually by merging '{branch_to_merge}' into '{main_branch}'.")
+                sys.exit(1)
+
+            merge_message = format_merge_commit_message(main_branch, branch_to_merge)
+            merge_commit = git.output(["commit-tree", tree, "-p", target_oid, "-p", source_oid, "-m", merge_message])
+            git.advance_branch(main_branch, merge_commit, target_oid, f"merge {branch_to_merge}: {merge_message}")
+            print(f"Merge successful: {merge_commit[:7]} {merge_message}")
+    except GitError as e:
+        print(f"Error: Failed to merge branch '{branch_to_merge}': {e.stderr.strip()}")
+        sys.exit(1)
+
+    print(f"\nStep 4: Switching to '{main_branch}' branch...")
+    checkout_main_result = git.run_command(["checkout", "--detach", main_branch] if detach else ["checkout", main_branch])
+    if isinstance(checkout_main_result, subprocess.CalledProcessError) or checkout_main_result is None:
+        print(f"Error: '{main_branch}' was updated but could not be checked out; still on '{branch_to_merge}'.")
+        sys.exit(1)
+    refresh_snapshot(snapshot, snapshot.paths())
+
+def merge_in_worktree(git, snapshot, main_branch, branch_to_merge):
+    """
+    Merges branch_to_merge into main_branch (--no-ff) from a Task Set worktree.
+
+    main_branch is usually checked out in the main worktree, so the merge is made
+    on a detached HEAD at its tip and main_branch is then advanced to the result.
+    Used when git has no `merge-tree --write-tree`.
+    """
+    target = git.resolve(f"refs/heads/{main_branch}^{{commit}}")
+    if target is None:
+        print(f"Error: Branch '{main_branch}' not found.")
+        sys.exit(1)
+    target_oid = target[0]
+
+    print(f"\nStep 3: Detaching worktree at '{main_branch}'...")
+    checkout_main_result = git.run_command(["checkout", "--detach", target_oid])
+    if isinstance(checkout_main_result, subprocess.CalledProcessError) or checkout_main_result is None:
+        print(f"Error: Failed to checkout {main_branch} branch.")
+        git.run_command(["checkout", branch_to_merge], check=False, suppress_output=True)
+        sys.exit(1)
+    refresh_snapshot(snapshot, snapshot.paths())
+
+    print(f"\nStep 4: Merging '{branch_to_merge}' into '{main_branch}'...")
+    merge_message = format_merge_commit_message(main_branch, branch_to_merge)
+    merge_result = git.run_command(["merge", "--no-ff", "-m", merge_message, branch_to_merge])
+    if isinstance(merge_result, subprocess.CalledProcessError) or merge_result is None:
+        print(f"Error: Failed to merge branch '{branch_to_merge}'.")
+        output_text = (merge_result.stdout or "") + (merge_result.stderr or "") if merge_result else ""
+        if "conflict" in output_text.lower():
+             print("MERGE CONFLICT DETECTED. Aborting merge.")
+             git.run_command(["merge", "--abort"], check=False)
+             print(f"Merge aborted. '{main_branch}' was not changed; please resolve conflicts manually.")
+        else:
+             print("Merge failed for an unknown reason.")
+        git.run_command(["checkout", branch_to_merge], check=False, suppress_output=True)
+        sys.exit(1)
+
+    merge_commit = git.resolve("HEAD")[0]
+    if merge_commit != target_oid:
+        try:
+            git.advance_branch(main_branch, merge_commit, target_oid, f"merge {branch_to_merge}: {merge_message}")
+        except GitError as e:
+            print(f"Error: Could not advance '{main_branch}' to the merge: {e.stderr.strip()}")
+            git.run_command(["checkout", branch_to_merge], check=False, suppress_output=True)
+            sys.exit(1)
+    print("Merge successful.")
+    refresh_snapshot(snapshot, snapshot.paths())
+
+def delete_branches_atomically(git, branch_names, branch_oids):
+    """
+    Force-deletes the branches in one `git update-ref --stdin` transaction.
+
+    Each ref is only deleted if it still points at the commit listed earlier, and
+    either every branch is deleted or none is. Branches checked out in another
+    worktree are skipped, as `git branch -D` would refuse them.
+    Returns True if every branch to delete was deleted.
+    """
+    try:
+        checked_out = git.checked_out_branches()
+    except GitError as e:
+        print(f"Warning: Could not list worktrees: {e.stderr.strip()}")
+        return False
+    deletable = []
+    for name in branch_names:
+        if name in checked_out:
+            print(f"Skipping deletion of branch checked out in a worktree: {name}")
+        else:
+            deletable.append(name)
+    if not deletable:
+        return False
+
+    print(f"Force deleting {len(deletable)} branches in one transaction: {', '.join(deletable)}")
+    transaction = "".join(f"delete refs/heads/{name} {branch_oids[name]}\n" for name in deletable)
+    try:
+        git.run(["update-ref", "-m", "complete-task-set: cleanup", "--stdin"], input=transaction)
+    except GitError as e:
+        print(f"Warning: Branch deletion failed, no branch was deleted: {e.stderr.strip()}")
+        return False
+    for name in deletable:
+        print(f"Successfully force deleted branch '{name}'.")
+    return len(deletable) == len(branch_names)
+
 def main():
+    with GitSession() as git:
+        complete_task_set(git)
+
+def complete_task_set(git):
     parser = argparse.ArgumentParser(description="Complete a task set: commit changes, merge to main, and delete the specified branch.")
     parser.add_argument(
         "-s", "--Summary",
@@ -76,11 +194,26 @@ def main():
         default="main",
         help="The name of the main integration branch (default: main)."
     )
+    parser.add_argument(
+        "--no-checkout",
+        action="store_true",
+        help="Merge with `git merge-tree --write-tree` and commit-tree/update-ref instead of a checkout "
+             "and `git merge`, and delete related branches in one update-ref transaction (needs git 2.38+; "
+             "older git falls back to the checkout path)."
+    )
     parser.add_argument(
         "--preserve-branch",
         action="store_true",
         help="Preserve the feature branch (do not delete it after merge)"
     )
+    parser.add_argument(
+        "--worktree",
+        action="store_true",
+        help="Run from inside a pooled Task Set worktree (see glob_start-task-set-branch.py --worktree): "
+             "merge without checking out the main branch there, then return the worktree to the pool."
+    )
+    parser.add_argument("--worktree-dir", default=None, help="Managed directory for the pooled worktrees (default: <repo>.worktrees).")
+    parser.add_argument("--pool-size", type=int, default=DEFAULT_POOL_SIZE, help=f"Idle worktrees kept for reuse (default: {DEFAULT_POOL_SIZE}).")
     args = parser.parse_args()
     summary = args.Summary
     branch_to_merge = args.branch
@@ -88,11 +221,37 @@ def main():
 
     commit_message = format_complete_commit_message(branch_to_merge, summary)
 
+    use_merge_tree = False
+    if args.no_checkout or args.worktree:
+        git_version = git.version()
+        use_merge_tree = git_version >= MERGE_TREE_VERSION
+        if not use_merge_tree:
+            print(f"Note: git {'.'.join(map(str, git_version))} has no `merge-tree --write-tree` (needs "
+                  f"{'.'.join(map(str, MERGE_TREE_VERSION))}); merging with checkout instead.")
+
+    pool = worktree_path = None
+    if args.worktree:
+        try:
+            pool = WorktreePool(git, args.worktree_dir, args.pool_size)
+            worktree_path = git.output(["rev-parse", "--show-toplevel"])
+        except GitError as e:
+            print(f"Error: Could not read worktrees: {e.stderr.strip()}")
+            sys.exit(1)
+        if not pool.contains(worktree_path):
+            print(f"Error: {worktree_path} is not a pooled Task Set worktree under {pool.root}.")
+            sys.exit(1)
+
     print(f"\n--- Completing Task on Branch {branch_to_merge} ---")
     print(f"Summary: {summary}")
     print(f"Main branch is: {main_branch}")
 
-    current_branch = get_current_branch()
+    # One status scan; each step below rescans only the paths it touched
+    try:
+        snapshot = RepoSnapshot(git)
+    except GitError as e:
+        print(f"Error: Could not read git status: {e.stderr.strip()}")
+        sys.exit(1)
+    current_branch = snapshot.branch
     if not current_branch:
         print("Error: Could not determine current git branch. Cannot safely proceed with merge.")
         sys.exit(1)
@@ -101,32 +260,32 @@ def main():
     # Ensure we are on the branch to merge before committing
     if current_branch != branch_to_merge:
          print(f"Switching from '{current_branch}' to branch '{branch_to_merge}' before committing...")
-         checkout_result = run_command(["git", "checkout", branch_to_merge])
+         checkout_result = git.run_command(["checkout", branch_to_merge])
          if isinstance(checkout_result, subprocess.CalledProcessError) or checkout_result is None:
               print(f"Error: Failed to checkout branch '{branch_to_merge}'.")
               # Attempt to switch back if possible
               if current_branch:
-                   run_command(["git", "checkout", current_branch], check=False, suppress_output=True)
+                   git.run_command(["checkout", current_branch], check=False, suppress_output=True)
               sys.exit(1)
          current_branch = branch_to_merge # Update current branch
+         refresh_snapshot(snapshot, snapshot.paths())
 
 
     # 1. Stage changes on the feature branch
     print(f"\nStep 1: Staging changes on branch '{branch_to_merge}'...")
-    stage_result = run_command(["git", "add", "."])
+    stage_result = git.run_command(["add", "."])
     if isinstance(stage_result, subprocess.CalledProcessError) or stage_result is None:
         print("Error: Failed to stage changes.")
         sys.exit(1)
+    status_known = refresh_snapshot(snapshot, snapshot.paths())
 
     # 2. Commit changes on the feature branch
     print(f"\nStep 2: Committing changes on branch '{branch_to_merge}'...")
     # Check if there are changes to commit first
-    status_result = run_command(["git", "status", "--porcelain"], suppress_output=True, check=False)
-    # Check return code and stdout for reliability
-    if status_result and status_result.returncode == 0 and status_result.stdout:
+    if status_known and not snapshot.is_clean():
         print("Changes detected, proceeding with commit.")
         # Use separate arguments for -m and the message to avoid shell interpretation issues
-        commit_result = run_command(["git", "commit", "-m", commit_message])
+        commit_result = git.run_command(["commit", "-m", commit_message])
         if isinstance(commit_result, subprocess.CalledProcessError) or commit_result is None:
             print("Error: Failed to commit changes.")
             # Check if it failed because there was nothing to commit (less reliable check)
@@ -138,12 +297,12 @@ def main():
                  sys.exit(1)
         else:
             print("Commit successful.")
-    elif status_result and status_result.returncode == 0 and not status_result.stdout:
+    elif status_known:
          print("No changes staged to commit.")
     else:
          print("Warning: Could not reliably determine git status before commit.")
          print("Attempting commit anyway...")
-         commit_result = run_command(["git", "commit", "-m", commit_message], check=False)
+         commit_result = git.run_command(["commit", "-m", commit_message], check=False)
          if commit_result and commit_result.returncode != 0:
               # Check if it failed because there was nothing to commit
               output_text = (commit_result.stdout or "") + (commit_result.stderr or "")
@@ -157,36 +316,45 @@ def main():
          else: # Includes None case
               print("Error: Commit attempt failed or status unknown.")
               sys.exit(1)
+    # The commit only changed what was staged; rescan everything if that was unknown
+    refresh_snapshot(snapshot, snapshot.staged_paths() if status_known else None)
 
+    # 3-4. Merge the feature branch into main
+    if use_merge_tree:
+        merge_without_checkout(git, snapshot, main_branch, branch_to_merge, detach=args.worktree)
+    elif args.worktree:
+        merge_in_worktree(git, snapshot, main_branch, branch_to_merge)
+    else:
+        # 3. Checkout main branch
+        print(f"\nStep 3: Checking out '{main_branch}' branch...")
+        checkout_main_result = git.run_command(["checkout", main_branch])
+        if isinstance(checkout_main_result, subprocess.CalledProcessError) or checkout_main_result is None:
+            print(f"Error: Failed to checkout {main_branch} branch.")
+            # Attempt to switch back to original branch before exiting
+            git.run_command(["checkout", current_branch], check=False, suppress_output=True)
+            sys.exit(1)
+        refresh_snapshot(snapshot, snapshot.paths())
 
-    # 3. Checkout main branch
-    print(f"\nStep 3: Checking out '{main_branch}' branch...")
-    checkout_main_result = run_command(["git", "checkout", main_branch])
-    if isinstance(checkout_main_result, subprocess.CalledProcessError) or checkout_main_result is None:
-        print(f"Error: Failed to checkout {main_branch} branch.")
-        # Attempt to switch back to original branch before exiting
-        run_command(["git", "checkout", current_branch], check=False, suppress_output=True)
-        sys.exit(1)
-
-    # 4. Merge the feature branch into main
-    print(f"\nStep 4: Merging '{branch_to_merge}' into '{main_branch}'...")
-    # Use --no-ff to ensure a merge commit is always created for task set history
-    merge_result = run_command(["git", "merge", "--no-ff", branch_to_merge])
-    if isinstance(merge_result, subprocess.CalledProcessError) or merge_result is None:
-        print(f"Error: Failed to merge branch '{branch_to_merge}'.")
-        # Check for merge conflicts
-        output_text = (merge_result.stdout or "") + (merge_result.stderr or "")
-        if "conflict" in output_text.lower():
-             print("MERGE CONFLICT DETECTED. Aborting merge.")
-             run_command(["git", "merge", "--abort"], check=False) # Attempt to abort
-             print(f"Merge aborted. Please resolve conflicts manually on branch '{main_branch}'.")
+        # 4. Merge the feature branch into main
+        print(f"\nStep 4: Merging '{branch_to_merge}' into '{main_branch}'...")
+        # Use --no-ff to ensure a merge commit is always created for task set history
+        merge_result = git.run_command(["merge", "--no-ff", branch_to_merge])
+        if isinstance(merge_result, subprocess.CalledProcessError) or merge_result is None:
+            print(f"Error: Failed to merge branch '{branch_to_merge}'.")
+            # Check for merge conflicts
+            output_text = (merge_result.stdout or "") + (merge_result.stderr or "")
+            if "conflict" in output_text.lower():
+                 print("MERGE CONFLICT DETECTED. Aborting merge.")
+                 git.run_command(["merge", "--abort"], check=False) # Attempt to abort
+                 print(f"Merge aborted. Please resolve conflicts manually on branch '{main_branch}'.")
+            else:
+                 print("Merge failed for an unknown reason.")
+            # Attempt to switch back to original branch before exiting
+            git.run_command(["checkout", current_branch], check=False, suppress_output=True)
+            sys.exit(1)
         else:
-             print("Merge failed for an unknown reason.")
-        # Attempt to switch back to original branch before exiting
-        run_command(["git", "checkout", current_branch], check=False, suppress_output=True)
-        sys.exit(1)
-    else:
-        print("Merge successful.")
+            print("Merge successful.")
+            refresh_snapshot(snapshot, snapshot.paths())
 
     # 5. Clean up branches by default (unless --preserve-branch is set)
     if not args.preserve_branch and branch_to_merge != main_branch:
@@ -196,16 +364,19 @@ def main():
         base_branch_name = re.sub(r'_attempt-\d+$', '', branch_to_merge)
         print(f"Base identifier for cleanup: {base_branch_name}")
 
-        # List all local branches
-        list_all_result = run_command(["git", "branch"], capture=True)
-        if not list_all_result or list_all_result.returncode != 0:
+        # List the base branch and its attempt branches in one for-each-ref call
+        try:
+            related_branches = git.branches(base_branch_name, f"{base_branch_name}_attempt-*")
+        except GitError as e:
+            related_branches = None
+            print(f"Error listing branches: {e.stderr.strip()}")
+        if related_branches is None:
             print("Warning: Could not list local branches. Skipping cleanup of related branches.")
         else:
-            all_local_branches = [b.strip('* ').strip() for b in list_all_result.stdout.splitlines()]
             branches_to_delete = []
 
             # Identify base branch and all attempt branches for this Task Set
-            for local_branch in all_local_branches:
+            for local_branch in sorted(related_branches):
                 if local_branch == base_branch_name or re.match(rf"^{re.escape(base_branch_name)}_attempt-\d+$", local_branch):
                      # Ensure we don't try to delete the branch we are currently on (should be main)
                      if local_branch != main_branch: # Check against main_branch variable
@@ -215,24 +386,27 @@ def main():
 
             if branches_to_delete:
                 print(f"Found {len(branches_to_delete)} related branches to force delete:")
-                all_deleted_successfully = True
-                for branch_to_del in branches_to_delete:
-                    print(f"Force deleting branch '{branch_to_del}'...")
-                    # Use force delete (-D)
-                    del_result = run_command(["git", "branch", "-D", branch_to_del])
-                    if isinstance(del_result, subprocess.CalledProcessError) or del_result is None:
-                        print(f"Warning: Failed to force delete branch '{branch_to_del}'.")
-                        if del_result and hasattr(del_result, 'stderr'):
-                            # Check if error is just "not found" which is okay
-                            if "not found" not in del_result.stderr.lower():
-                                 print(f"Error: {del_result.stderr.strip()}")
-                                 all_deleted_successfully = False
+                if args.no_checkout or args.worktree:
+                    all_deleted_successfully = delete_branches_atomically(git, branches_to_delete, related_branches)
+                else:
+                    all_deleted_successfully = True
+                    for branch_to_del in branches_to_delete:
+                        print(f"Force deleting branch '{branch_to_del}'...")
+                        # Use force delete (-D)
+                        del_result = git.run_command(["branch", "-D", branch_to_del])
+                        if isinstance(del_result, subprocess.CalledProcessError) or del_result is None:
+                            print(f"Warning: Failed to force delete branch '{branch_to_del}'.")
+                            if del_result and hasattr(del_result, 'stderr'):
+                                # Check if error is just "not found" which is okay
+                                if "not found" not in del_result.stderr.lower():
+                                     print(f"Error: {del_result.stderr.strip()}")
+                                     all_deleted_successfully = False
+                                else:
+                                     print(f"(Branch '{branch_to_del}' likely already deleted)")
                             else:
-                                 print(f"(Branch '{branch_to_del}' likely already deleted)")
+                                 all_deleted_successfully = False # Unknown error
                         else:
-                             all_deleted_successfully = False # Unknown error
-                    else:
-                        print(f"Successfully force deleted branch '{branch_to_del}'.")
+                            print(f"Successfully force deleted branch '{branch_to_del}'.")
                 if not all_deleted_successfully:
                      print("Warning: One or more related branches could not be deleted.")
             else:
@@ -250,7 +424,15 @@ def main():
 
     # Print final git status
     print("\nFinal git status:")
-    run_command(["git", "status"], check=False)
+    print(snapshot.render())
+
+    if pool:
+        try:
+            kept = pool.release(worktree_path)
+        except GitError as e:
+            print(f"Warning: Could not release worktree {worktree_path}: {e.stderr.strip()}")
+        else:
+            print(f"\nWorktree {worktree_path} {'returned to the pool' if kept else 'removed (pool is full)'}.")
     sys.exit(0)
 
 if __name__ == "__main__":
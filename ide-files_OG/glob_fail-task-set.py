@@ -1,37 +1,13 @@
-import subprocess
 import argparse
 import sys
 import os
 import shutil
 import tempfile
 import re
-# Removed: from components.confirmation_popup import show_confirmation
-
-def get_current_branch():
-    """Gets the current git branch name."""
-    try:
-        result = subprocess.run(['git', 'rev-parse', '--abbrev-ref', 'HEAD'],
-                               capture_output=True, text=True, check=True)
-        return result.stdout.strip()
-    except subprocess.CalledProcessError as e:
-        print(f"Error detecting current branch: {e}")
-        sys.exit(1)
 
-def get_all_changed_files():
-    """Gets a list of all modified (tracked) and untracked files."""
-    try:
-        # Get modified tracked files
-        modified_result = subprocess.run(['git', 'ls-files', '-m'],
-                                         capture_output=True, text=True, check=True)
-        # Get untracked files
-        untracked_result = subprocess.run(['git', 'ls-files', '--others', '--exclude-standard'],
-                                          capture_output=True, text=True, check=True)
-
-        all_files = modified_result.stdout.splitlines() + untracked_result.stdout.splitlines()
-        return all_files
-    except subprocess.CalledProcessError as e:
-        print(f"Error getting changed files: {e}")
-        sys.exit(1)
+from glob_git_session import GitError, GitSession, RepoSnapshot
+from glob_task_worktrees import DEFAULT_POOL_SIZE, WorktreePool
+# Removed: from components.confirmation_popup import show_confirmation
 
 def format_fail_commit_message(branch_name, reason):
     """Formats the commit message based on branch name and failure reason."""
@@ -47,6 +23,19 @@ def format_fail_commit_message(branch_name, reason):
         # Fallback for branches not matching the pattern (e.g., main)
         return f'❌ Cleanup after task failure: {reason}'
 
+def format_preserved_commit_message(branch_name, pr_count):
+    """Formats the main-branch commit message for the preserved PR files."""
+    # Use branch name to get OG/TS/Attempt numbers
+    match = re.match(r'^OG-(\d+)_TS-(\d+)(_attempt-(\d+))?$', branch_name or '')
+    if match:
+        og_number = match.group(1)
+        task_set_number = match.group(2)
+        attempt_number = match.group(4) if match.group(4) else '1'
+        return f"OG-{og_number} TS-{task_set_number} Attempt-{attempt_number}: ❌ Failed. [{pr_count}] PRs preserved."
+    else:
+        # Fallback if not on a task branch
+        return "❌ Failed. Generic branch cleanup complete."
+
 def filter_needed_files(files):
     """Filters the list for .md files NOT matching the _##_OG_ pattern."""
     # Pattern matches filenames starting with _##_OG_ and ending with .md
@@ -96,7 +85,8 @@ def restore_files_from_temp(original_to_temp_map):
         try:
             # Ensure the original destination directory exists
             original_dir = os.path.dirname(original_path)
-            os.makedirs(original_dir, exist_ok=True)
+            if original_dir: # Files in the current directory need no parent created
+                os.makedirs(original_dir, exist_ok=True)
 
             # Move the file back
             if os.path.exists(temp_path): # Ensure temp file exists
@@ -108,7 +98,135 @@ def restore_files_from_temp(original_to_temp_map):
         except Exception as e:
             print(f"Error restoring {original_path} from {temp_path}: {e}")
 
+def commit_files_to_branch(git, branch, files, message, top=''):
+    """
+    Commits the work-tree contents of files on top of branch without a checkout.
+
+    files are relative to the top of the work tree (as status reports them) and
+    top is the path from the current directory to it (`rev-parse --show-cdup`).
+
+    The commit is built in a temporary index (GIT_INDEX_FILE) seeded from the
+    branch tip, so neither the work tree nor the real index is touched. The
+    branch only moves if it still points at the commit the tree was built on
+    (and is fast-forwarded in place if a worktree has it checked out).
+    Returns the new commit ID, or None if the files already match the branch.
+    """
+    parent = git.resolve(f"refs/heads/{branch}^{{commit}}")
+    if parent is None:
+        raise GitError(['rev-parse', branch], 1, stderr=f"branch '{branch}' not found")
+    parent_oid = parent[0]
+
+    index_dir = tempfile.mkdtemp(prefix='git_fail_index_')
+    try:
+        env = {'GIT_INDEX_FILE': os.path.join(index_dir, 'index')}
+        git.run(['read-tree', parent_oid], env=env)
+        # One hash-object for every file; clean filters and eol conversion apply as for `git add`.
+        # It is run from the top, since --stdin-paths does not resolve paths against a subdirectory
+        work_paths = [os.path.join(top, path) for path in files]
+        oids = git.output([*(['-C', top] if top else []), 'hash-object', '-w', '--stdin-paths'],
+                          input="\n".join(files) + "\n").splitlines()
+        entries = []
+        for path, work_path, oid in zip(files, work_paths, oids):
+            mode = '100755' if os.name != 'nt' and os.access(work_path, os.X_OK) else '100644'
+            entries.append(f"{mode} {oid}\t{path}\0")
+        git.run(['update-index', '--add', '-z', '--index-info'], input="".join(entries), env=env)
+        tree = git.output(['write-tree'], env=env)
+    finally:
+        shutil.rmtree(index_dir, ignore_errors=True)
+
+    if tree == git.resolve(f"{parent_oid}^{{tree}}")[0]:
+        return None
+    commit = git.output(['commit-tree', tree, '-p', parent_oid, '-m', message])
+    git.advance_branch(branch, commit, parent_oid, f"fail-task-set: {message}")
+    return commit
+
+def fail_task_set_without_checkout(git, args, pool=None, worktree_path=None):
+    """
+    Failure cleanup that commits the preserved files to main with plumbing, then switches once.
+
+    In a pooled Task Set worktree the switch detaches at main and the worktree
+    is then returned to the pool (or removed if the pool is full).
+    """
+    # Only .md files can be preserved, so only they are scanned
+    snapshot = RepoSnapshot(git, pathspecs=['*.md'])
+    current_branch = snapshot.branch or 'HEAD' # Detached HEAD reads as 'HEAD', like rev-parse --abbrev-ref
+    main_branch = args.main_branch
+    branch_to_delete = current_branch if current_branch != main_branch else None
+
+    print("1. Getting list of changed .md files...")
+    changed_md_files = snapshot.modified_files() + snapshot.untracked_files()
+    if not changed_md_files:
+        print("No modified or untracked .md files found.")
+    else:
+        print(f"  Found changed files: {changed_md_files}")
+
+    print("2. Committing all changes...")
+    git.run(['add', '.'], check=True)
+    # Compares the index with HEAD only; the work tree was just scanned by `add`
+    if not git.succeeds(['diff', '--staged', '--quiet']):
+        print("  Creating commit...")
+        commit_message = format_fail_commit_message(current_branch, args.r)
+        git.run(['commit', '-m', commit_message], check=True)
+        snapshot.refresh(snapshot.paths())
+        print(f"  Committed with message: '{commit_message}'")
+    else:
+        print("  No changes staged for commit.")
+
+    print("3. Identifying needed files to preserve...")
+    needed_files = filter_needed_files(changed_md_files)
+    if needed_files:
+        print(f"  Needed files: {needed_files}")
+    else:
+        print("  No specific .md files need preservation.")
+
+    print(f"4. Committing preserved files on {main_branch} branch (temporary index, no checkout)...")
+    top = git.output(['rev-parse', '--show-cdup']) # Status paths are relative to the top of the work tree
+    preserved_files = [path for path in needed_files if os.path.isfile(os.path.join(top, path))] # Deleted files are not preserved
+    commit_message_restore = format_preserved_commit_message(branch_to_delete, len(preserved_files))
+    if preserved_files and commit_files_to_branch(git, main_branch, preserved_files, commit_message_restore, top):
+        print(f"  Successfully committed preserved files with message: '{commit_message_restore}'")
+    else:
+        print(f"  No preserved files to commit on '{main_branch}'.")
+
+    if pool:
+        # main is checked out in the main worktree; the preserved files stay in place here too
+        print(f"5. Detaching worktree at {main_branch}...")
+        git.run(['checkout', '--detach', main_branch], check=True)
+        snapshot.refresh(snapshot.paths())
+        print(f"  Successfully detached at '{main_branch}'.")
+    elif current_branch != main_branch:
+        # The preserved files are identical on both sides, so the switch leaves them in place
+        print(f"5. Switching to {main_branch} branch...")
+        git.run(['checkout', main_branch], check=True)
+        snapshot.refresh(snapshot.paths())
+        print(f"  Successfully checked out '{main_branch}'.")
+    else:
+        print(f"5. Already on '{main_branch}'.")
+
+    if args.delete_branch and branch_to_delete:
+        print(f"6. Deleting branch {branch_to_delete} (--delete-branch flag set)...")
+        git.run(['branch', '-D', branch_to_delete], check=True)
+        print(f"  Successfully deleted branch '{branch_to_delete}'.")
+    elif args.delete_branch:
+         print(f"6. Skipping branch deletion (already on '{main_branch}' or no branch to delete, despite --delete-branch flag).")
+    else:
+         print("6. Preserving branch (default behavior).")
+
+    print("\nOperation completed successfully!")
+
+    # Show final git status
+    print("\nFinal git status (.md files):")
+    print(snapshot.render())
+
+    if pool:
+        kept = pool.release(worktree_path)
+        print(f"\nWorktree {worktree_path} {'returned to the pool' if kept else 'removed (pool is full)'}.")
+
 def main():
+    with GitSession() as git:
+        fail_task_set(git)
+
+def fail_task_set(git):
     parser = argparse.ArgumentParser(description='Clean up after failed task')
     parser.add_argument('--r', required=False, default="No reason provided", help='Failure Reason: (default: "No reason provided")')
     parser.add_argument('--delete-branch', action='store_true', help='Delete the branch after cleanup (default is to preserve)')
@@ -118,15 +236,48 @@ def main():
         default="main",
         help="The name of the main integration branch (default: main)."
     )
+    parser.add_argument(
+        "--no-checkout",
+        action="store_true",
+        help="Commit the preserved files to the main branch with git plumbing in a temporary index, "
+             "then switch branches once (no moving files out and back around a checkout)."
+    )
+    parser.add_argument(
+        "--worktree",
+        action="store_true",
+        help="Run from inside a pooled Task Set worktree (see glob_start-task-set-branch.py --worktree): "
+             "clean up as with --no-checkout, then return the worktree to the pool."
+    )
+    parser.add_argument("--worktree-dir", default=None, help="Managed directory for the pooled worktrees (default: <repo>.worktrees).")
+    parser.add_argument("--pool-size", type=int, default=DEFAULT_POOL_SIZE, help=f"Idle worktrees kept for reuse (default: {DEFAULT_POOL_SIZE}).")
     args = parser.parse_args()
 
     try:
-        current_branch = get_current_branch()
+        if args.worktree:
+            pool = WorktreePool(git, args.worktree_dir, args.pool_size)
+            worktree_path = git.output(['rev-parse', '--show-toplevel'])
+            if not pool.contains(worktree_path):
+                print(f"Error: {worktree_path} is not a pooled Task Set worktree under {pool.root}.")
+                sys.exit(1)
+            fail_task_set_without_checkout(git, args, pool, worktree_path)
+            sys.exit(0)
+        if args.no_checkout:
+            fail_task_set_without_checkout(git, args)
+            sys.exit(0)
+
+        # One status scan gives the branch and the changed files; each step below
+        # rescans only the paths it touched
+        snapshot = RepoSnapshot(git)
+        current_branch = snapshot.branch or 'HEAD' # Detached HEAD reads as 'HEAD', like rev-parse --abbrev-ref
         main_branch = args.main_branch # Use the provided main branch name
         branch_to_delete = current_branch if current_branch != main_branch else None
 
         print("1. Getting list of all changed files...")
-        all_changed_files = get_all_changed_files()
+        # Same files as `git ls-files -m` plus `git ls-files --others --exclude-standard`: status paths are
+        # relative to the top of the work tree, ls-files lists the current directory relative to itself
+        prefix = git.output(['rev-parse', '--show-prefix'])
+        all_changed_files = [path[len(prefix):] for path in snapshot.modified_files() + snapshot.untracked_files()
+                             if path.startswith(prefix)]
         if not all_changed_files:
             print("No modified or untracked files found.")
         else:
@@ -134,14 +285,15 @@ def main():
 
         print("2. Committing all changes...")
         if all_changed_files:
-             # Check if there's anything to commit (git status --porcelain)
-            status_result = subprocess.run(['git', 'status', '--porcelain'], capture_output=True, text=True, check=True)
-            if status_result.stdout.strip():
+             # Check if there's anything to commit (same scan as step 1)
+            if not snapshot.is_clean():
                 print("  Staging all changes...")
-                subprocess.run(['git', 'add', '.'], check=True)
+                git.run(['add', '.'], check=True)
+                snapshot.refresh(snapshot.paths())
                 print("  Creating commit...")
                 commit_message = format_fail_commit_message(current_branch, args.r)
-                subprocess.run(['git', 'commit', '-m', commit_message], check=True)
+                git.run(['commit', '-m', commit_message], check=True)
+                snapshot.refresh(snapshot.staged_paths())
                 print(f"  Committed with message: '{commit_message}'")
             else:
                 print("  No changes staged for commit.")
@@ -162,14 +314,16 @@ def main():
             temp_dir = tempfile.mkdtemp(prefix='git_fail_')
             print(f"  Created temp directory: {temp_dir}")
             original_to_temp_map = move_files_to_temp(needed_files, temp_dir)
+            snapshot.refresh([prefix + path for path in original_to_temp_map])
 
         print(f"5. Checking out {main_branch} branch...")
-        subprocess.run(['git', 'checkout', main_branch], check=True)
+        git.run(['checkout', main_branch], check=True)
+        snapshot.refresh(snapshot.paths())
         print(f"  Successfully checked out '{main_branch}'.")
 
         if args.delete_branch and branch_to_delete:
             print(f"6. Deleting branch {branch_to_delete} (--delete-branch flag set)...")
-            subprocess.run(['git', 'branch', '-D', branch_to_delete], check=True)
+            git.run(['branch', '-D', branch_to_delete], check=True)
             print(f"  Successfully deleted branch '{branch_to_delete}'.")
         elif args.delete_branch:
              print(f"6. Skipping branch deletion (already on '{main_branch}' or no branch to delete, despite --delete-branch flag).")
@@ -179,29 +333,20 @@ def main():
         if original_to_temp_map:
             print("7. Restoring needed files...")
             restore_files_from_temp(original_to_temp_map)
+            snapshot.refresh([prefix + path for path in original_to_temp_map])
             print("  Finished restoring files.")
         else:
             print("7. No files to restore.")
 
         print("8. Committing restored files on main branch...")
         # Stage any restored files (or other changes if any)
-        subprocess.run(['git', 'add', '.'], check=True)
+        git.run(['add', '.'], check=True)
+        snapshot.refresh(snapshot.paths())
         # Check if there's anything staged to commit
-        status_result_after_restore = subprocess.run(['git', 'diff', '--staged', '--quiet'], check=False) # check=False as it returns 1 if there are staged changes
-        if status_result_after_restore.returncode == 1:
-            # Use branch name to get OG/TS/Attempt numbers
-            match = re.match(r'^OG-(\d+)_TS-(\d+)(_attempt-(\d+))?$', branch_to_delete or '')
-            if match:
-                og_number = match.group(1)
-                task_set_number = match.group(2)
-                attempt_number = match.group(4) if match.group(4) else '1'
-                # Count preserved PR files
-                pr_count = len(original_to_temp_map)
-                commit_message_restore = f"OG-{og_number} TS-{task_set_number} Attempt-{attempt_number}: ❌ Failed. [{pr_count}] PRs preserved."
-            else:
-                # Fallback if not on a task branch
-                commit_message_restore = "❌ Failed. Generic branch cleanup complete."
-            subprocess.run(['git', 'commit', '-m', commit_message_restore], check=True)
+        if snapshot.has_staged_changes():
+            commit_message_restore = format_preserved_commit_message(branch_to_delete, len(original_to_temp_map))
+            git.run(['commit', '-m', commit_message_restore], check=True)
+            snapshot.refresh(snapshot.staged_paths())
             print(f"  Successfully committed restored files with message: '{commit_message_restore}'")
         else:
             print("  No restored files staged for commit.")
@@ -219,11 +364,11 @@ def main():
 
         # Show final git status
         print("\nFinal git status:")
-        subprocess.run(['git', 'status'], check=False)
+        print(snapshot.render())
 
         sys.exit(0)
 
-    except subprocess.CalledProcessError as e:
+    except GitError as e:
         print(f"Error: {e}")
         sys.exit(1)
     except Exception as e:
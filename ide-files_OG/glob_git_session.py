@@ -0,0 +1,506 @@
+"""
+Shared git access for the glob_* Task Set scripts.
+
+Each script opens one GitSession and sends every git call through it, so that:
+  - values are read in bulk where git allows it (one `for-each-ref` for many
+    branches, one `status --porcelain=v2 --branch -z` for the branch, HEAD and
+    every changed path) instead of one process per question;
+  - objects and revisions are read through long-lived `git cat-file --batch`
+    and `--batch-check` processes instead of a `git` spawn per lookup;
+  - a RepoSnapshot parses that status once and is kept current by rescanning
+    only the paths each step touched, and renders the human-readable status
+    instead of another full `git status`;
+  - every git call is timed. A summary is printed to stderr when the session
+    closes; set GLOB_GIT_TRACE=1 to also log each call as it finishes.
+
+Commands are always passed as argument lists (never through a shell).
+
+Usage:
+    from glob_git_session import GitSession, RepoSnapshot
+
+    with GitSession() as git:
+        snapshot = RepoSnapshot(git)
+        print(snapshot.render())
+"""
+
+import os
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+# Above this many paths a snapshot refresh rescans everything instead of passing
+# each path on the command line (which also stays well under the Windows limit)
+REFRESH_PATH_LIMIT = 200
+
+# `git status` labels for the porcelain status letters
+CHANGE_LABELS = {"M": "modified:", "T": "typechange:", "A": "new file:", "D": "deleted:",
+                 "R": "renamed:", "C": "copied:"}
+UNMERGED_LABELS = {"DD": "both deleted:", "AU": "added by us:", "UD": "deleted by them:",
+                   "UA": "added by them:", "DU": "deleted by us:", "AA": "both added:",
+                   "UU": "both modified:"}
+
+
+class GitError(Exception):
+    """A git command exited with a non-zero status."""
+
+    def __init__(self, args, returncode, stdout="", stderr=""):
+        self.args_list = list(args)
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        super().__init__(f"git {' '.join(self.args_list)} failed with exit code {returncode}: {stderr.strip()}")
+
+
+# One changed path from `git status --porcelain=v2`.
+#   kind: "1" (changed), "2" (renamed or copied), "u" (unmerged), "?" (untracked), "!" (ignored)
+#   xy: two-letter index/work-tree status ("??" for untracked, "!!" for ignored)
+#   orig_path: source path of a rename or copy, else None
+StatusEntry = namedtuple("StatusEntry", ["kind", "xy", "path", "orig_path"])
+
+# Parsed `git status --porcelain=v2 --branch -z`.
+#   oid: commit checked out (None before the first commit)
+#   branch: checked-out branch (None when HEAD is detached)
+#   upstream, ahead, behind: tracking information (None/0 when there is no upstream)
+Status = namedtuple("Status", ["oid", "branch", "upstream", "ahead", "behind", "entries"])
+
+# One entry of `git worktree list --porcelain` (the main worktree comes first).
+#   head: commit checked out (None for a bare repository)
+#   branch: checked-out branch, or None when detached
+#   locked: lock reason ("" if locked without one), or None when not locked
+Worktree = namedtuple("Worktree", ["path", "head", "branch", "locked"])
+
+
+def parse_status_v2(output):
+    """Parse `git status --porcelain=v2 --branch -z` output (str) into a Status."""
+    oid = branch = upstream = None
+    ahead = behind = 0
+    entries = []
+    records = iter(output.split("\0"))
+    for record in records:
+        if not record:
+            continue
+        kind = record[0]
+        if kind == "#":
+            _, key, value = record.split(" ", 2)
+            if key == "branch.oid":
+                oid = None if value == "(initial)" else value
+            elif key == "branch.head":
+                branch = None if value == "(detached)" else value
+            elif key == "branch.upstream":
+                upstream = value
+            elif key == "branch.ab":
+                ahead_text, behind_text = value.split(" ")
+                ahead, behind = int(ahead_text), -int(behind_text)
+        elif kind == "1":
+            fields = record.split(" ", 8)
+            entries.append(StatusEntry(kind, fields[1], fields[8], None))
+        elif kind == "2":
+            fields = record.split(" ", 9)
+            # The rename or copy source follows as its own NUL-terminated field
+            entries.append(StatusEntry(kind, fields[1], fields[9], next(records, None)))
+        elif kind == "u":
+            fields = record.split(" ", 10)
+            entries.append(StatusEntry(kind, fields[1], fields[10], None))
+        elif kind in "?!":
+            entries.append(StatusEntry(kind, kind * 2, record[2:], None))
+    return Status(oid, branch, upstream, ahead, behind, entries)
+
+
+class GitSession:
+    """Timed access to one repository, with bulk reads and persistent cat-file processes."""
+
+    def __init__(self, cwd=None, trace=None):
+        self.cwd = cwd or os.getcwd()
+        self.trace = os.environ.get("GLOB_GIT_TRACE") == "1" if trace is None else trace
+        # (command, seconds, exit code) for every git call made
+        self.timings = []
+        self._batch = None
+        self._batch_check = None
+        self._version = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _record(self, args, started, returncode):
+        elapsed = time.perf_counter() - started
+        self.timings.append((" ".join(args), elapsed, returncode))
+        if self.trace:
+            print(f"[git {elapsed * 1000:7.1f} ms] {' '.join(args)} (exit {returncode})", file=sys.stderr)
+
+    def run(self, args, check=True, input=None, env=None):
+        """
+        Run `git <args>` and return the CompletedProcess (text mode, utf-8).
+
+        Raises GitError on a non-zero exit when check is true. `env` entries are
+        added to the current environment.
+        """
+        started = time.perf_counter()
+        process = subprocess.run(
+            ["git", *args], cwd=self.cwd, input=input, capture_output=True, text=True,
+            encoding="utf-8", errors="replace", env=dict(os.environ, **env) if env else None)
+        self._record(args, started, process.returncode)
+        if check and process.returncode != 0:
+            raise GitError(args, process.returncode, process.stdout, process.stderr)
+        return process
+
+    def output(self, args, check=True, **kwargs):
+        """Run `git <args>` and return its stripped stdout."""
+        return self.run(args, check=check, **kwargs).stdout.strip()
+
+    def succeeds(self, args):
+        """Run `git <args>` and return whether it exited with status 0."""
+        return self.run(args, check=False).returncode == 0
+
+    def run_command(self, args, check=True, suppress_output=False):
+        """
+        Run `git <args>` with the console logging the glob_* scripts use.
+
+        Prints the command and its output unless suppress_output is set.
+
+        Returns:
+            The CompletedProcess, or the CalledProcessError when the command
+            fails and check is true (callers test for it instead of catching),
+            or None if git could not be run at all.
+        """
+        command_str = " ".join(["git", *args])
+        if not suppress_output:
+            print(f"Executing: {command_str}")
+        try:
+            process = self.run(args, check=False)
+        except OSError as e:
+            print(f"An unexpected error occurred: {e}")
+            return None
+        if check and process.returncode != 0:
+            print(f"Error executing command: {command_str}")
+            print(f"Return code: {process.returncode}")
+            if process.stdout.strip():
+                print(f"Output:\n{process.stdout.strip()}")
+            if process.stderr.strip():
+                print(f"Error output:\n{process.stderr.strip()}")
+            return subprocess.CalledProcessError(process.returncode, ["git", *args], process.stdout, process.stderr)
+        if not suppress_output:
+            if process.stdout:
+                print("Output:\n", process.stdout.strip())
+            if process.stderr:
+                print("Errors:\n", process.stderr.strip())
+            print("Command successful.")
+        return process
+
+    def status(self, paths=(), untracked="all"):
+        """
+        Read the branch, HEAD and every changed path in one status call.
+
+        Args:
+            paths: Optional pathspecs limiting the entries returned
+            untracked: --untracked-files mode ("all", "normal" or "no")
+
+        Returns:
+            Status
+        """
+        args = ["status", "--porcelain=v2", "--branch", "-z", f"--untracked-files={untracked}"]
+        if paths:
+            args += ["--", *paths]
+        return parse_status_v2(self.run(args).stdout)
+
+    def version(self):
+        """The git version as a tuple of ints, e.g. (2, 43, 0); read once per session."""
+        if self._version is None:
+            # "git version 2.43.0" or "git version 2.39.2.windows.1"
+            numbers = self.output(["version"]).split()[2].split(".")
+            self._version = tuple(int(number) for number in numbers[:3] if number.isdigit())
+        return self._version
+
+    def worktrees(self):
+        """Every worktree of the repository, from one `worktree list --porcelain` call."""
+        worktrees = []
+        for record in self.output(["worktree", "list", "--porcelain"]).split("\n\n"):
+            fields = {}
+            for line in record.splitlines():
+                key, _, value = line.partition(" ")
+                fields[key] = value
+            if "worktree" not in fields:
+                continue
+            branch = fields.get("branch")
+            if branch and branch.startswith("refs/heads/"):
+                branch = branch[len("refs/heads/"):]
+            worktrees.append(Worktree(os.path.normpath(fields["worktree"]), fields.get("HEAD"), branch, fields.get("locked")))
+        return worktrees
+
+    def checked_out_branches(self):
+        """Names of the branches checked out in any worktree of the repository."""
+        return {worktree.branch for worktree in self.worktrees() if worktree.branch}
+
+    def advance_branch(self, branch, new_oid, old_oid, message=None):
+        """
+        Move a branch from old_oid to new_oid, failing if it no longer points at old_oid.
+
+        A branch checked out in some worktree is fast-forwarded there with
+        `merge --ff-only`, so that worktree's index and files follow the ref
+        instead of being left behind by a bare update-ref.
+        """
+        for worktree in self.worktrees():
+            if worktree.branch == branch:
+                if worktree.head != old_oid:
+                    raise GitError(["update-ref", f"refs/heads/{branch}"], 1,
+                                   stderr=f"'{branch}' moved from {old_oid[:7]} to {worktree.head[:7]}")
+                self.run(["-C", worktree.path, "merge", "--ff-only", "--quiet", new_oid])
+                return
+        self.run(["update-ref", "-m", message or f"advance {branch}", f"refs/heads/{branch}", new_oid, old_oid])
+
+    def current_branch(self):
+        """Checked-out branch name, or None when HEAD is detached (no work tree scan)."""
+        return self.output(["symbolic-ref", "--quiet", "--short", "HEAD"], check=False) or None
+
+    def refs(self, *patterns):
+        """
+        Map every ref matching the for-each-ref patterns to its object ID, in one call.
+
+        Patterns are ref prefixes or globs, e.g. "refs/heads/OG-12_TS-3*".
+        """
+        output = self.run(["for-each-ref", "--format=%(refname)%00%(objectname)", *patterns]).stdout
+        refs = {}
+        for line in output.splitlines():
+            name, _, oid = line.partition("\0")
+            refs[name] = oid
+        return refs
+
+    def branches(self, *patterns):
+        """Map local branch names matching the glob patterns (all if none) to commit IDs."""
+        prefix = "refs/heads/"
+        found = self.refs(*([prefix + pattern for pattern in patterns] or [prefix]))
+        return {name[len(prefix):]: oid for name, oid in found.items()}
+
+    def _cat_file(self, mode):
+        """Start (once) and return a `git cat-file <mode>` process."""
+        attribute = "_batch" if mode == "--batch" else "_batch_check"
+        process = getattr(self, attribute)
+        if process is None:
+            started = time.perf_counter()
+            process = subprocess.Popen(["git", "cat-file", mode], cwd=self.cwd,
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._record(["cat-file", mode, "(start)"], started, 0)
+            setattr(self, attribute, process)
+        return process
+
+    def resolve(self, revision):
+        """
+        Look up a revision through the persistent `cat-file --batch-check` process.
+
+        Returns:
+            (object ID, object type, size), or None if the revision does not exist
+        """
+        started = time.perf_counter()
+        process = self._cat_file("--batch-check")
+        process.stdin.write(revision.encode("utf-8") + b"\n")
+        process.stdin.flush()
+        header = process.stdout.readline().decode("utf-8").split()
+        self._record(["cat-file", "--batch-check", revision], started, 0)
+        if len(header) != 3:
+            return None
+        return header[0], header[1], int(header[2])
+
+    def read_object(self, revision):
+        """
+        Read an object through the persistent `cat-file --batch` process.
+
+        Returns:
+            (object type, contents as bytes), or None if the object does not exist
+        """
+        started = time.perf_counter()
+        process = self._cat_file("--batch")
+        process.stdin.write(revision.encode("utf-8") + b"\n")
+        process.stdin.flush()
+        header = process.stdout.readline().decode("utf-8").split()
+        if len(header) != 3:
+            self._record(["cat-file", "--batch", revision], started, 1)
+            return None
+        contents = process.stdout.read(int(header[2]))
+        process.stdout.read(1)  # trailing newline
+        self._record(["cat-file", "--batch", revision], started, 0)
+        return header[1], contents
+
+    def print_timings(self, file=None):
+        """Print the number of git calls and the time spent in them."""
+        if not self.timings:
+            return
+        total = sum(seconds for _, seconds, _ in self.timings)
+        slowest = max(self.timings, key=lambda timing: timing[1])
+        print(f"[git] {len(self.timings)} calls, {total * 1000:.0f} ms total; "
+              f"slowest: {slowest[0]} ({slowest[1] * 1000:.0f} ms)", file=file or sys.stderr)
+
+    def _stop_cat_file(self):
+        for attribute in ("_batch", "_batch_check"):
+            process = getattr(self, attribute)
+            if process is not None:
+                process.stdin.close()
+                process.wait()
+                setattr(self, attribute, None)
+
+    def chdir(self, cwd):
+        """Run later git calls in cwd (e.g. another worktree); cat-file processes restart there."""
+        self._stop_cat_file()
+        self.cwd = cwd
+
+    def close(self):
+        """Stop the cat-file processes and print the timing summary."""
+        self._stop_cat_file()
+        self.print_timings()
+
+
+class RepoSnapshot:
+    """
+    Branch, HEAD and changed paths from one `status --porcelain=v2 -z` scan.
+
+    Workflow steps read from the snapshot instead of asking git again, and call
+    refresh() with the paths they just changed so only those are rescanned.
+    Pathspecs (e.g. "*.md") limit the snapshot to matching paths.
+    """
+
+    def __init__(self, git, untracked="all", pathspecs=()):
+        self.git = git
+        self.untracked = untracked
+        self.pathspecs = list(pathspecs)
+        self.oid = self.branch = self.upstream = None
+        self.ahead = self.behind = 0
+        # path -> StatusEntry, in git's order
+        self.entries = {}
+        self.refresh()
+
+    def _set_head(self, status):
+        self.oid, self.branch = status.oid, status.branch
+        self.upstream, self.ahead, self.behind = status.upstream, status.ahead, status.behind
+
+    def _read_head(self):
+        """Reread HEAD, the branch and its tracking counts without scanning the work tree."""
+        self.branch = self.git.current_branch()
+        head = self.git.resolve("HEAD")
+        self.oid = head[0] if head else None
+        self.upstream, self.ahead, self.behind = None, 0, 0
+        if self.branch:
+            track = self.git.output(["for-each-ref", "--format=%(upstream:short)%00%(upstream:track,nobracket)",
+                                     f"refs/heads/{self.branch}"])
+            self.upstream, _, counts = track.partition("\0")
+            self.upstream = self.upstream or None
+            for count in counts.split(", "):
+                word, _, number = count.partition(" ")
+                if word == "ahead":
+                    self.ahead = int(number)
+                elif word == "behind":
+                    self.behind = int(number)
+
+    def refresh(self, paths=None):
+        """
+        Rescan the given paths and update the snapshot in place.
+
+        Args:
+            paths: Paths changed since the last scan. None rescans everything;
+                an empty list only rereads HEAD and the branch.
+
+        Returns:
+            self
+        """
+        if paths is None or len(paths) > REFRESH_PATH_LIMIT:
+            status = self.git.status(self.pathspecs, untracked=self.untracked)
+            self.entries = {entry.path: entry for entry in status.entries}
+            self._set_head(status)
+        elif paths:
+            paths = set(paths)
+            # Status paths are relative to the top of the work tree, whatever the current directory
+            status = self.git.status([":(top,literal)" + path for path in sorted(paths)], untracked=self.untracked)
+            for path, entry in list(self.entries.items()):
+                if path in paths or entry.orig_path in paths:
+                    del self.entries[path]
+            for entry in status.entries:
+                self.entries[entry.path] = entry
+            self._set_head(status)
+        else:
+            self._read_head()
+        return self
+
+    def paths(self):
+        """Every path in the snapshot, including rename and copy sources."""
+        found = []
+        for entry in self.entries.values():
+            found.append(entry.path)
+            if entry.orig_path:
+                found.append(entry.orig_path)
+        return found
+
+    def staged_paths(self):
+        """Paths with index changes (what a commit would record), plus unmerged paths."""
+        found = []
+        for entry in self.entries.values():
+            if entry.kind == "u" or (entry.kind in "12" and entry.xy[0] != "."):
+                found.append(entry.path)
+                if entry.orig_path:
+                    found.append(entry.orig_path)
+        return found
+
+    def modified_files(self):
+        """Tracked files changed in the work tree (`git ls-files -m`)."""
+        return [entry.path for entry in self.entries.values() if entry.kind in "12u" and entry.xy[1] != "."]
+
+    def untracked_files(self):
+        """Untracked, non-ignored files (`git ls-files --others --exclude-standard`)."""
+        return [entry.path for entry in self.entries.values() if entry.kind == "?"]
+
+    def has_staged_changes(self):
+        """Whether the index differs from HEAD (`git diff --staged --quiet` exiting 1)."""
+        return bool(self.staged_paths())
+
+    def is_clean(self):
+        """Whether there is nothing to commit and no untracked files."""
+        return not self.entries
+
+    def render(self):
+        """The snapshot as the long `git status` output, without the advice hints."""
+        if self.branch:
+            lines = [f"On branch {self.branch}"]
+        else:
+            lines = [f"HEAD detached at {self.oid[:7]}" if self.oid else "Not currently on any branch."]
+        if self.upstream:
+            if self.ahead and self.behind:
+                lines.append(f"Your branch and '{self.upstream}' have diverged,\n"
+                             f"and have {self.ahead} and {self.behind} different commits each, respectively.")
+            elif self.ahead or self.behind:
+                count = self.ahead or self.behind
+                where = "ahead of" if self.ahead else "behind"
+                lines.append(f"Your branch is {where} '{self.upstream}' by {count} commit{'s' if count != 1 else ''}.")
+            else:
+                lines.append(f"Your branch is up to date with '{self.upstream}'.")
+            lines.append("")
+        if self.oid is None:
+            lines += ["", "No commits yet", ""]
+
+        staged, unmerged, unstaged, untracked = [], [], [], []
+        for entry in self.entries.values():
+            if entry.kind == "?":
+                untracked.append(f"\t{entry.path}")
+            elif entry.kind == "u":
+                unmerged.append(f"\t{UNMERGED_LABELS.get(entry.xy, 'unmerged:'):<17}{entry.path}")
+            elif entry.kind in "12":
+                index_status, worktree_status = entry.xy
+                if index_status != ".":
+                    path = f"{entry.orig_path} -> {entry.path}" if entry.orig_path else entry.path
+                    staged.append(f"\t{CHANGE_LABELS.get(index_status, 'changed:'):<12}{path}")
+                if worktree_status != ".":
+                    unstaged.append(f"\t{CHANGE_LABELS.get(worktree_status, 'changed:'):<12}{entry.path}")
+        for title, items in (("Changes to be committed:", staged), ("Unmerged paths:", unmerged),
+                             ("Changes not staged for commit:", unstaged), ("Untracked files:", untracked)):
+            if items:
+                lines += [title, *items, ""]
+
+        if staged:
+            return "\n".join(lines).rstrip("\n")
+        if unstaged or unmerged:
+            footer = "no changes added to commit"
+        elif untracked:
+            footer = "nothing added to commit but untracked files present"
+        else:
+            footer = "nothing to commit, working tree clean"
+        lines.append(footer)
+        return "\n".join(lines)
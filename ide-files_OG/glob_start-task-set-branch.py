@@ -9,27 +9,36 @@ Usage:
     Retry attempt: python glob_start-task-set-branch.py <og_file_path> <og_number> <task_set_number> <attempt_number> [--main-branch <branch_name>]
 """
 
-import subprocess
 import sys
 import re
 import argparse
 
-def run_git_command(cmd, check=True):
-    """Run a Git command and return its output."""
+from glob_git_session import GitError, GitSession, RepoSnapshot
+from glob_task_worktrees import DEFAULT_POOL_SIZE, WorktreePool
+
+def run_git_command(git, cmd):
+    """Run a Git command through the session and return its output."""
     try:
-        result = subprocess.run(
-            ["git"] + cmd,
-            capture_output=True,
-            text=True,
-            check=check
-        )
-        return result.stdout.strip()
-    except subprocess.CalledProcessError as e:
+        return git.output(cmd)
+    except GitError as e:
         print(f"Error running git command: {' '.join(cmd)}")
         print(e.stderr)
         sys.exit(1)
 
+def refresh_snapshot(snapshot, paths=None):
+    """Rescan the given paths (all when None) into the snapshot."""
+    try:
+        snapshot.refresh(paths)
+    except GitError as e:
+        print("Error running git command: status")
+        print(e.stderr)
+        sys.exit(1)
+
 def main():
+    with GitSession() as git:
+        start_task_set(git)
+
+def start_task_set(git):
     parser = argparse.ArgumentParser(description="Start a new Task Set branch.")
     parser.add_argument("og_file_path", help="Path to the Orchestrator Guide file.")
     parser.add_argument("og_number", help="OG number.")
@@ -41,6 +50,14 @@ def main():
         default="main",
         help="The name of the main integration branch (default: main)."
     )
+    parser.add_argument(
+        "--worktree",
+        action="store_true",
+        help="Create the branch in its own pooled git worktree instead of checking it out here, "
+             "so several Task Sets can run at once."
+    )
+    parser.add_argument("--worktree-dir", default=None, help="Managed directory for the pooled worktrees (default: <repo>.worktrees).")
+    parser.add_argument("--pool-size", type=int, default=DEFAULT_POOL_SIZE, help=f"Idle worktrees kept for reuse (default: {DEFAULT_POOL_SIZE}).")
     args = parser.parse_args()
 
     og_file_path = args.og_file_path
@@ -60,34 +77,40 @@ def main():
         print("Error: Attempt number must be 1 or greater")
         sys.exit(1)
 
-    # Show initial status
+    # Show initial status (one NUL-delimited scan; later steps rescan only the paths they touch)
+    try:
+        snapshot = RepoSnapshot(git, untracked="normal")
+    except GitError as e:
+        print("Error running git command: status")
+        print(e.stderr)
+        sys.exit(1)
     print("\nInitial git status:")
-    print(run_git_command(["status"]))
+    print(snapshot.render())
 
     # Ensure we're on main branch
     print(f"\nEnsuring clean {main_branch} branch...")
-    run_git_command(["checkout", main_branch])
+    run_git_command(git, ["checkout", main_branch])
+    refresh_snapshot(snapshot, snapshot.paths())
 
-    # Check git status
-    status_output = run_git_command(["status", "--porcelain"])
-    status_lines = status_output.split('\n') if status_output else []
+    og_path = og_file_path.replace("\\", "/")
     has_og_file = False
     has_other_files = False
 
-    for line in status_lines:
-        file_path = line[3:]
-        if file_path == og_file_path:
+    for entry in snapshot.entries.values():
+        if entry.path == og_path:
             has_og_file = True
         else:
             has_other_files = True
 
     # Commit all changes if any exist
-    if status_lines:
+    if snapshot.entries:
         print("Staging all changes...")
-        run_git_command(["add", "."])
+        run_git_command(git, ["add", "."])
+        refresh_snapshot(snapshot, snapshot.paths())
 
         commit_msg = f"OG-{og_number} TS-{task_set_number}: Doc update before Attempt-{attempt_number}"
-        run_git_command(["commit", "-m", commit_msg])
+        run_git_command(git, ["commit", "-m", commit_msg])
+        refresh_snapshot(snapshot, snapshot.staged_paths())
 
         if has_og_file and has_other_files:
             print(f"Committed {og_file_path} and other files.")
@@ -104,11 +127,24 @@ def main():
         branch_name = f"OG-{og_number}_TS-{task_set_number}"
         print(f"Creating initial branch: {branch_name}")
 
-    run_git_command(["checkout", "-b", branch_name])
+    if args.worktree:
+        try:
+            pool = WorktreePool(git, args.worktree_dir, args.pool_size)
+            worktree_path = pool.acquire(branch_name, main_branch)
+        except GitError as e:
+            print(f"Error creating Task Set worktree for {branch_name}")
+            print(e.stderr)
+            sys.exit(1)
+        print(f"\nTask Set branch created successfully in worktree: {worktree_path}")
+        print("Run the Task Set there; pass --worktree to glob_complete-task-set.py or glob_fail-task-set.py.")
+        return
+
+    run_git_command(git, ["checkout", "-b", branch_name])
+    refresh_snapshot(snapshot, [])  # A new branch at HEAD changes no paths
 
     # Show final status
     print("\nTask Set branch created successfully. Current status:")
-    print(run_git_command(["status"]))
+    print(snapshot.render())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,137 @@
+"""
+Pooled git worktrees so several Task Sets can run side by side in one clone.
+
+In worktree mode each Task Set (or attempt) branch is checked out in its own
+`git worktree` under a managed directory instead of in the single main working
+tree, so the orchestrator can run independent Task Sets in parallel without
+recloning and without sharing an index.
+
+Worktrees are pooled: when a Task Set completes or fails, its worktree is
+detached at the main branch, cleaned of untracked and ignored files (build
+output, logs) so nothing leaks into the next Task Set, and handed to that Task
+Set, which only has to rewrite the files that differ. Worktrees beyond the pool
+size are removed.
+A worktree in use is locked (`git worktree lock`), which is also how concurrent
+starts claim an idle one without racing each other.
+
+The managed directory defaults to `<main worktree>.worktrees` next to the main
+working tree; set GLOB_WORKTREE_DIR or pass --worktree-dir to change it.
+
+Usage:
+    python glob_start-task-set-branch.py <og_file_path> <og_number> <task_set_number> --worktree
+    (then run glob_complete-task-set.py / glob_fail-task-set.py with --worktree
+    from inside the printed worktree)
+"""
+
+import os
+
+from glob_git_session import GitError
+
+# Pooled worktrees are <managed dir>/pool-01, pool-02, ...
+POOL_PREFIX = "pool-"
+# Idle worktrees kept for reuse; more are removed when released
+DEFAULT_POOL_SIZE = 4
+WORKTREE_DIR_ENV = "GLOB_WORKTREE_DIR"
+
+
+def _is_within(directory, path):
+    """Whether directory is path or below it."""
+    directory = os.path.realpath(directory)
+    return directory == path or directory.startswith(path.rstrip(os.sep) + os.sep)
+
+
+class WorktreePool:
+    """The pooled Task Set worktrees of one repository."""
+
+    def __init__(self, git, root=None, size=DEFAULT_POOL_SIZE):
+        self.git = git
+        self.size = size
+        # The main worktree is always listed first
+        self.main_path = git.worktrees()[0].path
+        root = root or os.environ.get(WORKTREE_DIR_ENV)
+        # git reports worktree paths with symlinks resolved
+        self.root = os.path.realpath(root) if root else self.main_path + ".worktrees"
+
+    def pooled(self):
+        """The worktrees under the managed directory that belong to the pool."""
+        return [worktree for worktree in self.git.worktrees()
+                if os.path.dirname(worktree.path) == self.root
+                and os.path.basename(worktree.path).startswith(POOL_PREFIX)]
+
+    def contains(self, path):
+        """Whether path is a pooled worktree."""
+        path = os.path.realpath(path)
+        return any(worktree.path == path for worktree in self.pooled())
+
+    def acquire(self, branch, start_point):
+        """
+        Check out a new branch at start_point in an idle pooled worktree, or a new one.
+
+        Returns:
+            The worktree path (locked until release())
+        """
+        reason = f"glob task set {branch}"
+        pooled = self.pooled()
+        for worktree in pooled:
+            if worktree.branch is not None or worktree.locked is not None:
+                continue
+            # Locking fails if another start claimed this worktree first
+            if not self.git.succeeds(["worktree", "lock", "--reason", reason, worktree.path]):
+                continue
+            if self.git.succeeds(["-C", worktree.path, "checkout", "--quiet", "-b", branch, start_point]):
+                print(f"Reusing pooled worktree: {worktree.path}")
+                return worktree.path
+            print(f"Warning: Could not check out '{branch}' in {worktree.path}; trying another worktree.")
+            self.git.run(["worktree", "unlock", worktree.path], check=False)
+
+        os.makedirs(self.root, exist_ok=True)
+        used = {os.path.basename(worktree.path) for worktree in pooled}
+        number = 1
+        while True:
+            name = f"{POOL_PREFIX}{number:02d}"
+            path = os.path.join(self.root, name)
+            number += 1
+            if name in used or os.path.exists(path):
+                continue
+            try:
+                self.git.run(["worktree", "add", "--lock", "-b", branch, path, start_point])
+            except GitError:
+                # A concurrent start may have taken the same name
+                if os.path.exists(path):
+                    continue
+                raise
+            print(f"Created pooled worktree: {path}")
+            return path
+
+    def release(self, path):
+        """
+        Return a worktree to the pool, or remove it if the pool is already full.
+
+        The worktree must already be detached (its branch merged or abandoned).
+        A kept worktree is cleaned (`git clean -fdx`) while still locked, so
+        untracked and ignored files do not carry over to the next Task Set; one
+        that cannot be cleaned is removed instead.
+        If the process or the session is inside path (which may be removed),
+        it moves to the main worktree; otherwise its directory is left as is.
+
+        Returns:
+            True if the worktree was kept for reuse, False if it was removed
+        """
+        path = os.path.realpath(path)
+        if _is_within(os.getcwd(), path):
+            os.chdir(self.main_path)
+        if _is_within(self.git.cwd, path):
+            self.git.chdir(self.main_path)
+        idle = [worktree for worktree in self.pooled()
+                if worktree.path != path and worktree.branch is None and worktree.locked is None]
+        # Clean before unlocking, so no start can claim a worktree still holding old files
+        if len(idle) >= self.size or not self.git.succeeds(["-C", path, "clean", "-fdx", "--quiet"]):
+            # Twice --force removes a locked worktree
+            self.git.run(["worktree", "remove", "--force", "--force", path])
+            kept = False
+        else:
+            self.git.run(["worktree", "unlock", path], check=False)
+            kept = True
+        # Drop entries for worktree directories deleted by hand
+        self.git.run(["worktree", "prune"])
+        return kept
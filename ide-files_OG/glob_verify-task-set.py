@@ -1,43 +1,16 @@
 import argparse
 import subprocess
-import sys
-import os
-# Removed: from concurrent.futures import ThreadPoolExecutor
 
-def run_command(command, capture=True, check=True, suppress_output=False):
-    """Runs a shell command, captures output, and handles errors."""
-    command_str = ' '.join(command)
-    if not suppress_output:
-        print(f"Executing: {command_str}")
-    try:
-        process = subprocess.run(command_str, shell=True, check=check,
-                               capture_output=capture, text=True,
-                               cwd=os.getcwd(), encoding='utf-8',
-                               errors='replace')
-        if not suppress_output:
-            if process.stdout:
-                print("Output:\n", process.stdout.strip())
-            if process.stderr:
-                print("Errors:\n", process.stderr.strip())
-            print(f"Command successful.")
-        return process
-    except subprocess.CalledProcessError as e:
-        stdout = e.stdout.strip() if e.stdout else ""
-        stderr = e.stderr.strip() if e.stderr else ""
-        print(f"Error executing command: {command_str}")
-        print(f"Return code: {e.returncode}")
-        if stdout:
-            print(f"Output:\n{stdout}")
-        if stderr:
-            print(f"Error output:\n{stderr}")
-        return e
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-        return None
+from glob_git_session import GitError, GitSession, RepoSnapshot
+# Removed: from concurrent.futures import ThreadPoolExecutor
 
 # Removed: run_tests_parallel function
 
 def main():
+    with GitSession() as git:
+        verify_task_set(git)
+
+def verify_task_set(git):
     parser = argparse.ArgumentParser(description="Verify changes on a branch (stages changes only in global version).")
     parser.add_argument(
         "-b", "--branch",
@@ -64,13 +37,19 @@ def main():
     print(f"\n--- Verifying Branch {branch_name} (Staging Changes Only) ---")
     print("Note: In the global workflow, project-specific verification must be performed separately by the executing mode.")
 
-    # Print initial git status
+    # Print initial git status (one scan; staging below rescans only the paths it touched)
     print("\nInitial git status:")
-    run_command(["git", "status"], suppress_output=False)
+    try:
+        snapshot = RepoSnapshot(git)
+        print(snapshot.render())
+    except GitError as e:
+        # Staging does not need the status; report it and carry on
+        print(f"Error: Could not read git status: {e.stderr.strip()}")
+        snapshot = None
 
     # Stage changes
     print("\nStep 1: Staging changes...")
-    stage_result = run_command(["git", "add", "."], suppress_output=True)
+    stage_result = git.run_command(["add", "."], suppress_output=True)
     if isinstance(stage_result, subprocess.CalledProcessError) or stage_result is None:
         print("Error: Failed to stage changes. Verification cannot proceed reliably.")
         if hasattr(stage_result, 'stderr') and stage_result.stderr:
@@ -84,7 +63,14 @@ def main():
 
     # Print final git status
     print("\nFinal git status:")
-    run_command(["git", "status"], suppress_output=False)
+    try:
+        if snapshot is None:
+            snapshot = RepoSnapshot(git)
+        else:
+            snapshot.refresh(snapshot.paths())
+        print(snapshot.render())
+    except GitError as e:
+        print(f"Error: Could not read git status: {e.stderr.strip()}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,45 @@
+import importlib.util
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = os.path.join(ROOT, "ide-files_OG")
+
+# find_duplicate_files.py and the glob_* scripts are top-level scripts, not installed packages
+sys.path.insert(0, ROOT)
+sys.path.insert(0, SCRIPTS)
+
+
+def git(cwd, *args, input=None):
+    """Run git in cwd and return its stripped stdout."""
+    return subprocess.run(["git", *args], cwd=cwd, input=input, capture_output=True, text=True,
+                          check=True).stdout.strip()
+
+
+def load_script(name):
+    """Import a glob_*.py script whose file name is not a valid module name."""
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), os.path.join(SCRIPTS, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def git_repo(tmp_path, monkeypatch):
+    """A repository on branch main with one commit (README.md), made the current directory."""
+    for key, value in (("GIT_AUTHOR_NAME", "Test"), ("GIT_AUTHOR_EMAIL", "test@example.com"),
+                       ("GIT_COMMITTER_NAME", "Test"), ("GIT_COMMITTER_EMAIL", "test@example.com"),
+                       ("GIT_CONFIG_NOSYSTEM", "1"), ("GIT_CONFIG_GLOBAL", os.devnull)):
+        monkeypatch.setenv(key, value)
+    monkeypatch.delenv("GLOB_WORKTREE_DIR", raising=False)
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    git(str(repo), "init", "-q", "-b", "main")
+    (repo / "README.md").write_text("readme\n")
+    git(str(repo), "add", ".")
+    git(str(repo), "commit", "-q", "-m", "initial")
+    monkeypatch.chdir(repo)
+    return str(repo)
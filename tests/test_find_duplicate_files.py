@@ -0,0 +1,565 @@
+import json
+import os
+import random
+
+import pytest
+
+import benchmark_find_duplicate_files as bench
+from conftest import git
+import find_duplicate_files as fdf
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_content_estimate_is_exact_at_full_sample_with_many_threads(tmp_path):
+    rng = random.Random(19)
+    pairs = 400
+    for i in range(pairs):
+        data = rng.randbytes(rng.randint(20_000, 40_000))
+        _write(str(tmp_path / "a" / f"f{i}.bin"), data)
+        _write(str(tmp_path / "b" / f"f{i}.bin"), data)
+
+    estimate = fdf.estimate_duplicates(str(tmp_path), "content", sample_rate=1.0,
+                                       walk_threads=8, partial_bytes=4096)
+
+    assert estimate.duplicate_sets == pairs
+    assert estimate.duplicate_files == pairs
+
+
+def test_link_skips_target_edited_since_scan(tmp_path):
+    keep, edited = str(tmp_path / "keep.bin"), str(tmp_path / "edited.bin")
+    _write(keep, b"a" * 5000)
+    _write(edited, b"a" * 4999 + b"b")  # Same size, as after an in-place edit the index missed
+
+    summary = fdf.link_duplicates([(("stale-hash", 5000), [keep, edited])], "hardlink")
+
+    assert summary["linked"] == 0 and summary["skipped"] == 1
+    assert os.stat(keep).st_ino != os.stat(edited).st_ino
+    with open(edited, "rb") as f:
+        assert f.read().endswith(b"b")
+
+
+def test_link_replaces_identical_target(tmp_path):
+    keep, copy = str(tmp_path / "keep.bin"), str(tmp_path / "copy.bin")
+    _write(keep, b"a" * 5000)
+    _write(copy, b"a" * 5000)
+
+    summary = fdf.link_duplicates([(("hash", 5000), [keep, copy])], "hardlink")
+
+    assert summary["linked"] == 1
+    assert os.stat(keep).st_ino == os.stat(copy).st_ino
+
+
+def test_reflink_rejected_before_touching_files_where_unsupported(tmp_path, monkeypatch):
+    monkeypatch.setattr(fdf.sys, "platform", "win32")
+    keep, copy = str(tmp_path / "keep.bin"), str(tmp_path / "copy.bin")
+    _write(keep, b"a" * 100)
+    _write(copy, b"a" * 100)
+    journal = str(tmp_path / "journal.jsonl")
+
+    with pytest.raises(ValueError):
+        fdf.link_duplicates([(("hash", 100), [keep, copy])], "reflink", journal)
+
+    assert not os.path.exists(journal)
+    assert os.stat(keep).st_ino != os.stat(copy).st_ino
+
+
+def test_hardlinks_counted_once_from_scan_without_restat(tmp_path, monkeypatch):
+    _write(str(tmp_path / "a" / "x.bin"), b"x" * 100)
+    os.makedirs(str(tmp_path / "b"))
+    os.link(str(tmp_path / "a" / "x.bin"), str(tmp_path / "b" / "x.bin"))
+    _write(str(tmp_path / "c" / "x.bin"), b"x" * 100)
+    shard = str(tmp_path / "scan.shard")
+    fdf.write_shard(shard, str(tmp_path))
+
+    in_memory, external, merged = {}, {}, {}
+    list(fdf.iter_duplicate_files(str(tmp_path), copies=in_memory))
+    list(fdf.iter_duplicate_files_external(str(tmp_path), 1, copies=external))
+    # The shard's paths may be on another host: nothing may be stat'ed again
+    monkeypatch.setattr(fdf.os, "stat", None)
+    fdf.merge_shards([shard], merged)
+
+    assert in_memory == external == merged == {("x.bin", 100): 2}
+
+
+def test_duplicate_directories_reports_siblings_inside_duplicated_parents(tmp_path):
+    for parent in ("p1", "p2"):
+        _write(str(tmp_path / parent / "a" / "x.txt"), b"x" * 10)
+        _write(str(tmp_path / parent / "b" / "x.txt"), b"x" * 10)
+        _write(str(tmp_path / parent / "n" / "deep" / "y.txt"), b"y" * 20)
+    _write(str(tmp_path / "s" / "d" / "z.txt"), b"z" * 30)
+    _write(str(tmp_path / "s" / "e" / "z.txt"), b"z" * 30)
+    _write(str(tmp_path / "s" / "unique.txt"), b"u")
+
+    results = fdf.find_duplicate_directories(str(tmp_path))
+
+    found = sorted([os.path.relpath(d, str(tmp_path)) for d in r.directories] for r in results)
+    assert found == [
+        ["p1", "p2"],
+        [os.path.join("p1", "a"), os.path.join("p1", "b")],
+        [os.path.join("s", "d"), os.path.join("s", "e")],
+    ]
+
+
+def _name_groups(root):
+    return {key: sorted(dirs) for key, dirs in fdf.iter_duplicate_files(root)}
+
+
+@pytest.mark.parametrize("memory_budget, fan_in, min_runs, max_runs", [
+    (64 * 1024 * 1024, fdf.ExternalGrouper.MERGE_FAN_IN, 1, 1),  # Everything fits: one run
+    (4096, fdf.ExternalGrouper.MERGE_FAN_IN, 2, fdf.ExternalGrouper.MERGE_FAN_IN),  # Spills, one merge pass
+    (4096, 2, 3, None),  # Too many runs for one pass: merged down in several
+])
+def test_external_grouping_matches_in_memory(tmp_path, monkeypatch, memory_budget, fan_in, min_runs, max_runs):
+    bench.make_tree(str(tmp_path), dirs=40, files_per_dir=25, seed=8)
+    monkeypatch.setattr(fdf.ExternalGrouper, "MERGE_FAN_IN", fan_in)
+    spills = []
+    spill = fdf.ExternalGrouper._spill
+    monkeypatch.setattr(fdf.ExternalGrouper, "_spill", lambda self: spills.append(len(self._buffer)) or spill(self))
+
+    external = dict(fdf.iter_duplicate_files_external(str(tmp_path), memory_budget))
+
+    assert external
+    assert external == _name_groups(str(tmp_path))
+    runs = sum(1 for count in spills if count)
+    assert min_runs <= runs <= (max_runs or runs)
+
+
+@pytest.mark.parametrize("concurrency", [1, 32])
+def test_async_scan_on_slow_filesystem_matches_sync_scan(tmp_path, concurrency):
+    bench.make_tree(str(tmp_path), dirs=30, files_per_dir=10, seed=14)
+
+    result = fdf.find_duplicate_files_async(str(tmp_path), concurrency, None, bench.SlowFileSystem(0.0005))
+
+    assert result
+    assert {key: sorted(dirs) for key, dirs in result.items()} == _name_groups(str(tmp_path))
+
+
+@pytest.mark.parametrize("hashes", [False, True])
+def test_merged_shards_match_single_scan(tmp_path, hashes):
+    root = tmp_path / "tree"
+    for i, part in enumerate(("a", "b", "c")):
+        bench.make_tree(str(root / part), dirs=15, files_per_dir=10, seed=i, name_pool=30)
+    shards = []
+    for part in ("a", "b", "c"):
+        shards.append(str(tmp_path / f"{part}.shard"))
+        fdf.write_shard(shards[-1], str(root / part), hashes=hashes, workers=0)
+
+    merged, metadatas = fdf.merge_shards(shards)
+
+    assert [metadata["root"] for metadata in metadatas] == [str(root / part) for part in ("a", "b", "c")]
+    expected = _name_groups(str(root))
+    assert any(len({os.path.relpath(d, str(root)).split(os.sep)[0] for d in dirs}) > 1
+               for dirs in expected.values())
+    assert {key: sorted(dirs) for key, dirs in merged.items()} == expected
+
+
+@pytest.mark.parametrize("scan", [
+    lambda root: fdf.find_duplicate_files(root, walk_threads=1),
+    lambda root: fdf.find_duplicate_files(root, walk_threads=4),
+    lambda root: fdf.find_duplicate_files_async(root),
+])
+def test_progress_counts_directories_without_files(tmp_path, monkeypatch, scan):
+    _write(str(tmp_path / "a" / "b" / "c" / "x.txt"), b"x")
+    os.makedirs(str(tmp_path / "empty"))
+    monkeypatch.setattr(fdf, "progress", fdf.ScanProgress())
+
+    scan(str(tmp_path))
+
+    # The root, a, a/b, a/b/c and empty
+    assert fdf.progress.dirs == 5
+    assert fdf.progress.files == 1
+
+
+def test_index_drops_hash_of_file_edited_in_place(tmp_path):
+    root = tmp_path / "tree"
+    _write(str(root / "a" / "f.txt"), b"a" * 5000)
+    _write(str(root / "b" / "f.txt"), b"a" * 5000)
+    index_path = str(tmp_path / "index.sqlite")
+
+    def scan():
+        index = fdf.ScanIndex(index_path)
+        try:
+            return list(fdf.iter_content_duplicates(str(root), workers=0, partial_bytes=1024, index=index))
+        finally:
+            index.close()
+
+    assert len(scan()) == 1
+    # Rewrite in place: same size, directory mtime unchanged
+    dir_mtime = os.stat(str(root / "b")).st_mtime_ns
+    with open(str(root / "b" / "f.txt"), "r+b") as f:
+        f.seek(2500)
+        f.write(b"b")
+    # Move the mtime even where timestamps are coarse
+    st = os.stat(str(root / "b" / "f.txt"))
+    os.utime(str(root / "b" / "f.txt"), ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert os.stat(str(root / "b")).st_mtime_ns == dir_mtime
+
+    assert scan() == []
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_walker_raises_lister_errors_instead_of_hanging(tmp_path, workers):
+    bench.make_tree(str(tmp_path), dirs=20, files_per_dir=2, seed=2)
+    broken = next(dirpath for dirpath, _, _ in os.walk(str(tmp_path)) if dirpath.endswith("dir_00003"))
+
+    def lister(dirpath):
+        if dirpath == broken:
+            raise RuntimeError("index is corrupt")
+        return fdf.list_directory(dirpath)
+
+    with pytest.raises(RuntimeError, match="index is corrupt"):
+        list(fdf.scan_tree(str(tmp_path), workers, lister))
+
+
+@pytest.mark.parametrize("refresh", [True, False])
+def test_compare_trees_reads_each_reference_file_once(tmp_path, monkeypatch, refresh):
+    tree, reference = tmp_path / "tree", tmp_path / "reference"
+    _write(str(tree / "same.bin"), b"s" * 100)
+    _write(str(tree / "moved" / "renamed.bin"), b"m" * 100)
+    _write(str(tree / "edited.bin"), b"e" * 100)
+    _write(str(tree / "new.bin"), b"n" * 100)
+    _write(str(tree / "odd_size.bin"), b"o" * 7)
+    _write(str(reference / "same.bin"), b"s" * 100)
+    _write(str(reference / "elsewhere" / "renamed.bin"), b"m" * 100)
+    _write(str(reference / "edited.bin"), b"E" * 100)
+    reference_index = fdf.ScanIndex(str(tmp_path / "reference.sqlite"))
+    for _ in reference_index.scan(str(reference)):
+        pass
+    monkeypatch.setattr(fdf, "COMPARE_BATCH_SIZE", 1)
+    reads = []
+    hash_full = fdf._hash_full
+    monkeypatch.setattr(fdf, "_hash_full", lambda path, **kwargs: reads.append(path) or hash_full(path, **kwargs))
+
+    try:
+        results = list(fdf.compare_trees(str(tree), str(reference), reference_index, workers=0, refresh=refresh))
+    finally:
+        reference_index.close()
+
+    found = {os.path.relpath(r.path, str(tree)): (r.status, [os.path.relpath(p, str(reference)) for p in r.reference])
+             for r in results}
+    assert found == {
+        "same.bin": ("present", ["same.bin"]),
+        os.path.join("moved", "renamed.bin"): ("present", [os.path.join("elsewhere", "renamed.bin")]),
+        "edited.bin": ("changed", ["edited.bin"]),
+        "new.bin": ("missing", []),
+        "odd_size.bin": ("missing", []),
+    }
+    reference_reads = [path for path in reads if path.startswith(str(reference))]
+    assert sorted(reference_reads) == sorted(set(reference_reads))
+    assert len(reference_reads) == 3
+
+
+def _content_groups(root, **kwargs):
+    return sorted((size, [os.path.relpath(p, root) for p in paths])
+                  for (_, size), paths in fdf.iter_content_duplicates(root, partial_bytes=1024, **kwargs))
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_content_duplicates_need_the_full_hash_to_agree(tmp_path, workers):
+    head, tail = b"h" * 1024, b"t" * 1024
+    # Same size and same partial-hash windows; only the middle tells them apart
+    _write(str(tmp_path / "a.bin"), head + b"m" * 3000 + tail)
+    _write(str(tmp_path / "b.bin"), head + b"m" * 3000 + tail)
+    _write(str(tmp_path / "c.bin"), head + b"m" * 1500 + b"X" + b"m" * 1499 + tail)
+    # Small enough for the partial stage to read whole
+    _write(str(tmp_path / "small1.txt"), b"abc" * 100)
+    _write(str(tmp_path / "small2.txt"), b"abc" * 100)
+    _write(str(tmp_path / "small3.txt"), b"abd" * 100)
+    _write(str(tmp_path / "unique.bin"), b"u" * 5)
+    stats = fdf.new_content_stats()
+
+    groups = _content_groups(str(tmp_path), workers=workers, stats=stats)
+
+    assert groups == [(300, ["small1.txt", "small2.txt"]), (5048, ["a.bin", "b.bin"])]
+    assert stats["full"]["candidates"] == 3
+    assert stats["size"]["bytes_skipped"] == 5
+
+
+def test_content_duplicates_pool_matches_in_process(tmp_path):
+    rng = random.Random(1)
+    blobs = [rng.randbytes(rng.choice([100, 3000, 20_000])) for _ in range(30)]
+    for i in range(120):
+        _write(str(tmp_path / f"d{i % 7}" / f"f{i}.bin"), rng.choice(blobs))
+
+    in_process = _content_groups(str(tmp_path), workers=0)
+
+    assert in_process
+    assert _content_groups(str(tmp_path), workers=3) == in_process
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_content_duplicates_skip_unreadable_files(tmp_path, monkeypatch, workers):
+    for name in ("a.bin", "b.bin", "gone.bin"):
+        _write(str(tmp_path / name), b"x" * 5000)
+    # Listed by the walk, unreadable by the time it is hashed
+    walk = list(fdf.walk_tree(str(tmp_path)))
+    os.remove(str(tmp_path / "gone.bin"))
+    monkeypatch.setattr(fdf, "progress", fdf.ScanProgress())
+
+    groups = _content_groups(str(tmp_path), workers=workers, walk=walk)
+
+    assert groups == [(5000, ["a.bin", "b.bin"])]
+    assert fdf.progress.errors == 1
+
+
+def test_scan_store_groups_match_dict_of_lists_scan(tmp_path):
+    bench.make_tree(str(tmp_path), dirs=60, files_per_dir=15, seed=7)
+    expected = bench._normalize(bench.legacy_find_duplicate_files(str(tmp_path)))
+
+    store = fdf.build_scan_store(str(tmp_path))
+    view = fdf.find_duplicate_files(str(tmp_path))
+
+    assert expected
+    assert {key: sorted(dirs) for key, dirs in store.groups()} == expected
+    assert bench._normalize(dict(view.items())) == expected
+    assert len(view) == len(expected)
+    for key in list(expected)[:20]:
+        assert sorted(view[key]) == expected[key]
+        assert sorted(store.lookup(*key)) == expected[key]
+    # Every file is kept, not only the duplicated ones
+    assert len(store) == sum(len(files) for _, _, files in os.walk(str(tmp_path)))
+    assert sum(len(dirs) for _, dirs, _ in store.entries()) == len(store)
+
+
+def _rules_tree(root):
+    for path in ("keep.txt", "skip.log", "Photo_main_1.JPG", os.path.join("src", "a.txt"),
+                 os.path.join("src", "cache", "b.txt"), os.path.join("node_modules", "pkg", "c.txt"),
+                 os.path.join("docs", "src", "d.txt")):
+        _write(os.path.join(root, path), b"x" * 10)
+
+
+def _walked(root, rules, index=None):
+    return sorted(os.path.relpath(os.path.join(dirpath, name), root)
+                  for dirpath, files in fdf.walk_tree(root, 2, index, rules) for name, _ in files)
+
+
+def test_pruned_directories_are_never_listed(tmp_path, monkeypatch):
+    _rules_tree(str(tmp_path))
+    listed = []
+    scandir = os.scandir
+    monkeypatch.setattr(fdf.os, "scandir", lambda path: listed.append(path) or scandir(path))
+
+    found = _walked(str(tmp_path), fdf.ScanRules(prune=["node_modules", "*/src/cache"]))
+
+    assert os.path.join("node_modules", "pkg", "c.txt") not in found
+    assert os.path.join("src", "cache", "b.txt") not in found
+    assert os.path.join("src", "a.txt") in found
+    assert not any("node_modules" in path or path.endswith("cache") for path in listed)
+
+
+def test_name_globs_match_anywhere_and_path_globs_match_the_whole_path(tmp_path):
+    root = str(tmp_path)
+    _rules_tree(root)
+
+    # A bare name glob matches in every directory
+    assert _walked(root, fdf.ScanRules(include=["*.txt"])) == [
+        os.path.join("docs", "src", "d.txt"), "keep.txt", os.path.join("node_modules", "pkg", "c.txt"),
+        os.path.join("src", "a.txt"), os.path.join("src", "cache", "b.txt")]
+    # A glob with a separator is matched against the full path, so it is anchored at the root
+    # unless it starts with a wildcard
+    assert _walked(root, fdf.ScanRules(include=["src/*.txt"])) == []
+    assert _walked(root, fdf.ScanRules(include=[root + "/src/*.txt"])) == [
+        os.path.join("src", "a.txt"), os.path.join("src", "cache", "b.txt")]
+    assert _walked(root, fdf.ScanRules(include=["*/src/*.txt"])) == [
+        os.path.join("docs", "src", "d.txt"), os.path.join("src", "a.txt"), os.path.join("src", "cache", "b.txt")]
+    # Excludes win over includes; extensions ignore case
+    assert _walked(root, fdf.ScanRules(include=["*.txt"], exclude=["*/cache/*", "c.*"])) == [
+        os.path.join("docs", "src", "d.txt"), "keep.txt", os.path.join("src", "a.txt")]
+    assert _walked(root, fdf.ScanRules(extensions=["jpg"])) == ["Photo_main_1.JPG"]
+    assert fdf.ScanRules().categorize("Photo_main_1.JPG") == "Main Images"
+
+
+def test_index_rescan_without_rules_lists_previously_pruned_directories(tmp_path):
+    root = str(tmp_path / "tree")
+    _rules_tree(root)
+    index = fdf.ScanIndex(str(tmp_path / "index.sqlite"))
+    try:
+        pruned = _walked(root, fdf.ScanRules(prune=["node_modules"], exclude=["*.log"]), index)
+        everything = _walked(root, None, index)
+    finally:
+        index.close()
+
+    assert pruned == _walked(root, fdf.ScanRules(prune=["node_modules"], exclude=["*.log"]))
+    assert "skip.log" not in pruned and os.path.join("node_modules", "pkg", "c.txt") not in pruned
+    assert everything == _walked(root, None)
+
+
+def test_cut_lengths_numpy_matches_python():
+    np = pytest.importorskip("numpy")
+    data = random.Random(3).randbytes(300000)
+    for avg_size in (256, 1024, 8192):
+        for size in (0, 100, 5000, len(data)):
+            for final in (False, True):
+                assert (fdf._cut_lengths_numpy(np, data[:size], avg_size, final)
+                        == fdf._cut_lengths_python(data[:size], avg_size, final))
+
+
+def test_chunk_file_streamed_reads_match_whole_buffer(tmp_path, monkeypatch):
+    data = random.Random(4).randbytes(200000)
+    path = str(tmp_path / "f.bin")
+    _write(path, data)
+    # Many short reads, none aligned to a chunk boundary
+    monkeypatch.setattr(fdf, "HASH_CHUNK_BYTES", 3001)
+
+    chunks, bytes_read = fdf.chunk_file(path, 1024)
+
+    lengths = fdf._cut_lengths_python(data, 1024, True)
+    assert bytes_read == len(data)
+    assert [length for _, length in chunks] == lengths
+    # A non-final pass only cuts what the next read cannot move
+    assert lengths[:len(fdf._cut_lengths_python(data[:50000], 1024, False))] == \
+        fdf._cut_lengths_python(data[:50000], 1024, False)
+
+
+def test_chunks_pass_does_not_count_directories_twice(tmp_path, monkeypatch, capsys):
+    for name in ("a", "b", "c"):
+        _write(str(tmp_path / name / "f.bin"), b"x" * 4096)
+    monkeypatch.setattr(fdf, "progress", fdf.ScanProgress())
+    monkeypatch.setattr("sys.argv", ["find_duplicate_files.py", str(tmp_path), "--mode", "content",
+                                     "--chunks", "--workers", "0"])
+
+    fdf.main()
+
+    captured = capsys.readouterr()
+    assert "Scanned 4 directories, 3 files" in captured.out + captured.err
+
+
+def test_git_blob_ids_only_trusts_clean_files(git_repo):
+    sub = os.path.join(git_repo, "sub")
+    for name in ("clean.txt", "modified.txt", "staged.txt"):
+        _write(os.path.join(sub, name), b"one\n")
+    git(git_repo, "add", ".")
+    git(git_repo, "commit", "-q", "-m", "files")
+    # Same size as the committed blob, so only the object ID could tell them apart
+    _write(os.path.join(sub, "modified.txt"), b"two\n")
+    _write(os.path.join(sub, "staged.txt"), b"thr\n")
+    git(git_repo, "add", "sub/staged.txt")
+    _write(os.path.join(sub, "untracked.txt"), b"two\n")
+
+    known, object_format = fdf.git_blob_ids(sub)
+
+    one = git(git_repo, "hash-object", "--stdin", input="one\n")
+    two = git(git_repo, "hash-object", "--stdin", input="two\n")
+    thr = git(git_repo, "hash-object", "--stdin", input="thr\n")
+    assert object_format == "sha1"
+    assert known == {os.path.join(sub, "clean.txt"): one, os.path.join(sub, "staged.txt"): thr}
+    groups = list(fdf.iter_git_content_duplicates(sub, (known, object_format), workers=0))
+    assert groups == [((two, 4), [os.path.join(sub, "modified.txt"), os.path.join(sub, "untracked.txt")])]
+
+
+def test_mmap_and_buffered_digests_match_around_threshold(tmp_path, monkeypatch):
+    data = random.Random(5).randbytes(fdf.MMAP_THRESHOLD + 1)
+    used = []
+    for name, func in list(fdf.HASH_STRATEGIES.items()):
+        monkeypatch.setitem(fdf.HASH_STRATEGIES, name,
+                            lambda f, hasher, name=name, func=func: used.append(name) or func(f, hasher))
+    for size in (fdf.MMAP_THRESHOLD - 1, fdf.MMAP_THRESHOLD, fdf.MMAP_THRESHOLD + 1):
+        path = str(tmp_path / f"{size}.bin")
+        _write(path, data[:size])
+        used.clear()
+
+        digests = [fdf.hash_file(path, strategy=name) for name in ("readinto", "mmap", "read")]
+        digests.append(fdf.hash_file(path))
+        assert digests[0][0] is not None
+        assert digests == [(digests[0][0], size)] * 4
+        # The last call chose its strategy by size
+        assert used[-1] == ("readinto" if size < fdf.MMAP_THRESHOLD else "mmap")
+
+
+def test_hash_errors_clear_the_status_line(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(fdf, "progress", fdf.ScanProgress())
+    fdf.progress._drawn = True
+
+    assert fdf.hash_file(str(tmp_path / "missing")) == (None, 0)
+    assert fdf._hash_partial((str(tmp_path / "missing"), 10, 4)) == (str(tmp_path / "missing"), None, 0)
+
+    err = capsys.readouterr().err
+    assert err.startswith("\r" + " " * 100 + "\r")
+    assert err.count("Error reading") == 2
+    # Callers count failed results, since hashing may run in a worker process
+    assert fdf.progress.errors == 0
+
+
+@pytest.mark.parametrize("mode,fields", [
+    ("name", {"name": str, "size": int, "directories": list}),
+    ("content", {"hash": str, "size": int, "paths": list}),
+    ("dirs", {"digest": str, "size": int, "file_count": int, "directories": list}),
+    ("compare", {"status": str, "path": str, "size": int, "reference": list}),
+])
+def test_jsonl_records_have_the_documented_fields(tmp_path, monkeypatch, capsys, mode, fields):
+    root = tmp_path / "tree"
+    for name in ("a/x.txt", "b/x.txt", "c/y.txt"):
+        _write(str(root / name), b"same\n")
+    _write(str(root / "c" / "other.txt"), b"other\n")
+    os.link(str(root / "c" / "y.txt"), str(root / "c" / "z.txt"))
+    _write(str(tmp_path / "ref" / "x.txt"), b"same\n")
+    argv = ["find_duplicate_files.py", str(root), "--mode", mode, "--format", "jsonl", "--workers", "0"]
+    if mode == "compare":
+        argv += ["--reference", str(tmp_path / "ref"), "--reference-index", str(tmp_path / "ref.sqlite")]
+    monkeypatch.setattr(fdf, "progress", fdf.ScanProgress())
+    monkeypatch.setattr("sys.argv", argv)
+
+    fdf.main()
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert records
+    for record in records:
+        extra = {"hardlinks"} if mode == "content" else set()
+        assert set(fields) <= set(record) <= set(fields) | extra
+        for key, kind in fields.items():
+            assert isinstance(record[key], kind)
+        for key in ("directories", "paths", "reference"):
+            assert all(isinstance(path, str) for path in record.get(key, []))
+    if mode == "name":
+        assert records == [{"name": "x.txt", "size": 5, "directories": [str(root / "a"), str(root / "b")]}]
+    elif mode == "content":
+        assert [sorted(r["paths"]) for r in records] == [[str(root / p) for p in ("a/x.txt", "b/x.txt", "c/y.txt")]]
+        assert records[0]["hardlinks"] == {str(root / "c" / "y.txt"): [str(root / "c" / "z.txt")]}
+    elif mode == "compare":
+        assert {r["status"] for r in records} == {"present", "missing"}
+
+
+def _pairwise_summary(groups):
+    """The per-pair file lists the directory-pair summary was first built from."""
+    dir_pairs = {}
+    for size, directories in groups:
+        sorted_dirs = sorted(set(directories))
+        for i in range(len(sorted_dirs)):
+            for j in range(i + 1, len(sorted_dirs)):
+                dir_pairs.setdefault((sorted_dirs[i], sorted_dirs[j]), []).append(size)
+    return {pair: (len(sizes), sum(sizes)) for pair, sizes in dir_pairs.items()}
+
+
+def test_directory_overlap_counts_match_pairwise_summary(tmp_path):
+    root = tmp_path / "tree"
+    layout = {
+        "a": {"1.txt": 10, "2.txt": 20, "3.txt": 30, "4.txt": 40},
+        "b": {"1.txt": 10, "2.txt": 20, "3.txt": 30},
+        "c": {"1.txt": 10, "2.txt": 20},
+        "c/d": {"1.txt": 10, "3.txt": 30, "5.txt": 50},
+        "e": {"5.txt": 50, "6.txt": 60},
+    }
+    for directory, files in layout.items():
+        for name, size in files.items():
+            _write(str(root / directory / name), b"x" * size)
+    groups = [(size, directories) for (_, size), directories in fdf.find_duplicate_files(str(root)).items()]
+    # Content mode can put two copies in one directory
+    groups.append((7, [str(root / "a"), str(root / "a"), str(root / "e")]))
+    overlap = fdf.DirectoryOverlapIndex()
+    for size, directories in groups:
+        overlap.add(size, directories)
+
+    pairs, total = overlap.top_pairs()
+
+    expected = _pairwise_summary(groups)
+    assert {(d1, d2): (count, size) for d1, d2, count, size in pairs} == expected
+    assert total == len(pairs) == 8
+    assert [(count, size) for _, _, count, size in pairs] == sorted(expected.values(), reverse=True)
+    assert pairs[0][:3] == (str(root / "a"), str(root / "b"), 3)
+    top, total = overlap.top_pairs(2)
+    assert top == pairs[:2] and total == 8
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from conftest import git, load_script
+from glob_git_session import GitSession
+
+fail = load_script("glob_fail-task-set")
+
+
+def _run_from(cwd, monkeypatch, *argv):
+    monkeypatch.chdir(cwd)
+    monkeypatch.setattr(fail.sys, "argv", ["glob_fail-task-set.py", *argv])
+    with GitSession() as session, pytest.raises(SystemExit) as exit_info:
+        fail.fail_task_set(session)
+    return exit_info.value.code
+
+
+@pytest.mark.parametrize("no_checkout", [False, True])
+def test_fail_from_subdirectory_preserves_notes(git_repo, monkeypatch, no_checkout):
+    os.makedirs(os.path.join(git_repo, "docs"))
+    with open(os.path.join(git_repo, "docs", "guide.md"), "w") as f:
+        f.write("old\n")
+    git(git_repo, "add", ".")
+    git(git_repo, "commit", "-q", "-m", "guide")
+    git(git_repo, "checkout", "-q", "-b", "OG-01_TS-02")
+    with open(os.path.join(git_repo, "docs", "guide.md"), "w") as f:
+        f.write("edited\n")
+    with open(os.path.join(git_repo, "docs", "notes.md"), "w") as f:
+        f.write("notes\n")
+    with open(os.path.join(git_repo, "docs", "_01_OG_plan.md"), "w") as f:
+        f.write("plan\n")
+
+    code = _run_from(os.path.join(git_repo, "docs"), monkeypatch, *(["--no-checkout"] if no_checkout else []))
+
+    assert code == 0
+    assert git(git_repo, "rev-parse", "--abbrev-ref", "HEAD") == "main"
+    assert git(git_repo, "show", "main:docs/notes.md") == "notes"
+    assert git(git_repo, "show", "main:docs/guide.md") == "edited"
+    # OG files stay on the failed branch only
+    assert git(git_repo, "ls-tree", "--name-only", "main", "docs/") == "docs/guide.md\ndocs/notes.md"
+    assert git(git_repo, "show", "OG-01_TS-02:docs/_01_OG_plan.md") == "plan"
+    assert git(git_repo, "status", "--porcelain") == ""
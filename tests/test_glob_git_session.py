@@ -0,0 +1,233 @@
+import os
+
+import pytest
+
+from conftest import git, load_script
+from glob_git_session import GitError, GitSession, RepoSnapshot, parse_status_v2
+
+complete = load_script("glob_complete-task-set")
+fail = load_script("glob_fail-task-set")
+
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", newline="") as f:
+        f.write(text)
+
+
+def test_status_parses_renames_and_unusual_paths(git_repo):
+    _write(os.path.join(git_repo, "old name.txt"), "moved\n")
+    _write(os.path.join(git_repo, "tracked.txt"), "tracked\n")
+    git(git_repo, "add", ".")
+    git(git_repo, "commit", "-q", "-m", "files")
+    git(git_repo, "mv", "old name.txt", "new name.txt")
+    _write(os.path.join(git_repo, "tracked.txt"), "edited\n")
+    _write(os.path.join(git_repo, "line\nbreak.md"), "x\n")
+    _write(os.path.join(git_repo, "sub dir", "a -> b.md"), "x\n")
+
+    with GitSession() as session:
+        snapshot = RepoSnapshot(session)
+
+    assert snapshot.branch == "main"
+    assert snapshot.oid == git(git_repo, "rev-parse", "HEAD")
+    entries = {entry.path: entry for entry in snapshot.entries.values()}
+    assert entries["new name.txt"].kind == "2"
+    assert entries["new name.txt"].xy == "R."
+    assert entries["new name.txt"].orig_path == "old name.txt"
+    assert snapshot.modified_files() == ["tracked.txt"]
+    assert sorted(snapshot.untracked_files()) == ["line\nbreak.md", "sub dir/a -> b.md"]
+    assert snapshot.staged_paths() == ["new name.txt", "old name.txt"]
+    assert "\trenamed:    old name.txt -> new name.txt" in snapshot.render()
+
+
+def test_parse_status_v2_branch_header_and_unmerged():
+    output = ("# branch.oid 1234567890abcdef\0# branch.head feature\0# branch.upstream origin/feature\0"
+              "# branch.ab +2 -3\0"
+              "u UU N... 100644 100644 100644 100644 a b c both changed.txt\0"
+              "? new file\0! ignored.log\0")
+
+    status = parse_status_v2(output)
+
+    assert (status.oid, status.branch, status.upstream, status.ahead, status.behind) == (
+        "1234567890abcdef", "feature", "origin/feature", 2, 3)
+    assert [(entry.kind, entry.xy, entry.path) for entry in status.entries] == [
+        ("u", "UU", "both changed.txt"), ("?", "??", "new file"), ("!", "!!", "ignored.log")]
+
+
+def test_snapshot_refresh_rescans_only_given_paths_from_subdirectory(git_repo, monkeypatch):
+    _write(os.path.join(git_repo, "docs", "a.md"), "a\n")
+    monkeypatch.chdir(os.path.join(git_repo, "docs"))
+    with GitSession() as session:
+        snapshot = RepoSnapshot(session)
+        assert snapshot.untracked_files() == ["docs/a.md"]
+        _write(os.path.join(git_repo, "README.md"), "changed\n")
+        os.remove(os.path.join(git_repo, "docs", "a.md"))
+        snapshot.refresh(["docs/a.md", "README.md"])
+
+    assert snapshot.untracked_files() == []
+    assert snapshot.modified_files() == ["README.md"]
+
+
+def test_branch_deletion_is_all_or_nothing(git_repo):
+    for name in ("OG-01_TS-01", "OG-01_TS-01_attempt-2"):
+        git(git_repo, "branch", name)
+    head = git(git_repo, "rev-parse", "HEAD")
+    with GitSession() as session:
+        # One branch moved since its commit was read: the whole transaction must fail
+        oids = {"OG-01_TS-01": head, "OG-01_TS-01_attempt-2": "0" * 40}
+        assert not complete.delete_branches_atomically(session, list(oids), oids)
+        assert set(session.branches()) == {"main", "OG-01_TS-01", "OG-01_TS-01_attempt-2"}
+
+        oids["OG-01_TS-01_attempt-2"] = head
+        assert complete.delete_branches_atomically(session, list(oids), oids)
+        assert set(session.branches()) == {"main"}
+
+
+def test_temporary_index_commit_leaves_work_tree_and_index_alone(git_repo):
+    git(git_repo, "checkout", "-q", "-b", "OG-01_TS-01")
+    _write(os.path.join(git_repo, "notes.md"), "notes\n")
+    _write(os.path.join(git_repo, "staged.md"), "staged\n")
+    git(git_repo, "add", "staged.md")
+    _write(os.path.join(git_repo, "README.md"), "unstaged edit\n")
+    index_path = os.path.join(git_repo, ".git", "index")
+    with open(index_path, "rb") as f:
+        index_before = f.read()
+    status_before = git(git_repo, "status", "--porcelain")
+    main_before = git(git_repo, "rev-parse", "main")
+
+    with GitSession() as session:
+        commit = fail.commit_files_to_branch(session, "main", ["notes.md"], "preserve notes")
+
+    assert git(git_repo, "rev-parse", "main") == commit
+    assert git(git_repo, "rev-parse", "main^") == main_before
+    assert git(git_repo, "ls-tree", "--name-only", "main") == "README.md\nnotes.md"
+    assert git(git_repo, "show", "main:README.md") == "readme"
+    with open(index_path, "rb") as f:
+        assert f.read() == index_before
+    assert git(git_repo, "status", "--porcelain") == status_before
+    assert git(git_repo, "rev-parse", "--abbrev-ref", "HEAD") == "OG-01_TS-01"
+
+
+def test_temporary_index_commit_of_unchanged_files_makes_no_commit(git_repo):
+    main_before = git(git_repo, "rev-parse", "main")
+    with GitSession() as session:
+        assert fail.commit_files_to_branch(session, "main", ["README.md"], "nothing new") is None
+    assert git(git_repo, "rev-parse", "main") == main_before
+
+
+def test_advance_branch_refuses_a_branch_that_moved(git_repo):
+    git(git_repo, "branch", "target")
+    old = git(git_repo, "rev-parse", "target")
+    git(git_repo, "commit", "-q", "--allow-empty", "-m", "next")
+    new = git(git_repo, "rev-parse", "HEAD")
+    with GitSession() as session:
+        with pytest.raises(GitError):
+            session.advance_branch("target", new, new, "stale expectation")
+        assert git(git_repo, "rev-parse", "target") == old
+        session.advance_branch("target", new, old, "advance")
+    assert git(git_repo, "rev-parse", "target") == new
+
+
+def _task_branch(repo, name, path, text):
+    """Commit `path` with `text` on a new branch `name` off main, then return to main."""
+    git(repo, "checkout", "-q", "-b", name, "main")
+    _write(os.path.join(repo, path), text)
+    git(repo, "add", path)
+    git(repo, "commit", "-q", "-m", f"{name} work")
+    git(repo, "checkout", "-q", "main")
+
+
+def test_merge_without_checkout(git_repo):
+    _task_branch(git_repo, "OG-01_TS-01", "feature.md", "feature\n")
+    git(git_repo, "checkout", "-q", "OG-01_TS-01")
+    main_before = git(git_repo, "rev-parse", "main")
+    source = git(git_repo, "rev-parse", "OG-01_TS-01")
+
+    with GitSession() as session:
+        complete.merge_without_checkout(session, RepoSnapshot(session), "main", "OG-01_TS-01")
+
+    assert git(git_repo, "rev-parse", "--abbrev-ref", "HEAD") == "main"
+    assert git(git_repo, "rev-list", "--parents", "-n", "1", "main").split()[1:] == [main_before, source]
+    assert git(git_repo, "log", "-1", "--format=%s", "main") == "Merge branch 'OG-01_TS-01'"
+    assert git(git_repo, "show", "main:feature.md") == "feature"
+    assert git(git_repo, "status", "--porcelain") == ""
+
+
+def test_merge_without_checkout_conflict_moves_no_ref(git_repo, capsys):
+    _task_branch(git_repo, "OG-01_TS-01", "README.md", "task\n")
+    _write(os.path.join(git_repo, "README.md"), "main\n")
+    git(git_repo, "commit", "-q", "-am", "main edit")
+    git(git_repo, "checkout", "-q", "OG-01_TS-01")
+    refs_before = git(git_repo, "for-each-ref")
+
+    with GitSession() as session, pytest.raises(SystemExit) as exit_info:
+        complete.merge_without_checkout(session, RepoSnapshot(session), "main", "OG-01_TS-01")
+
+    assert exit_info.value.code == 1
+    assert "Conflict: README.md" in capsys.readouterr().out
+    assert git(git_repo, "for-each-ref") == refs_before
+    assert git(git_repo, "rev-parse", "--abbrev-ref", "HEAD") == "OG-01_TS-01"
+    assert git(git_repo, "status", "--porcelain") == ""
+
+
+def _move_main_before_commit_tree(session, repo, monkeypatch):
+    """Make another process commit on main between the merge's snapshot of it and its update."""
+    output = session.output
+
+    def racing_output(args, *rest, **kwargs):
+        if args[0] == "commit-tree":
+            concurrent = git(repo, "commit-tree", "main^{tree}", "-p", "main", "-m", "concurrent")
+            git(repo, "update-ref", "refs/heads/main", concurrent)
+        return output(args, *rest, **kwargs)
+
+    monkeypatch.setattr(session, "output", racing_output)
+
+
+def test_merge_without_checkout_keeps_a_main_that_moved(git_repo, monkeypatch, capsys):
+    _task_branch(git_repo, "OG-01_TS-01", "feature.md", "feature\n")
+    git(git_repo, "checkout", "-q", "OG-01_TS-01")
+
+    with GitSession() as session, pytest.raises(SystemExit) as exit_info:
+        _move_main_before_commit_tree(session, git_repo, monkeypatch)
+        complete.merge_without_checkout(session, RepoSnapshot(session), "main", "OG-01_TS-01")
+
+    assert exit_info.value.code == 1
+    assert "Failed to merge" in capsys.readouterr().out
+    # The concurrent commit survives; the merge was not forced over it
+    assert git(git_repo, "log", "-1", "--format=%s", "main") == "concurrent"
+    assert git(git_repo, "rev-parse", "--abbrev-ref", "HEAD") == "OG-01_TS-01"
+
+
+def test_merge_from_worktree_keeps_a_checked_out_main_that_moved(git_repo, tmp_path, monkeypatch, capsys):
+    _task_branch(git_repo, "OG-01_TS-01", "feature.md", "feature\n")
+    worktree = str(tmp_path / "task")
+    git(git_repo, "worktree", "add", "-q", worktree, "OG-01_TS-01")
+    monkeypatch.chdir(worktree)
+
+    with GitSession() as session, pytest.raises(SystemExit) as exit_info:
+        _move_main_before_commit_tree(session, git_repo, monkeypatch)
+        complete.merge_without_checkout(session, RepoSnapshot(session), "main", "OG-01_TS-01", detach=True)
+
+    assert exit_info.value.code == 1
+    assert "moved from" in capsys.readouterr().out
+    assert git(git_repo, "log", "-1", "--format=%s", "main") == "concurrent"
+    assert not os.path.exists(os.path.join(git_repo, "feature.md"))
+    assert git(worktree, "rev-parse", "--abbrev-ref", "HEAD") == "OG-01_TS-01"
+
+
+def test_merge_from_worktree_advances_checked_out_main_in_place(git_repo, tmp_path, monkeypatch):
+    _task_branch(git_repo, "OG-01_TS-01", "feature.md", "feature\n")
+    worktree = str(tmp_path / "task")
+    git(git_repo, "worktree", "add", "-q", worktree, "OG-01_TS-01")
+    monkeypatch.chdir(worktree)
+
+    with GitSession() as session:
+        complete.merge_without_checkout(session, RepoSnapshot(session), "main", "OG-01_TS-01", detach=True)
+
+    # main is checked out in the main worktree, whose files follow the ref
+    assert git(git_repo, "log", "-1", "--format=%s", "main") == "Merge branch 'OG-01_TS-01'"
+    assert git(git_repo, "status", "--porcelain") == ""
+    with open(os.path.join(git_repo, "feature.md")) as f:
+        assert f.read() == "feature\n"
+    assert git(worktree, "rev-parse", "HEAD") == git(git_repo, "rev-parse", "main")
+    assert git(worktree, "rev-parse", "--abbrev-ref", "HEAD") == "HEAD"
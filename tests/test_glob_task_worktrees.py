@@ -0,0 +1,80 @@
+import os
+
+from conftest import git
+from glob_git_session import GitSession
+from glob_task_worktrees import WorktreePool
+
+
+def _finish(repo, path, branch):
+    """What the complete/fail scripts do before release(): detach at main and drop the branch."""
+    git(path, "checkout", "-q", "--detach", "main")
+    git(repo, "branch", "-D", branch)
+
+
+def _setup_ignores(repo):
+    with open(os.path.join(repo, ".gitignore"), "w") as f:
+        f.write("*.log\nbuild/\n")
+    git(repo, "add", ".gitignore")
+    git(repo, "commit", "-q", "-m", "ignores")
+
+
+def test_released_worktree_is_cleaned_and_reused(git_repo, monkeypatch):
+    _setup_ignores(git_repo)
+    with GitSession() as session:
+        pool = WorktreePool(session, size=2)
+        path = pool.acquire("OG-01_TS-01", "main")
+        assert pool.contains(path)
+        for name in ("ign.log", "untracked.txt", os.path.join("build", "out.o")):
+            os.makedirs(os.path.dirname(os.path.join(path, name)), exist_ok=True)
+            with open(os.path.join(path, name), "w") as f:
+                f.write("left over\n")
+        _finish(git_repo, path, "OG-01_TS-01")
+        # The scripts release the worktree they run in
+        monkeypatch.chdir(path)
+        session.chdir(path)
+
+        assert pool.release(path)
+
+        assert os.getcwd() == pool.main_path
+        assert session.cwd == pool.main_path
+        assert sorted(os.listdir(path)) == [".git", ".gitignore", "README.md"]
+        again = pool.acquire("OG-01_TS-02", "main")
+
+    assert again == path
+    assert git(again, "rev-parse", "--abbrev-ref", "HEAD") == "OG-01_TS-02"
+    assert git(again, "status", "--porcelain", "--ignored") == ""
+
+
+def test_release_removes_worktree_when_pool_is_full(git_repo):
+    with GitSession() as session:
+        pool = WorktreePool(session, size=1)
+        first = pool.acquire("OG-01_TS-01", "main")
+        second = pool.acquire("OG-01_TS-02", "main")
+        assert first != second
+        _finish(git_repo, first, "OG-01_TS-01")
+        _finish(git_repo, second, "OG-01_TS-02")
+
+        assert pool.release(first)
+        assert not pool.release(second)
+
+        assert not os.path.exists(second)
+        assert [worktree.path for worktree in pool.pooled()] == [first]
+        # The kept one is unlocked and can be claimed again
+        assert all(worktree.locked is None for worktree in pool.pooled())
+    assert second not in git(git_repo, "worktree", "list", "--porcelain")
+
+
+def test_release_leaves_a_cwd_outside_the_worktree_alone(git_repo, tmp_path, monkeypatch):
+    elsewhere = tmp_path / "elsewhere"
+    elsewhere.mkdir()
+    with GitSession() as session:
+        pool = WorktreePool(session, size=0)
+        path = pool.acquire("OG-01_TS-01", "main")
+        _finish(git_repo, path, "OG-01_TS-01")
+        monkeypatch.chdir(elsewhere)
+
+        assert not pool.release(path)
+
+        assert os.getcwd() == str(elsewhere)
+        assert session.cwd == git_repo
+    assert not os.path.exists(path)
@@ -0,0 +1,32 @@
+import os
+
+from conftest import git, load_script
+from glob_git_session import GitError, GitSession, RepoSnapshot
+
+verify = load_script("glob_verify-task-set")
+
+
+def test_verify_stages_changes_when_status_fails(git_repo, monkeypatch, capsys):
+    with open(os.path.join(git_repo, "notes.md"), "w") as f:
+        f.write("notes\n")
+    attempts = []
+
+    def failing_once(session):
+        attempts.append(session)
+        if len(attempts) == 1:
+            raise GitError(["status"], 128, stderr="fatal: index locked\n")
+        return RepoSnapshot(session)
+
+    monkeypatch.setattr(verify, "RepoSnapshot", failing_once)
+    monkeypatch.setattr("sys.argv", ["glob_verify-task-set.py", "-b", "main"])
+
+    with GitSession() as session:
+        verify.verify_task_set(session)
+
+    out = capsys.readouterr().out
+    assert "Error: Could not read git status: fatal: index locked" in out
+    assert "Changes staged successfully." in out
+    assert git(git_repo, "diff", "--cached", "--name-only") == "notes.md"
+    # The final status is read afresh
+    assert len(attempts) == 2
+    assert "notes.md" in out.split("Final git status:")[1]